@@ -1,8 +1,13 @@
 import numpy as np
 import os
+import sys
 import matplotlib.pyplot as plt
 import cv2
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                "chess_microservices"))
+from utils.fen import parse_fens  # shared with the RDF ingest
+
 BASE_DIR = "E:/WADe/WADe_ImagineAlpacas/app/training"
 
 # ✅ Load the first batch of images
@@ -43,25 +48,13 @@ def visualize_image(image):
 
     return image
 
-def extract_piece_count(filename):
-    """
-    Extract the number of pieces from the filename in FEN format with dashes instead of slashes.
-    """
-    fen_part = filename.split('.')[0]  # Remove file extension
-    fen_ranks = fen_part.split('-')[:8]  # Extract FEN ranks
-
-    piece_count = 0
-    for rank in fen_ranks:
-        for char in rank:
-            if char.isalpha():  # Each letter represents a piece
-                piece_count += 1
-    return piece_count
+# ✅ Piece counts of the samples checked below, parsed from their FEN filenames at once
+piece_counts = parse_fens(image_files[:10]).total_pieces.tolist()
 
 # ✅ Show a sample image
 sample_index = 7
 debug_image = visualize_image(X[sample_index].astype("uint8"))
-filename = image_files[sample_index]  # Get corresponding filename
-num_pieces = extract_piece_count(filename)
+num_pieces = piece_counts[sample_index]
 
 plt.imshow(debug_image)
 plt.title(f"Phase: {np.argmax(y_phase[sample_index])}, Pieces from filename: {num_pieces}")
@@ -70,6 +63,5 @@ plt.show()
 
 # ✅ Print first 10 samples for verification
 for i in range(10):
-    filename = image_files[i]
-    num_pieces = extract_piece_count(filename)
+    num_pieces = piece_counts[i]
     print(f"Sample {i}: Phase={np.argmax(y_phase[i])}, Pieces from filename={num_pieces}")
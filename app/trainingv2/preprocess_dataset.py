@@ -1,4 +1,5 @@
 import os
+import sys
 import cv2
 import numpy as np
 from tensorflow.keras.utils import to_categorical
@@ -6,13 +7,15 @@ import matplotlib.pyplot as plt
 
 # Update dataset path to point to the dataset folder
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))  # Get root directory
+sys.path.insert(0, os.path.join(BASE_DIR, "chess_microservices"))
+from utils.fen import parse_fens  # shared with the RDF ingest
 DATASET_PATH = os.path.join(BASE_DIR, "dataset/train")  # Adjust if needed
 DEBUG_DIR = os.path.join(BASE_DIR, "app/debug")  # Directory to save debug images
 
 # Image processing parameters
 IMG_SIZE = 128  # Consider using a larger size (e.g., 256) if detail is lost
 
-# Labels for game phases
+# Labels for game phases, in the order of utils.fen.GAME_STATES
 phase_labels = {"Opening": 0, "Middlegame": 1, "Endgame": 2}
 
 # Set this variable to 'yes' or 'no' to control debug image saving
@@ -21,33 +24,6 @@ save_debug_images = 'no'  # Change to 'no' to disable saving debug images
 if save_debug_images == 'yes':
     os.makedirs(DEBUG_DIR, exist_ok=True)  # Create debug directory if it doesn't exist
 
-def extract_piece_count(filename):
-    """
-    Extract the number of pieces from the filename in FEN format with dashes instead of slashes.
-    """
-    fen_part = filename.split('.')[0]  # Remove file extension
-    fen_ranks = fen_part.split('-')[:8]  # FEN ranks are the first 8 parts
-
-    piece_count = 0
-    for rank in fen_ranks:
-        for char in rank:
-            if char.isalpha():  # Each letter represents a piece
-                piece_count += 1
-
-    return piece_count
-
-def detect_game_phase(piece_count):
-    """
-    Determines whether the game is in the Opening, Middlegame, or Endgame
-    based on the number of pieces detected on the board.
-    """
-    if piece_count >= 24:
-        return phase_labels["Opening"]
-    elif 14 <= piece_count <= 23:
-        return phase_labels["Middlegame"]
-    else:
-        return phase_labels["Endgame"]
-
 def save_debug_image(image, filename, piece_count, phase_label, batch_number, idx):
     """
     Save the debug image with the detected information overlay.
@@ -68,6 +44,11 @@ print(f"📂 Scanning dataset folder: {DATASET_PATH}")
 
 image_files = [f for f in os.listdir(DATASET_PATH) if f.endswith((".jpeg", ".png"))]
 
+# Piece counts and game phases of all images at once, parsed from the FEN filenames
+boards = parse_fens(image_files)
+piece_counts = boards.total_pieces.tolist()
+phase_labels_of_images = boards.game_states().tolist()
+
 for idx, filename in enumerate(image_files):
     img_path = os.path.join(DATASET_PATH, filename)
 
@@ -85,11 +66,11 @@ for idx, filename in enumerate(image_files):
         image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
         # Extract piece count from filename
-        piece_count = extract_piece_count(filename)
+        piece_count = piece_counts[idx]
         print(f"🔍 {filename}: Detected Pieces from filename: {piece_count}")
 
         # Detect game phase.
-        phase_label = detect_game_phase(piece_count)
+        phase_label = phase_labels_of_images[idx]
 
         # Store results.
         X.append(image)
@@ -0,0 +1,574 @@
+import asyncio
+import json
+import os
+from functools import partial
+from itertools import islice
+from aiohttp import web
+from config import ROOT_DIR, SPARQL_BACKEND, COMPRESSION_MIN_SIZE, ML_PREDICTION_BATCH
+from utils.async_graphdb_utils import (
+    query_graphdb_async,
+    query_graphdb_rows_async,
+    query_graphdb_chunks_async,
+    query_graphdb_rows_chunks_async,
+    start_async_sparql_client,
+    stop_async_sparql_client,
+)
+from utils.query_cache import cache_stats
+from utils.local_store import get_local_store
+from utils.puzzle_index import get_puzzle_index
+from utils.response_utils import parse_page, TOTAL_COUNT_HEADER, NEXT_CURSOR_HEADER, CACHED_HEADERS
+from utils.http_cache import (
+    CONDITIONAL_PATHS,
+    CACHE_CONTROL,
+    COMPRESSIBLE_MIMETYPES,
+    NDJSON_MIMETYPE,
+    VARY,
+    CompressedStream,
+    cached_response,
+    encoded_etag,
+    etag_matches,
+    negotiate_encoding,
+    negotiate_format,
+    response_etag,
+)
+from utils.sparql_results import sum_results
+from utils.projection import parse_projection
+from utils.sparql_templates import check_values, puzzle_ids_to_ints
+from utils.fen import GAME_STATES
+from microservices.search_service import build_search_queries, format_search_row, SEARCH_FIELDS
+from microservices.filter_service import (
+    build_filter_queries,
+    format_piece_filter_row,
+    game_state_classifier,
+    PIECE_FILTER_FIELDS,
+)
+from microservices.filter_rdf_service import build_game_state_queries, format_game_state_row, GAME_STATE_FIELDS
+from microservices.filter_ml_service import (
+    build_candidate_queries as build_ml_candidate_queries,
+    format_candidates,
+    classify_candidates,
+    predicted_rows,
+)
+from microservices.recommendation_service import (
+    build_displayed_queries,
+    find_dominant_feature,
+    build_candidate_query as build_recommendation_candidate_query,
+    candidate_page_size,
+    add_candidate_page,
+    format_recommendations,
+    RECOMMENDATION_FIELDS,
+)
+from microservices.recommendation_ml_service import build_image_queries, recommend_from_results
+from microservices.recommendation_position_service import parse_position_request, recommend_positions
+from microservices.position_service import parse_position_fen, lookup_position
+from microservices.initial_load_service import build_initial_query, format_initial_row
+
+# Same serialization as Flask's jsonify
+json_response = partial(web.json_response, dumps=partial(json.dumps, sort_keys=True))
+
+
+_END = object()
+
+
+async def iterate(items):
+    for item in items:
+        yield item
+
+
+async def format_rows(rows, format_row):
+    index = 0
+    async for binding in rows:
+        index += 1
+        yield format_row(binding, index)
+
+
+async def project_rows(items, projection):
+    async for item in items:
+        yield projection.project(item)
+
+
+async def page_rows(rows, limit):
+    """
+    Async counterpart of utils.response_utils.page_rows: collects the limit + 1 rows of
+    a page and returns (rows, headers) with the next cursor.
+    """
+    if limit is None:
+        return rows, {}
+    page = []
+    async for row in rows:
+        page.append(row)
+        if len(page) > limit:
+            break
+    if len(page) > limit and hasattr(rows, "aclose"):
+        # As in the sync version: end the LIMITed query for the cache, then stop the other chunks
+        await anext(rows, None)
+        await rows.aclose()
+    if len(page) <= limit:
+        return iterate(page), {}
+    return iterate(page[:limit]), {NEXT_CURSOR_HEADER: page[limit - 1]["puzzle_id"]["value"]}
+
+
+async def stream_results(request, items, headers=None, projection=None):
+    """
+    Writes an async iterable of puzzle objects as a JSON array, or one per line as NDJSON
+    when the request asks for it, one item at a time. The first item is awaited before
+    the response starts so query errors still map to a 500. With a projection, only the
+    requested fields are written, or the compact columns, which are not streamed.
+    """
+    if projection is not None:
+        if projection.compact:
+            return json_response(projection.columns([item async for item in items]), headers=headers)
+        items = project_rows(items, projection)
+    dumps = partial(json.dumps, sort_keys=True)
+    first = await anext(items, _END)
+
+    ndjson = request["format"] == NDJSON_MIMETYPE
+    headers = {"Content-Type": request["format"], **(headers or {})}
+    etag, encoding = request["etag"], request["encoding"]
+    stream = None
+    if encoding is not None:
+        stream = CompressedStream(encoding, etag, {name: headers[name] for name in CACHED_HEADERS if name in headers})
+        headers["Content-Encoding"] = encoding
+    headers["Vary"] = VARY
+    if etag is not None:
+        headers["ETag"] = encoded_etag(etag, encoding)
+        headers["Cache-Control"] = CACHE_CONTROL
+
+    response = web.StreamResponse(headers=headers)
+    await response.prepare(request)
+
+    async def write(data):
+        data = stream.write(data) if stream else data
+        if data:
+            await response.write(data)
+
+    if ndjson:
+        if first is not _END:
+            await write(dumps(first).encode("utf-8") + b"\n")
+            async for item in items:
+                await write(dumps(item).encode("utf-8") + b"\n")
+    elif first is _END:
+        await write(b"[]\n")
+    else:
+        # The first item goes out with the bracket, in the first (flushed) compressed block
+        await write(b"[" + dumps(first).encode("utf-8"))
+        async for item in items:
+            await write(b"," + dumps(item).encode("utf-8"))
+        await write(b"]\n")
+    if stream:
+        await response.write(stream.finish())
+    await response.write_eof()
+    return response
+
+
+async def run_blocking(func, *args):
+    """
+    Runs CPU-bound or blocking work (ML models, image decoding) off the event loop.
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+async def predicted_page(rows, game_states, limit):
+    """
+    Async counterpart of predicted_rows chained with islice(limit + 1): candidates are
+    read ML_PREDICTION_BATCH at a time and classified off the event loop, and both the
+    query and the model stop once a page has matched.
+    """
+    matched = 0
+    batch = []
+    try:
+        async for row in rows:
+            batch.append(row)
+            if len(batch) < ML_PREDICTION_BATCH:
+                continue
+            for predicted in await run_blocking(list, predicted_rows(batch, game_states)):
+                yield predicted
+                matched += 1
+                if limit is not None and matched > limit:
+                    return
+            batch = []
+        if batch:
+            for predicted in islice(await run_blocking(list, predicted_rows(batch, game_states)),
+                                    None if limit is None else limit + 1 - matched):
+                yield predicted
+    finally:
+        if hasattr(rows, "aclose"):
+            await rows.aclose()
+
+
+async def read_json(request):
+    """
+    JSON object of a request body. Raises ValueError for an empty, malformed or non-object
+    body, which the routes answer with 400 as Flask does.
+    """
+    try:
+        data = await request.json()
+    except ValueError:
+        raise ValueError("Request body must be a JSON object") from None
+    if not isinstance(data, dict):
+        raise ValueError("Request body must be a JSON object")
+    return data
+
+
+async def search(request):
+    query = request.query.get("query", "").strip().lower()
+    if not query:
+        return json_response({"error": "Query parameter is required"}, status=400)
+    try:
+        after, limit = parse_page(request.query.get("after"), request.query.get("limit"))
+        projection = parse_projection(request.query.get("fields"), request.query.get("format"), SEARCH_FIELDS)
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+
+    try:
+        headers = {}
+        index = await run_blocking(get_puzzle_index)
+        if index is not None:
+            # Square terms may load the bitboard store from disk
+            bits = await run_blocking(index.search_bits, query)
+            rows = iterate(index.rows(bits, after=after, limit=limit, variables=projection.variables))
+            headers[TOTAL_COUNT_HEADER] = str(index.count(bits))
+        else:
+            sparql_queries = await run_blocking(build_search_queries, query, after, limit, projection.variables)
+            rows = await query_graphdb_rows_chunks_async(sparql_queries)
+        rows, page_headers = await page_rows(rows, limit)
+        return await stream_results(request, format_rows(rows, format_search_row), {**headers, **page_headers},
+                                    projection)
+    except Exception as e:
+        return json_response({"error": str(e)}, status=500)
+
+
+async def filter(request):
+    try:
+        data = await read_json(request)
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+    filters = data.get("filters", {})
+    puzzle_ids = data.get("puzzle_ids", [])
+    game_state_filter_endpoint = data.get("game_state_filter_endpoint", "")
+
+    if not puzzle_ids:
+        return json_response({"error": "puzzle_ids are required"}, status=400)
+    try:
+        after, limit = parse_page(data.get("after"), data.get("limit"))
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+
+    game_states = filters.get("game_state")
+    classifier = game_state_classifier(game_state_filter_endpoint) if game_states else None
+    query_limit = None if classifier == "ml" else limit
+
+    headers = {}
+    index = await run_blocking(get_puzzle_index)
+    try:
+        projection = parse_projection(data.get("fields"), data.get("format"),
+                                      PIECE_FILTER_FIELDS if classifier is None else GAME_STATE_FIELDS)
+        if classifier == "ml":
+            check_values(game_states, GAME_STATES)
+        if index is not None:
+            bits = index.filter_pieces_bits(filters, puzzle_ids)
+            if classifier == "rdf":
+                bits &= index.game_state_bits(game_states)
+            rows = iterate(index.rows(bits, with_game_state=classifier == "rdf", after=after, limit=query_limit,
+                                      variables=projection.variables))
+            if classifier != "ml":
+                headers[TOTAL_COUNT_HEADER] = str(index.count(bits))
+        else:
+            sparql_queries = build_filter_queries(filters, puzzle_ids, game_states if classifier == "rdf" else None,
+                                                  after, query_limit, projection.variables)
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+
+    try:
+        if index is None:
+            rows = await query_graphdb_rows_chunks_async(sparql_queries)
+        if classifier == "ml":
+            rows = predicted_page(rows, game_states, limit)
+        rows, page_headers = await page_rows(rows, limit)
+        format_row = format_piece_filter_row if classifier is None else format_game_state_row
+        return await stream_results(request, format_rows(rows, format_row), {**headers, **page_headers}, projection)
+    except Exception as e:
+        return json_response({"error": str(e)}, status=500)
+
+
+async def filter_game_state_rdf(request):
+    try:
+        data = await read_json(request)
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+    puzzle_ids = data.get("puzzle_ids", [])
+    game_states = data.get("game_state", [])
+
+    if not puzzle_ids:
+        return json_response({"error": "No puzzle_ids provided for game-state filtering"}, status=400)
+
+    headers = {}
+    index = await run_blocking(get_puzzle_index)
+    try:
+        after, limit = parse_page(data.get("after"), data.get("limit"))
+        projection = parse_projection(data.get("fields"), data.get("format"), GAME_STATE_FIELDS)
+        if index is not None:
+            bits = index.filter_game_state_bits(puzzle_ids, game_states)
+            rows = iterate(index.rows(bits, with_game_state=True, after=after, limit=limit,
+                                      variables=projection.variables))
+            headers[TOTAL_COUNT_HEADER] = str(index.count(bits))
+        else:
+            sparql_queries = build_game_state_queries(puzzle_ids, game_states, after, limit, projection.variables)
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+
+    try:
+        if index is None:
+            rows = await query_graphdb_rows_chunks_async(sparql_queries)
+        rows, page_headers = await page_rows(rows, limit)
+        return await stream_results(request, format_rows(rows, format_game_state_row), {**headers, **page_headers},
+                                    projection)
+    except Exception as e:
+        return json_response({"error": str(e)}, status=500)
+
+
+async def filter_game_state_ml(request):
+    try:
+        data = await read_json(request)
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+    puzzle_ids = data.get("puzzle_ids", [])
+    game_states = data.get("game_state", [])
+
+    if not puzzle_ids:
+        return json_response({"error": "No puzzle_ids provided for ML-based filtering"}, status=400)
+
+    try:
+        sparql_queries = build_ml_candidate_queries(puzzle_ids)
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+
+    try:
+        sparql_results = await query_graphdb_chunks_async(sparql_queries)
+    except Exception as e:
+        return json_response({"error": str(e)}, status=500)
+
+    candidates = format_candidates(sparql_results)
+    return json_response(await run_blocking(classify_candidates, candidates, game_states))
+
+
+async def rdf_recommendations(request):
+    try:
+        data = await read_json(request)
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+    displayed_puzzle_ids = data.get("puzzle_ids", [])
+
+    if not displayed_puzzle_ids:
+        return json_response({"error": "Displayed puzzle IDs are required"}, status=400)
+
+    try:
+        displayed = set(puzzle_ids_to_ints(displayed_puzzle_ids))
+        displayed_queries = build_displayed_queries(displayed)
+        projection = parse_projection(data.get("fields"), data.get("format"), RECOMMENDATION_FIELDS)
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+
+    try:
+        displayed_results = await query_graphdb_chunks_async(displayed_queries, merge=sum_results)
+        dominant_feature = find_dominant_feature(displayed_results)
+        if dominant_feature is None:
+            return json_response(projection.payload([]))
+
+        candidates = []
+        offset = 0
+        page_size = candidate_page_size(len(displayed))
+        while True:
+            candidate_results = await query_graphdb_async(
+                build_recommendation_candidate_query(displayed, dominant_feature, offset, projection.variables)
+            )
+            if not add_candidate_page(candidates, candidate_results, displayed, page_size):
+                break
+            offset += page_size
+        recommendations = format_recommendations({"results": {"bindings": candidates}}, dominant_feature)
+        return json_response(projection.payload(recommendations))
+    except Exception as e:
+        return json_response({"error": str(e)}, status=500)
+
+
+async def ml_recommendations(request):
+    try:
+        data = await read_json(request)
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+    if "puzzle_ids" not in data:
+        return json_response({"error": "Missing 'puzzle_ids' in request payload"}, status=400)
+
+    puzzle_ids = data["puzzle_ids"]
+    if not isinstance(puzzle_ids, list) or not puzzle_ids:
+        return json_response({"error": "'puzzle_ids' must be a non-empty list"}, status=400)
+
+    try:
+        sparql_queries = build_image_queries(puzzle_ids)
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+
+    try:
+        results = await query_graphdb_chunks_async(sparql_queries)
+        payload, status = await run_blocking(recommend_from_results, results)
+        return json_response(payload, status=status)
+    except Exception as e:
+        return json_response({"error": str(e)}, status=500)
+
+
+async def position_recommendations(request):
+    try:
+        data = await read_json(request)
+        puzzle_ids, metric, count = parse_position_request(data)
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+
+    try:
+        # The ranking is NumPy work over the whole dataset, kept off the event loop
+        return json_response(await run_blocking(recommend_positions, puzzle_ids, metric, count))
+    except Exception as e:
+        return json_response({"error": str(e)}, status=500)
+
+
+async def position(request):
+    try:
+        boards = parse_position_fen(request.query.get("fen"))
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+
+    try:
+        return json_response(await run_blocking(lookup_position, boards))
+    except Exception as e:
+        return json_response({"error": str(e)}, status=500)
+
+
+def image_path(filename):
+    """
+    Path of a dataset image in test/ or train/, or None. As with send_from_directory,
+    names that would leave those folders are refused.
+    """
+    if not filename or "/" in filename or os.sep in filename or filename in (".", ".."):
+        return None
+    for folder in ("test", "train"):
+        path = os.path.join(ROOT_DIR, "dataset", folder, filename)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+async def serve_image(request):
+    path = await run_blocking(image_path, request.match_info["filename"])
+    if path is None:
+        raise web.HTTPNotFound()
+    # FileResponse streams the file with sendfile without blocking the loop
+    return web.FileResponse(path)
+
+
+async def initial(request):
+    try:
+        after, limit = parse_page(request.query.get("after"), request.query.get("limit"))
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+
+    try:
+        rows, headers = await page_rows(await query_graphdb_rows_async(build_initial_query(after, limit)), limit)
+        return await stream_results(request, format_rows(rows, format_initial_row), headers)
+    except Exception as e:
+        return json_response({"error": str(e)}, status=500)
+
+
+async def get_cache_stats(request):
+    return json_response(cache_stats())
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    """
+    Mirrors flask_cors defaults: preflight requests are answered directly.
+    """
+    if request.method == "OPTIONS":
+        response = web.Response()
+        response.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
+        response.headers["Access-Control-Allow-Headers"] = request.headers.get("Access-Control-Request-Headers", "*")
+        return response
+    return await handler(request)
+
+
+@web.middleware
+async def http_cache_middleware(request, handler):
+    """
+    Same as utils.response_utils.conditional_request / compress_response: 304 and
+    precompressed bodies for the GET read endpoints, compressed JSON bodies for all.
+    Streamed responses are compressed by stream_results as they are written.
+    """
+    etag = None
+    encoding = negotiate_encoding(request.headers.get("Accept-Encoding"))
+    request["format"] = negotiate_format(request.headers.get("Accept"))
+    if request.method == "GET" and request.path in CONDITIONAL_PATHS:
+        etag = response_etag(request.path, request.query_string, request["format"])
+        headers = {"ETag": encoded_etag(etag, encoding), "Cache-Control": CACHE_CONTROL, "Vary": VARY}
+        if etag_matches(request.headers.get("If-None-Match"), etag):
+            return web.Response(status=304, headers=headers)
+        cached = cached_response(etag, encoding) if encoding else None
+        if cached is not None:
+            body, cached_headers = cached
+            return web.Response(body=body, headers={**cached_headers, **headers, "Content-Encoding": encoding})
+    request["etag"], request["encoding"] = etag, encoding
+
+    response = await handler(request)
+    if not isinstance(response, web.Response) or response.status != 200 or response.content_type not in COMPRESSIBLE_MIMETYPES:
+        return response
+    body = response.body or b""
+    if encoding is not None and len(body) < COMPRESSION_MIN_SIZE:
+        encoding = None
+    response.headers["Vary"] = VARY
+    if etag is not None:
+        response.headers["ETag"] = encoded_etag(etag, encoding)
+        response.headers["Cache-Control"] = CACHE_CONTROL
+    if encoding is not None:
+        stream = CompressedStream(encoding, etag, {name: response.headers[name] for name in CACHED_HEADERS if name in response.headers})
+        response.body = stream.write(body) + stream.finish()
+        response.headers["Content-Encoding"] = encoding
+    return response
+
+
+async def add_cors_headers(request, response):
+    # Runs on prepare, so streamed responses get the header too
+    response.headers["Access-Control-Allow-Origin"] = "*"
+    response.headers["Access-Control-Expose-Headers"] = f"{TOTAL_COUNT_HEADER}, {NEXT_CURSOR_HEADER}"
+
+
+async def on_startup(app):
+    await start_async_sparql_client()
+    if SPARQL_BACKEND == "local":
+        await run_blocking(get_local_store().warm_up)
+    await run_blocking(get_puzzle_index)
+
+
+async def on_cleanup(app):
+    await stop_async_sparql_client()
+
+
+def create_app():
+    app = web.Application(middlewares=[cors_middleware, http_cache_middleware])
+    app.add_routes([
+        web.get("/search", search),
+        web.post("/filter", filter),
+        web.post("/filter/game-state-rdf", filter_game_state_rdf),
+        web.post("/filter/game-state-ml", filter_game_state_ml),
+        web.post("/rdf-recommendations", rdf_recommendations),
+        web.post("/ml-recommendations", ml_recommendations),
+        web.post("/position-recommendations", position_recommendations),
+        web.get("/position", position),
+        web.get("/images/{filename}", serve_image),
+        web.get("/initial", initial),
+        web.get("/cache/stats", get_cache_stats),
+    ])
+    app.on_response_prepare.append(add_cors_headers)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+if __name__ == "__main__":
+    web.run_app(create_app(), host="0.0.0.0", port=5000)
@@ -0,0 +1,94 @@
+"""
+Times the batch FEN parser on synthetic image filenames, in boards/sec: one board per
+call, batches of growing size, the ingest path (one batch, then a dict per board) and the
+batch validation against the compiled chess-shapes.ttl.
+
+Run from chess_microservices/:
+    python -m benchmarks.fen_parser --size 100000
+"""
+import argparse
+import os
+import statistics
+import time
+import numpy as np
+from config import ROOT_DIR
+from utils.fen import PIECE_LETTERS, parse_fens
+from utils.validation import compile_shapes, validate_counts
+
+
+def synthetic_filenames(size, seed=0):
+    """
+    Random boards with a king each and up to 30 other pieces, named like the dataset images.
+    """
+    rng = np.random.default_rng(seed)
+    squares = np.where(rng.random((size, 64)) < 0.25, rng.integers(2, 13, size=(size, 64)), 0)
+    kings = rng.permuted(np.tile(np.arange(64), (size, 1)), axis=1)[:, :2]
+    squares[np.arange(size)[:, None], kings] = [1, 7]
+
+    letters = np.array(list("." + PIECE_LETTERS))
+    filenames = []
+    for board in letters[squares].reshape(size, 8, 8):
+        ranks = []
+        for rank in board:
+            fen, empty = "", 0
+            for square in rank:
+                if square == ".":
+                    empty += 1
+                    continue
+                fen += (str(empty) if empty else "") + square
+                empty = 0
+            ranks.append(fen + (str(empty) if empty else ""))
+        filenames.append("-".join(ranks) + ".jpeg")
+    return filenames
+
+
+def time_call(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=100000, help="number of boards")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per case, the median is reported")
+    args = parser.parse_args()
+
+    filenames = synthetic_filenames(args.size)
+    one_by_one = filenames[:min(len(filenames), 10000)]
+    cases = [
+        (f"one board per call ({len(one_by_one)} boards)", len(one_by_one),
+         lambda: [parse_fens([filename]) for filename in one_by_one]),
+    ]
+    for batch_size in (100, 2000, args.size):
+        if batch_size <= args.size:
+            cases.append((
+                f"batches of {batch_size}", args.size,
+                lambda batch_size=batch_size: [
+                    parse_fens(filenames[start:start + batch_size])
+                    for start in range(0, args.size, batch_size)
+                ],
+            ))
+
+    cases.append((
+        "one batch + properties per board", args.size,
+        lambda: [boards.properties(i) for boards in [parse_fens(filenames)] for i in range(len(boards))],
+    ))
+
+    constraints = compile_shapes(os.path.join(ROOT_DIR, "chess-shapes.ttl"))
+    cases.append((
+        "one batch + compiled shapes", args.size,
+        lambda: validate_counts(parse_fens(filenames).counts, constraints),
+    ))
+
+    print(f"{args.size} boards")
+    for name, boards, func in cases:
+        seconds = time_call(func, args.repeat)
+        print(f"{name:45s} {boards / seconds:14,.0f} boards/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Times the in-memory puzzle index bitsets, the bitboard square search and similarity, and the
+Zobrist position lookup on a synthetic dataset.
+
+Run from chess_microservices/:
+    python -m benchmarks.puzzle_index --size 100000
+"""
+import argparse
+import statistics
+import time
+import numpy as np
+from benchmarks.fen_parser import synthetic_filenames
+from utils.bitboards import BitboardStore, square_terms, canonical_rows
+from utils.fen import parse_fens
+from utils.puzzle_index import PuzzleIndex, SIDES, FLAGS
+
+
+def synthetic_index(size, seed=0):
+    """
+    Random positions with piece counts in realistic ranges; the contents do not matter for timing.
+    """
+    rng = np.random.default_rng(seed)
+    maxima = np.array([1, 2, 3, 3, 3, 9] * len(SIDES))
+    counts = rng.integers(0, maxima, size=(size, len(maxima)), endpoint=True)
+    counts[:, [0, 6]] = 1  # one king each
+    return PuzzleIndex(
+        puzzle_ids=np.arange(1, size + 1),
+        images=[f"http://imaginealpacas.org/chess/{i}.jpeg" for i in range(size)],
+        sides=rng.integers(0, len(SIDES), size=size),
+        counts=counts,
+        flags=rng.integers(0, 2, size=(size, len(FLAGS))),
+    )
+
+
+def time_call(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=100000, help="number of puzzles")
+    parser.add_argument("--repeat", type=int, default=50, help="runs per case, the median is reported")
+    args = parser.parse_args()
+
+    index = synthetic_index(args.size)
+    all_ids = [str(i) for i in range(1, args.size + 1)]
+    filters = {"rooks": ["2+"], "pawns": ["3+", "1"], "queens": ["1"]}
+    filenames = synthetic_filenames(args.size)
+    bitboards = BitboardStore.from_images(list(enumerate(filenames, start=1)))
+    probe = parse_fens(filenames[-1:])
+    squares = square_terms("white_knight:f3 pawns:7")
+    cases = [
+        ("search 'rooks queen'", lambda: index.search_bits("rooks queen")),
+        ("search '2 rooks white castling'", lambda: index.search_bits("2 rooks white castling")),
+        ("piece filter, 3 pieces", lambda: index.piece_filter_bits(filters)),
+        ("game state filter", lambda: index.game_state_bits(["midgame", "endgame"])),
+        (f"id bits, {len(all_ids)} string ids", lambda: index.id_bits(all_ids)),
+        ("/filter bits, all ids", lambda: index.filter_pieces_bits(filters, all_ids)),
+        ("result count", lambda: index.count(index.piece_filter_bits(filters))),
+        ("squares 'white_knight:f3 pawns:7'", lambda: int(np.count_nonzero(bitboards.matches(squares)))),
+        ("position recommendations, 6 shown", lambda: len(bitboards.nearest(list(range(1, 7)), 3)[0])),
+        ("position recommendations, 100 shown", lambda: len(bitboards.nearest(list(range(1, 101)), 3, "hamming")[0])),
+        ("exact position lookup", lambda: len(bitboards.position_rows(probe)[0])),
+        ("duplicate detection", lambda: int(np.count_nonzero(
+            canonical_rows(bitboards.hashes, bitboards.bitboards) != np.arange(len(bitboards))))),
+    ]
+    print(f"{len(index)} puzzles")
+    for name, func in cases:
+        result = func()
+        matches = result if isinstance(result, int) else index.count(result)
+        print(f"{name:<35} {time_call(func, args.repeat):>8.3f} ms {matches:>8} matches")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Size and cost of the /initial body in each content coding of utils/http_cache.py, on
+synthetic puzzles named like the dataset images: bytes sent, compression time of one
+response and the time a client spends decompressing and parsing it (more than parsing
+alone: compression trades client CPU for bytes on the wire).
+
+Run from chess_microservices/:
+    python -m benchmarks.response_compression --size 100000
+"""
+import argparse
+import json
+import zlib
+import brotli
+from config import GRAPHDB_ENDPOINT
+from benchmarks.fen_parser import synthetic_filenames, time_call
+from microservices.initial_load_service import format_initial_row
+from utils.http_cache import ENCODINGS, CompressedStream
+
+DECOMPRESS = {"br": brotli.decompress, "gzip": lambda body: zlib.decompress(body, 16 + zlib.MAX_WBITS)}
+
+
+def initial_chunks(size):
+    """
+    The chunks stream_json_array writes for an /initial response of size puzzles.
+    """
+    chunks = ["["]
+    for index, filename in enumerate(synthetic_filenames(size), 1):
+        binding = {"image": {"value": f"{GRAPHDB_ENDPOINT}/{filename}"}, "puzzle_id": {"value": str(index)}}
+        chunks.extend(["," if index > 1 else "", json.dumps(format_initial_row(binding, index), sort_keys=True)])
+    chunks.append("]\n")
+    return [chunk.encode("utf-8") for chunk in chunks if chunk]
+
+
+def compress(chunks, encoding):
+    stream = CompressedStream(encoding)
+    return b"".join([stream.write(chunk) for chunk in chunks] + [stream.finish()])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=100000, help="puzzles in the response")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case, the median is reported")
+    args = parser.parse_args()
+
+    chunks = initial_chunks(args.size)
+    body = b"".join(chunks)
+    parse = time_call(lambda: json.loads(body), args.repeat)
+    print(f"{'encoding':<10}{'bytes':>14}{'ratio':>8}{'compress ms':>14}{'decode+parse ms':>17}")
+    print(f"{'identity':<10}{len(body):>14,}{1:>8.1f}{0:>14.1f}{parse * 1000:>17.1f}")
+    for encoding in ENCODINGS:
+        compressed = compress(chunks, encoding)
+        seconds = time_call(lambda: compress(chunks, encoding), args.repeat)
+        client = time_call(lambda: json.loads(DECOMPRESS[encoding](compressed)), args.repeat)
+        print(f"{encoding:<10}{len(compressed):>14,}{len(body) / len(compressed):>8.1f}"
+              f"{seconds * 1000:>14.1f}{client * 1000:>17.1f}")
+    print("A precompressed cache hit (or a 304) skips the compression and the queries altogether.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Compares the GraphDB HTTP backend with the embedded local store on every query the services send.
+
+Run from chess_microservices/ after utils/setup_rdf.py:
+    python -m benchmarks.sparql_backends --repeat 5
+"""
+import argparse
+import statistics
+import time
+from config import GRAPHDB_ENDPOINT, PAGE_DEFAULT_LIMIT
+from utils.graphdb_utils import SparqlClient
+from utils.local_store import LocalSparqlStore
+from utils.sparql_templates import render, values_block, chunk_puzzle_ids
+from microservices.initial_load_service import build_initial_query
+from microservices.search_service import build_search_queries
+from microservices.filter_service import build_piece_filter_queries, build_filter_queries
+from microservices.filter_rdf_service import build_game_state_queries
+from microservices.recommendation_service import build_displayed_queries, build_candidate_query
+
+
+def service_queries(puzzle_ids, sample_size):
+    """
+    One entry per query shape: (name, list of queries sent for one request).
+    Id-based queries use every puzzle (what the frontend sends after /initial)
+    and a sample of the first sample_size ids.
+    """
+    sample = puzzle_ids[:sample_size]
+    queries = [
+        ("initial", [build_initial_query()]),
+        # Keyset pages: a page deep in the dataset should cost no more than the first one
+        (f"initial, first page of {PAGE_DEFAULT_LIMIT}", [build_initial_query(None, PAGE_DEFAULT_LIMIT)]),
+        (f"initial, page of {PAGE_DEFAULT_LIMIT} after the middle id",
+         [build_initial_query(puzzle_ids[len(puzzle_ids) // 2], PAGE_DEFAULT_LIMIT)]),
+        ("search 'rooks queen'", build_search_queries("rooks queen")),
+        ("search '2 rooks no queens endgame'", build_search_queries("2 rooks no queens endgame")),
+        # fields=puzzle_id: only the variables and patterns the projection reads
+        ("search 'rooks queen', fields=puzzle_id", build_search_queries("rooks queen", variables={"image", "puzzle_id"})),
+    ]
+    for label, ids in ((f"{len(sample)} ids", sample), (f"all {len(puzzle_ids)} ids", puzzle_ids)):
+        chunks = chunk_puzzle_ids(ids)
+        queries += [
+            (f"filter pieces, {label}", build_piece_filter_queries({"rooks": ["2+"], "pawns": ["3+"]}, ids)),
+            (f"filter game state, {label}", build_game_state_queries(ids, ["midgame", "endgame"])),
+            (f"filter pieces + game state, one query, {label}",
+             build_filter_queries({"rooks": ["2+"], "pawns": ["3+"]}, ids, ["midgame", "endgame"])),
+            (f"ml candidates, {label}", [render("ml_candidates", puzzle_values=values_block("puzzle_id", c)) for c in chunks]),
+            (f"ml images, {label}", [render("ml_images", puzzle_values=values_block("puzzle_id", c)) for c in chunks]),
+            (f"recommendation summary, {label}", build_displayed_queries(ids)),
+            (f"recommendation candidates, {label}", [build_candidate_query(ids, "rooks")]),
+        ]
+    return queries
+
+
+def time_queries(backend, sparql_queries, repeat):
+    """
+    Returns (median milliseconds, rows) for sending every query of one request in turn.
+    """
+    timings = []
+    rows = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = sum(len(backend.query(q)["results"]["bindings"]) for q in sparql_queries)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings), rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="runs per query, the median is reported")
+    parser.add_argument("--sample", type=int, default=100, help="size of the small puzzle id set")
+    parser.add_argument("--endpoint", default=GRAPHDB_ENDPOINT, help="SPARQL endpoint of the HTTP backend")
+    args = parser.parse_args()
+
+    local = LocalSparqlStore()
+    start = time.perf_counter()
+    local.warm_up()
+    print(f"Local store loaded in {time.perf_counter() - start:.2f}s")
+
+    initial = local.query(build_initial_query())["results"]["bindings"]
+    puzzle_ids = [int(binding["puzzle_id"]["value"]) for binding in initial]
+
+    backends = {"http": SparqlClient(args.endpoint), "local": local}
+    try:
+        backends["http"].query(build_initial_query())
+    except Exception as e:
+        print(f"HTTP backend unavailable at {args.endpoint}: {e}")
+        del backends["http"]
+
+    print(f"{'query':<45} {'rows':>7} " + " ".join(f"{name + ' ms':>10}" for name in backends) + f" {'speedup':>8}")
+    for name, sparql_queries in service_queries(puzzle_ids, args.sample):
+        medians = {}
+        for backend_name, backend in backends.items():
+            medians[backend_name], rows = time_queries(backend, sparql_queries, args.repeat)
+        speedup = f"{medians['http'] / medians['local']:.1f}x" if "http" in medians else "-"
+        print(f"{name:<45} {rows:>7} " + " ".join(f"{ms:>10.1f}" for ms in medians.values()) + f" {speedup:>8}")
+
+    for backend in backends.values():
+        backend.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,93 @@
+import os
+
 ### Uncomment the lines on the bottom to use the remote server
 
 GRAPHDB_ENDPOINT = "http://localhost:7200/repositories/chess-repo"
+GRAPHDB_UPDATE_ENDPOINT = GRAPHDB_ENDPOINT + "/statements"  # SPARQL Update endpoint of the same repository
 BASE_URL = "http://localhost:5000"
 
 # GRAPHDB_ENDPOINT = "http://3.80.124.45:3030/chess-repo"
+# GRAPHDB_UPDATE_ENDPOINT = "http://3.80.124.45:3030/chess-repo/update"
 # BASE_URL = "http://54.157.41.92:5000"
+
+### SPARQL client settings (applied per worker process)
+
+GRAPHDB_CONNECT_TIMEOUT = 3.05  # seconds to establish the TCP connection
+GRAPHDB_READ_TIMEOUT = 60  # seconds to wait for the store to answer
+GRAPHDB_POOL_SIZE = 10  # keep-alive connections kept open to the store
+GRAPHDB_MAX_CONCURRENCY = 10  # queries allowed in flight at the same time
+GRAPHDB_MAX_RETRIES = 3  # retries on connection errors and 429/502/503/504
+GRAPHDB_RETRY_BACKOFF = 0.3  # backoff factor between retries (0.3s, 0.6s, 1.2s, ...)
+
+# async_gateway.py keeps many more queries in flight from a single process
+ASYNC_GRAPHDB_POOL_SIZE = 100
+ASYNC_GRAPHDB_MAX_CONCURRENCY = 200
+
+# Puzzle id sets larger than this are split into several queries run concurrently
+SPARQL_CHUNK_SIZE = 1000
+
+### SPARQL result cache
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATASET_VERSION_FILE = os.path.join(ROOT_DIR, "dataset_version")  # bumped by utils/setup_rdf.py
+RDF_SCHEMA_FILE = os.path.join(ROOT_DIR, "rdf_schema")  # "nested" or "flat", written by setup_rdf.py / migrate_rdf_schema.py
+INGEST_MANIFEST_FILE = os.path.join(ROOT_DIR, "ingest_manifest.tsv")  # image file name -> stable puzzle_id, written by setup_rdf.py
+BITBOARDS_FILE = os.path.join(ROOT_DIR, "bitboards.npz")  # piece bitboards of every puzzle_id, written by setup_rdf.py
+INGEST_ADDED_FILE = os.path.join(ROOT_DIR, "ontology.added.nt")  # triples added by the last --incremental ingest
+INGEST_REMOVED_FILE = os.path.join(ROOT_DIR, "ontology.removed.nt")  # triples it removed; both are deleted by a full ingest
+
+SPARQL_CACHE_BACKEND = "memory"  # "memory", "disk" or None to disable caching
+SPARQL_CACHE_SIZE = 256  # entries kept before the least recently used one is evicted
+SPARQL_CACHE_TTL = 3600  # seconds an entry stays valid
+SPARQL_CACHE_PATH = os.path.join(ROOT_DIR, "sparql_cache.sqlite3")  # used by the "disk" backend
+SPARQL_CACHE_MAX_ROWS = 50000  # streamed results longer than this are not cached
+
+### SPARQL backend
+
+SPARQL_BACKEND = "http"  # "http" queries GRAPHDB_ENDPOINT, "local" an embedded store (no network hop)
+LOCAL_STORE_SOURCE = os.path.join(ROOT_DIR, "ontology.nt")  # written by utils/setup_rdf.py, loaded by the "local" backend
+
+### Bulk loader (utils/bulk_load.py)
+
+BULK_LOAD_CHUNK_SIZE = 50000  # triples per update, each one a transaction in the store
+BULK_LOAD_CONCURRENCY = 4  # updates sent at the same time
+BULK_LOAD_CHECKPOINT_FILE = os.path.join(ROOT_DIR, "bulk_load_checkpoint.json")  # committed chunks, to resume a load
+
+### In-memory puzzle index
+
+PUZZLE_INDEX = None  # None, "store" (loaded through the SPARQL backend) or "fen" (parsed from the image filenames)
+PUZZLE_INDEX_DATASET_DIR = os.path.join(ROOT_DIR, "dataset", "test")  # read by the "fen" source
+PUZZLE_INDEX_RETRY_INTERVAL = 30  # seconds before a failed build is retried, the services use SPARQL meanwhile
+
+### Position recommendations (bitboard similarity)
+
+POSITION_SIMILARITY_METRIC = "jaccard"  # "jaccard" or "hamming", when the request does not name one
+POSITION_SIMILARITY_BATCH = 65536  # (displayed, candidate) position pairs compared per NumPy batch
+POSITION_RECOMMENDATION_MAX_COUNT = 100  # largest "count" a request may ask for
+
+### Keyset pagination (/initial, /search, /filter)
+
+PAGE_DEFAULT_LIMIT = 100  # page size when a request passes "after" without "limit"
+PAGE_MAX_LIMIT = 1000  # largest "limit" a request may ask for
+
+### HTTP caching and compression (/initial, /search, /position, /filter)
+
+RESPONSE_COMPRESSION = True  # gzip / brotli JSON bodies for clients that accept it
+GZIP_LEVEL = 6  # zlib level of gzip responses
+BROTLI_QUALITY = 5  # brotli quality, well below the slow maximum of 11 since bodies are compressed per request
+COMPRESSION_MIN_SIZE = 1024  # bytes; smaller (non-streamed) bodies are sent as is
+COMPRESSED_CACHE_SIZE = 64  # precompressed GET responses kept per worker, least recently used evicted first
+COMPRESSED_CACHE_MAX_BYTES = 8 * 1024 * 1024  # compressed responses larger than this are not kept
+
+### Duplicate positions
+
+COLLAPSE_DUPLICATES = True  # hide images linked by chess:duplicate_of from /initial, /search and the recommendations
+
+### ML game state (/filter/game-state-ml, /filter with the ML classifier)
+
+ML_PREDICTION_BATCH = 32  # images classified per model call
+ML_PREDICTION_CACHE_SIZE = 100000  # predicted game states kept per worker, by image filename
+
+### Search query language (/search)
+
+SEARCH_PLAN_CACHE_SIZE = 1024  # compiled search plans kept per worker, by normalized query
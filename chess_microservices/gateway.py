@@ -1,16 +1,31 @@
-from flask import Flask
+from flask import Flask, jsonify
 from flask_cors import CORS
 from microservices.search_service import search_blueprint
 from microservices.filter_service import filter_blueprint
 from microservices.recommendation_service import recommendation_blueprint
 from microservices.recommendation_ml_service import recommendation_ml_blueprint
+from microservices.recommendation_position_service import recommendation_position_blueprint
+from microservices.position_service import position_blueprint
 from microservices.image_service import image_blueprint
 from microservices.initial_load_service import initial_load_blueprint
 from microservices.filter_rdf_service import filter_rdf_blueprint
 from microservices.filter_ml_service import filter_ml_blueprint
+from config import SPARQL_BACKEND
+from utils.query_cache import cache_stats
+from utils.response_utils import TOTAL_COUNT_HEADER, NEXT_CURSOR_HEADER, conditional_request, compress_response
+from utils.local_store import get_local_store
+from utils.puzzle_index import get_puzzle_index
+
+# Load the embedded store and the puzzle index before serving instead of during the first request
+if SPARQL_BACKEND == "local":
+    get_local_store().warm_up()
+get_puzzle_index()
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=[TOTAL_COUNT_HEADER, NEXT_CURSOR_HEADER])
+# ETags / 304 and compression of the JSON responses, see utils/http_cache.py
+app.before_request(conditional_request)
+app.after_request(compress_response)
 
 # Register Blueprints
 app.register_blueprint(search_blueprint, url_prefix="/")
@@ -19,8 +34,17 @@ app.register_blueprint(filter_rdf_blueprint, url_prefix="/filter")
 app.register_blueprint(filter_ml_blueprint, url_prefix="/filter")
 app.register_blueprint(recommendation_blueprint, url_prefix="/")
 app.register_blueprint(recommendation_ml_blueprint, url_prefix="/")
+app.register_blueprint(recommendation_position_blueprint, url_prefix="/")
+app.register_blueprint(position_blueprint, url_prefix="/")
 app.register_blueprint(image_blueprint, url_prefix="/images")
 app.register_blueprint(initial_load_blueprint, url_prefix="/")
 
+@app.route("/cache/stats", methods=["GET"])
+def get_cache_stats():
+    """
+    Hit/miss counters of the SPARQL result cache.
+    """
+    return jsonify(cache_stats())
+
 if __name__ == "__main__":
     app.run(debug=True, host="0.0.0.0", port=5000)
@@ -4,9 +4,12 @@ from tensorflow.keras.models import load_model # type: ignore
 import numpy as np
 import cv2
 import os
-from utils.graphdb_utils import query_graphdb, extract_filename
+from itertools import islice
+from utils.graphdb_utils import query_graphdb_chunks, extract_filename
+from utils.query_cache import LRUCache
+from utils.sparql_templates import render, values_block, chunk_puzzle_ids
 import tensorflow as tf
-from config import BASE_URL
+from config import BASE_URL, ML_PREDICTION_BATCH, ML_PREDICTION_CACHE_SIZE
 
 filter_ml_blueprint = Blueprint("filter_game_state_ml", __name__)
 
@@ -15,6 +18,11 @@ temp_path = os.path.dirname(temp_path)
 temp_path = os.path.join(temp_path, "app", "model", "chess_phase_model.h5")
 model = load_model(temp_path)
 
+PHASE_LABELS = {0: "opening", 1: "midgame", 2: "endgame"}
+
+# An image never changes under its name, so its prediction does not expire
+_predictions = LRUCache(max_entries=ML_PREDICTION_CACHE_SIZE, ttl=float("inf"))
+
 # Preprocess image function
 def preprocess_image(image_path):
     IMG_SIZE = 128
@@ -32,68 +40,71 @@ def preprocess_image(image_path):
 
     return image
 
-# Predict game state using the model
-def predict_game_state(image_path):
-    image = preprocess_image(image_path)
-    predictions = model.predict(image)
+def image_path(filename):
+    temp_path = os.path.dirname(os.path.dirname(__file__))
+    temp_path = os.path.dirname(temp_path)
+    return f"{temp_path}/dataset/test/{filename}"
 
-    phase_labels = {0: "opening", 1: "midgame", 2: "endgame"}
-    predicted_index = np.argmax(predictions[0])
-    return phase_labels[predicted_index]
-
-@filter_ml_blueprint.route("/game-state-ml", methods=["POST"])
-def filter_game_state_ml():
+def predict_game_states(filenames):
     """
-    1. Retrieve candidate puzzles using SPARQL.
-    2. Pass each candidate image to the ML model.
-    3. If the prediction matches one of the game_states, return the puzzle.
+    {filename: predicted game state} for the given images. Images classified before are
+    answered from the prediction cache, the others go through the model
+    ML_PREDICTION_BATCH at a time. Images that cannot be read are left out.
     """
-    data = request.json
-    puzzle_ids = data.get("puzzle_ids", [])
-    game_states = data.get("game_state", [])  # Example: ["opening", "midgame", "endgame"]
-
-    if not puzzle_ids:
-        return jsonify({"error": "No puzzle_ids provided for ML-based filtering"}), 400
-
-    # --------------- 1) Retrieve Candidates with SPARQL ---------------
-    sparql_query = """
-    PREFIX chess: <http://imaginealpacas.org/chess/>
-    PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
-
-    SELECT 
-      ?image ?puzzle_id ?next_player
-      ?white_kings ?white_queens ?white_rooks ?white_bishops ?white_knights ?white_pawns
-      ?black_kings ?black_queens ?black_rooks ?black_bishops ?black_knights ?black_pawns
-    WHERE {
-      ?image chess:puzzle_id ?puzzle_id .
-      ?image chess:next_player ?next_player .
-      ?image chess:white_pieces ?white_pieces .
-      ?image chess:black_pieces ?black_pieces .
-
-      OPTIONAL { ?white_pieces chess:white_pieces_kings ?white_kings . }
-      OPTIONAL { ?white_pieces chess:white_pieces_queens ?white_queens . }
-      OPTIONAL { ?white_pieces chess:white_pieces_rooks ?white_rooks . }
-      OPTIONAL { ?white_pieces chess:white_pieces_bishops ?white_bishops . }
-      OPTIONAL { ?white_pieces chess:white_pieces_knights ?white_knights . }
-      OPTIONAL { ?white_pieces chess:white_pieces_pawns ?white_pawns . }
-
-      OPTIONAL { ?black_pieces chess:black_pieces_kings ?black_kings . }
-      OPTIONAL { ?black_pieces chess:black_pieces_queens ?black_queens . }
-      OPTIONAL { ?black_pieces chess:black_pieces_rooks ?black_rooks . }
-      OPTIONAL { ?black_pieces chess:black_pieces_bishops ?black_bishops . }
-      OPTIONAL { ?black_pieces chess:black_pieces_knights ?black_knights . }
-      OPTIONAL { ?black_pieces chess:black_pieces_pawns ?black_pawns . }
+    states = {}
+    missing = []
+    for filename in dict.fromkeys(filenames):
+        state = _predictions.get(filename)
+        if state is None:
+            missing.append(filename)
+        else:
+            states[filename] = state
+
+    for start in range(0, len(missing), ML_PREDICTION_BATCH):
+        batch, images = [], []
+        for filename in missing[start:start + ML_PREDICTION_BATCH]:
+            try:
+                images.append(preprocess_image(image_path(filename)))
+                batch.append(filename)
+            except Exception as e:
+                print(f"Error processing image {filename}: {e}")
+        if not images:
+            continue
+        predictions = model.predict(np.concatenate(images))
+        for filename, prediction in zip(batch, predictions):
+            states[filename] = PHASE_LABELS[int(np.argmax(prediction))]
+            _predictions.set(filename, states[filename])
+    return states
+
+def predicted_rows(bindings, game_states):
     """
-    puzzle_id_list = ", ".join(map(str, puzzle_ids))
-    sparql_query += f"\nFILTER (?puzzle_id IN ({puzzle_id_list}))"
-    sparql_query += "\n}"
-    # sparql_query += "\n}LIMIT 100"
-
+    Lazily keeps the bindings whose image the model puts in one of game_states, adding
+    the prediction as computed_state like the game_state query does. Bindings are
+    classified ML_PREDICTION_BATCH at a time, so a page stops the model early.
+    """
+    rows = iter(bindings)
     try:
-        sparql_results = query_graphdb(sparql_query)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        while batch := list(islice(rows, ML_PREDICTION_BATCH)):
+            predicted = predict_game_states([extract_filename(binding["image"]["value"]) for binding in batch])
+            for binding in batch:
+                state = predicted.get(extract_filename(binding["image"]["value"]))
+                if state in game_states:
+                    yield {**binding, "computed_state": {"type": "literal", "value": state}}
+    finally:
+        # Ends the streamed query once the page is full
+        if hasattr(rows, "close"):
+            rows.close()
+
+def build_candidate_queries(puzzle_ids):
+    """
+    Builds the SPARQL queries retrieving the candidate puzzles for ML classification, one per chunk of puzzle ids.
+    """
+    return [render("ml_candidates", puzzle_values=values_block("puzzle_id", chunk)) for chunk in chunk_puzzle_ids(puzzle_ids)]
 
+def format_candidates(sparql_results):
+    """
+    Turns the candidate bindings into puzzle objects awaiting a predicted game state.
+    """
     candidates = []
     for binding in sparql_results["results"]["bindings"]:
         candidates.append({
@@ -110,25 +121,48 @@ def filter_game_state_ml():
                   "encodingFormat": "image/png",
                 }
             })
+    return candidates
 
+def classify_candidates(candidates, game_states):
+    """
+    Runs the ML model on each candidate image and keeps those whose predicted phase is requested.
+    """
     print(f"Found {len(candidates)} candidates for ML-based filtering")
-    # --------------- 2) Pass Images to ML Model ---------------
+    predicted = predict_game_states([candidate["filename"] for candidate in candidates])
     filtered_puzzles = []
     for candidate in candidates:
-        try:
-            temp_path = os.path.dirname(os.path.dirname(__file__))
-            temp_path = os.path.dirname(temp_path)
-            image_path = f"{temp_path}/dataset/test/{candidate["filename"]}"
-            # response = requests.get(image_path, stream=True)
-            # if not os.path.exists(image_path):
-            #     print(f"Image not found: {image_path}")
-            #     continue
-
-            predicted_phase = predict_game_state(image_path)
-            if predicted_phase in game_states:
-                candidate["game_state"] = predicted_phase
-                filtered_puzzles.append(candidate)
-        except Exception as e:
-            print(f"Error processing image {candidate['filename']}: {e}")
-
-    return jsonify(filtered_puzzles)
\ No newline at end of file
+        predicted_phase = predicted.get(candidate["filename"])
+        if predicted_phase in game_states:
+            candidate["game_state"] = predicted_phase
+            filtered_puzzles.append(candidate)
+    return filtered_puzzles
+
+@filter_ml_blueprint.route("/game-state-ml", methods=["POST"])
+def filter_game_state_ml():
+    """
+    1. Retrieve candidate puzzles using SPARQL.
+    2. Pass each candidate image to the ML model.
+    3. If the prediction matches one of the game_states, return the puzzle.
+    """
+    data = request.json
+    puzzle_ids = data.get("puzzle_ids", [])
+    game_states = data.get("game_state", [])  # Example: ["opening", "midgame", "endgame"]
+
+    if not puzzle_ids:
+        return jsonify({"error": "No puzzle_ids provided for ML-based filtering"}), 400
+
+    # --------------- 1) Retrieve Candidates with SPARQL ---------------
+    try:
+        sparql_queries = build_candidate_queries(puzzle_ids)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        sparql_results = query_graphdb_chunks(sparql_queries)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    candidates = format_candidates(sparql_results)
+
+    # --------------- 2) Pass Images to ML Model ---------------
+    return jsonify(classify_candidates(candidates, game_states))
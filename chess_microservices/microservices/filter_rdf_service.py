@@ -1,9 +1,75 @@
 from flask import request, jsonify, Blueprint
 from config import BASE_URL
-from utils.graphdb_utils import query_graphdb, extract_filename
+from utils.graphdb_utils import query_graphdb_rows_chunks, extract_filename
+from utils.response_utils import format_rows, stream_results, parse_page, page_rows, TOTAL_COUNT_HEADER
+from utils.puzzle_index import get_puzzle_index
+from utils.projection import parse_projection
+from utils.sparql_templates import (
+    render,
+    values_block,
+    chunk_puzzle_ids,
+    string_list,
+    after_condition,
+    limit_clause,
+    NO_MATCH,
+)
+from utils.fen import GAME_STATES
 
 filter_rdf_blueprint = Blueprint("filter_game_state_rdf", __name__)
 
+# Fields of the puzzle objects returned by the game-state filters, see utils.projection
+GAME_STATE_FIELDS = ("index", "filename", "puzzle_id", "next_player", "game_state", "metadata")
+
+def game_state_condition(game_states):
+    """
+    FILTER keeping the puzzles in one of game_states, none when empty.
+    Raises ValueError for unknown game states.
+    """
+    if not game_states:
+        return ""
+    return f"FILTER (?computed_state IN ({string_list(game_states, GAME_STATES)}))"
+
+def build_game_state_queries(puzzle_ids, game_states, after=None, limit=None, variables=None):
+    """
+    Builds the SPARQL queries classifying each puzzle as opening/midgame/endgame, one per chunk of puzzle ids,
+    optionally for the page of limit results following the puzzle_id after and selecting only the given variables.
+    Raises ValueError for malformed puzzle ids or unknown game states.
+    """
+    conditions = game_state_condition(game_states)
+
+    chunks = chunk_puzzle_ids(puzzle_ids, after)
+    if not chunks:
+        # Every id precedes the page cursor
+        return [render("game_state", puzzle_values="", conditions=NO_MATCH)]
+    return [
+        render("game_state", puzzle_values=values_block("puzzle_id", chunk), conditions=conditions,
+               after=after_condition(after), limit=limit_clause(limit), variables=variables)
+        for chunk in chunks
+    ]
+
+def format_game_state_row(binding, index):
+    """
+    Turns one game-state binding into the puzzle object returned by /filter/game-state-rdf.
+    """
+    return {
+        "index": index,
+        "filename": extract_filename(binding["image"]["value"]),
+        "puzzle_id": binding.get("puzzle_id", {}).get("value", ""),
+        "next_player": binding.get("next_player", {}).get("value", ""),
+        "game_state": binding.get("computed_state", {}).get("value", "unknown"),
+        "metadata": {  # RDF-Compatible metadata
+          "@context": "http://schema.org/",
+          "@type": "ImageObject",
+          "identifier": binding.get("puzzle_id", {}).get("value", ""),
+          "name": f"Chess Puzzle {binding.get("puzzle_id", {}).get("value", "")}",
+          "contentUrl": f"{BASE_URL}/images/{extract_filename(binding["image"]["value"])}",
+          "encodingFormat": "image/png",
+        }
+    }
+
+def format_game_state_results(results):
+    return [format_game_state_row(binding, index) for index, binding in enumerate(results["results"]["bindings"], 1)]
+
 @filter_rdf_blueprint.route("/game-state-rdf", methods=["POST"])
 def filter_game_state_rdf():
     """
@@ -19,96 +85,25 @@ def filter_game_state_rdf():
     if not puzzle_ids:
         return jsonify({"error": "No puzzle_ids provided for game-state filtering"}), 400
 
-    sparql_query = """
-    PREFIX chess: <http://imaginealpacas.org/chess/>
-    PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
-
-    SELECT 
-      ?image ?puzzle_id ?next_player
-      ?white_kings ?white_queens ?white_rooks ?white_bishops ?white_knights ?white_pawns
-      ?black_kings ?black_queens ?black_rooks ?black_bishops ?black_knights ?black_pawns
-      ?total_pieces 
-      ?computed_state
-    WHERE {
-      ?image chess:puzzle_id ?puzzle_id .
-      ?image chess:next_player ?next_player .
-      ?image chess:white_pieces ?white_pieces .
-      ?image chess:black_pieces ?black_pieces .
-
-      OPTIONAL { ?white_pieces chess:white_pieces_kings ?white_kings . }
-      OPTIONAL { ?white_pieces chess:white_pieces_queens ?white_queens . }
-      OPTIONAL { ?white_pieces chess:white_pieces_rooks ?white_rooks . }
-      OPTIONAL { ?white_pieces chess:white_pieces_bishops ?white_bishops . }
-      OPTIONAL { ?white_pieces chess:white_pieces_knights ?white_knights . }
-      OPTIONAL { ?white_pieces chess:white_pieces_pawns ?white_pawns . }
-
-      OPTIONAL { ?black_pieces chess:black_pieces_kings ?black_kings . }
-      OPTIONAL { ?black_pieces chess:black_pieces_queens ?black_queens . }
-      OPTIONAL { ?black_pieces chess:black_pieces_rooks ?black_rooks . }
-      OPTIONAL { ?black_pieces chess:black_pieces_bishops ?black_bishops . }
-      OPTIONAL { ?black_pieces chess:black_pieces_knights ?black_knights . }
-      OPTIONAL { ?black_pieces chess:black_pieces_pawns ?black_pawns . }
-
-      BIND(
-        (
-          COALESCE(xsd:integer(?white_kings), 0) +
-          COALESCE(xsd:integer(?white_queens), 0) +
-          COALESCE(xsd:integer(?white_rooks), 0) +
-          COALESCE(xsd:integer(?white_bishops), 0) +
-          COALESCE(xsd:integer(?white_knights), 0) +
-          COALESCE(xsd:integer(?white_pawns), 0) +
-          COALESCE(xsd:integer(?black_kings), 0) +
-          COALESCE(xsd:integer(?black_queens), 0) +
-          COALESCE(xsd:integer(?black_rooks), 0) +
-          COALESCE(xsd:integer(?black_bishops), 0) +
-          COALESCE(xsd:integer(?black_knights), 0) +
-          COALESCE(xsd:integer(?black_pawns), 0)
-        )
-        AS ?total_pieces
-      )
-
-      BIND(
-        IF(
-          ?total_pieces >= 24,
-          "opening",
-          IF(
-            ?total_pieces >= 14,
-            "midgame",
-            "endgame"
-          )
-        ) AS ?computed_state
-      )
-    """
-
-    puzzle_id_list = ", ".join(map(str, puzzle_ids))
-    sparql_query += f"\nFILTER (?puzzle_id IN ({puzzle_id_list})) "
-
-    if game_states:
-        states_str = ", ".join(f"\"{s}\"" for s in game_states)
-        sparql_query += f"\nFILTER(?computed_state IN ({states_str}))"
-
-    sparql_query += "\n} ORDER BY ASC(xsd:integer(?puzzle_id))"
+    headers = {}
+    index = get_puzzle_index()
+    try:
+        after, limit = parse_page(data.get("after"), data.get("limit"))
+        projection = parse_projection(data.get("fields"), data.get("format"), GAME_STATE_FIELDS)
+        if index is not None:
+            # Answered from the in-memory puzzle index, no SPARQL involved
+            bits = index.filter_game_state_bits(puzzle_ids, game_states)
+            rows = index.rows(bits, with_game_state=True, after=after, limit=limit, variables=projection.variables)
+            headers[TOTAL_COUNT_HEADER] = str(index.count(bits))
+        else:
+            sparql_queries = build_game_state_queries(puzzle_ids, game_states, after, limit, projection.variables)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
     try:
-        results = query_graphdb(sparql_query)
-        final_puzzles = []
-        for index, binding in enumerate(results["results"]["bindings"]):
-            final_puzzles.append({
-                "index": index + 1,
-                "filename": extract_filename(binding["image"]["value"]),
-                "puzzle_id": binding.get("puzzle_id", {}).get("value", ""),
-                "next_player": binding.get("next_player", {}).get("value", ""),
-                "game_state": binding.get("computed_state", {}).get("value", "unknown"),
-                "metadata": {  # RDF-Compatible metadata
-                  "@context": "http://schema.org/",
-                  "@type": "ImageObject",
-                  "identifier": binding.get("puzzle_id", {}).get("value", ""),
-                  "name": f"Chess Puzzle {binding.get("puzzle_id", {}).get("value", "")}",
-                  "contentUrl": f"{BASE_URL}/images/{extract_filename(binding["image"]["value"])}",
-                  "encodingFormat": "image/png",
-                }
-            })
-        return jsonify(final_puzzles)
+        if index is None:
+            rows = query_graphdb_rows_chunks(sparql_queries)
+        rows, page_headers = page_rows(rows, limit)
+        return stream_results(format_rows(rows, format_game_state_row), {**headers, **page_headers}, projection)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    
\ No newline at end of file
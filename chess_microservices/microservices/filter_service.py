@@ -1,16 +1,132 @@
+from itertools import islice
+from urllib.parse import urlparse
 from flask import request, jsonify, Blueprint
 from config import BASE_URL
-from utils.graphdb_utils import query_graphdb, extract_filename
-import requests
+from utils.graphdb_utils import query_graphdb_rows_chunks, extract_filename
+from utils.response_utils import format_rows, stream_results, parse_page, page_rows, TOTAL_COUNT_HEADER
+from utils.puzzle_index import get_puzzle_index
+from utils.projection import parse_projection
+from utils.sparql_templates import (
+    render,
+    values_block,
+    chunk_puzzle_ids,
+    to_move_count,
+    piece_filter_terms,
+    check_values,
+    after_condition,
+    limit_clause,
+    NO_MATCH,
+)
+from utils.fen import GAME_STATES
+from microservices.filter_rdf_service import game_state_condition, format_game_state_row, GAME_STATE_FIELDS
+from microservices.filter_ml_service import predicted_rows
 
 filter_blueprint = Blueprint("filter", __name__)
 
+# Fields of the puzzle objects returned by /filter without game states, see utils.projection
+PIECE_FILTER_FIELDS = ("index", "filename", "puzzle_id", "next_player", "white_pieces", "black_pieces", "metadata")
+
+def game_state_classifier(endpoint):
+    """
+    Game-state classifier a /filter request picks with game_state_filter_endpoint: "ml"
+    when it names /filter/game-state-ml, "rdf" otherwise. The endpoint is not called,
+    both classifiers run within the /filter request.
+    """
+    return "ml" if urlparse(endpoint or "").path.rstrip("/").endswith("/game-state-ml") else "rdf"
+
+def piece_conditions(filters):
+    """
+    SPARQL conditions of the piece filters; 'game_state' entries are ignored.
+    """
+    piece_conditions = []
+    for piece, counts in piece_filter_terms(filters):
+        if piece is None:
+            # Unknown pieces never match, as before
+            piece_conditions.append(NO_MATCH)
+            continue
+
+        pattern, to_move = to_move_count(piece)
+        subconds = [f"{to_move} {operator} {count}" for operator, count in counts]
+        piece_conditions.append(f"{pattern} FILTER ({' || '.join(subconds)})")
+    return "\n".join(piece_conditions)
+
+def build_piece_filter_queries(filters, puzzle_ids, after=None, limit=None, variables=None):
+    """
+    Builds the piece-only SPARQL queries, one per chunk of puzzle ids; 'game_state' entries in filters are ignored.
+    after and limit select the page of limit results following the puzzle_id after, variables
+    the variables to select (all of them when None).
+    Raises ValueError for malformed puzzle ids or filter values.
+    """
+    return render_chunks("filter_pieces", piece_conditions(filters), puzzle_ids, after, limit, variables)
+
+def build_filter_queries(filters, puzzle_ids, game_states=None, after=None, limit=None, variables=None):
+    """
+    Compiles a /filter request into one SPARQL query per chunk of puzzle ids: the piece
+    filters alone, or with game_states the piece and game-state filters together on the
+    game_state template, which binds the piece counts and the stored game state at once.
+    Raises ValueError for malformed puzzle ids, filter values or game states.
+    """
+    if not game_states:
+        return build_piece_filter_queries(filters, puzzle_ids, after, limit, variables)
+    conditions = piece_conditions(filters) + "\n" + game_state_condition(game_states)
+    return render_chunks("game_state", conditions, puzzle_ids, after, limit, variables)
+
+def render_chunks(template, conditions, puzzle_ids, after, limit, variables=None):
+    chunks = chunk_puzzle_ids(puzzle_ids, after)
+    if not chunks:
+        # Every id precedes the page cursor
+        return [render(template, puzzle_values="", conditions=NO_MATCH)]
+    return [
+        render(template, puzzle_values=values_block("puzzle_id", chunk), conditions=conditions,
+               after=after_condition(after), limit=limit_clause(limit), variables=variables)
+        for chunk in chunks
+    ]
+
+def format_piece_filter_row(binding, index):
+    """
+    Turns one piece filter binding into the puzzle object returned by /filter.
+    """
+    return {
+        "index": index,
+        "filename": extract_filename(binding["image"]["value"]),
+        "puzzle_id": binding.get("puzzle_id", {}).get("value", "N/A"),
+        "next_player": binding.get("next_player", {}).get("value", ""),
+        "white_pieces": {
+            "kings": binding.get("white_kings", {}).get("value", "0"),
+            "queens": binding.get("white_queens", {}).get("value", "0"),
+            "rooks": binding.get("white_rooks", {}).get("value", "0"),
+            "bishops": binding.get("white_bishops", {}).get("value", "0"),
+            "knights": binding.get("white_knights", {}).get("value", "0"),
+            "pawns": binding.get("white_pawns", {}).get("value", "0"),
+        },
+        "black_pieces": {
+            "kings": binding.get("black_kings", {}).get("value", "0"),
+            "queens": binding.get("black_queens", {}).get("value", "0"),
+            "rooks": binding.get("black_rooks", {}).get("value", "0"),
+            "bishops": binding.get("black_bishops", {}).get("value", "0"),
+            "knights": binding.get("black_knights", {}).get("value", "0"),
+            "pawns": binding.get("black_pawns", {}).get("value", "0"),
+        },
+        "metadata": {  # RDF-Compatible metadata
+            "@context": "http://schema.org/",
+            "@type": "ImageObject",
+            "identifier": binding.get("puzzle_id", {}).get("value", "N/A"),
+            "name": f"Chess Puzzle {binding.get("puzzle_id", {}).get("value", "N/A")}",
+            "contentUrl": f"{BASE_URL}/images/{extract_filename(binding["image"]["value"])}",
+            "encodingFormat": "image/png",
+        }
+    }
+
+def format_piece_filter_results(piece_results):
+    return [format_piece_filter_row(binding, index) for index, binding in enumerate(piece_results["results"]["bindings"], 1)]
+
 @filter_blueprint.route("/filter", methods=["POST"])
 def filter():
     """
-    1) Piece-based filter.
-    2) If 'game_state' in filters, internally call '/filter/game-state-rdf' 
-       with the puzzle_ids returned from the piece filter.
+    Piece-based filter, and game-state filter when filters has 'game_state': the stored
+    game state in the same query, or the ML prediction of each image when
+    game_state_filter_endpoint names /filter/game-state-ml.
+    Optional after / limit select a page, the next cursor being sent in X-Next-Cursor.
     """
     data = request.json
     filters = data.get("filters", {})
@@ -19,144 +135,47 @@ def filter():
 
     if not puzzle_ids:
         return jsonify({"error": "puzzle_ids are required"}), 400
-
-    # Extract game_state if present, but do NOT remove it from 'filters' yet.
-    # We'll remove it after piece filtering if we still need it.
-    game_state_filters = filters.get("game_state")
-
-    # --------------- 1) Do the piece-based filter ---------------
-    # Build your piece-only SPARQL:
-    sparql_query = """
-    PREFIX chess: <http://imaginealpacas.org/chess/>
-    PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
-    SELECT ?image ?puzzle_id ?next_player
-           ?white_kings ?white_queens ?white_rooks ?white_bishops ?white_knights ?white_pawns
-           ?black_kings ?black_queens ?black_rooks ?black_bishops ?black_knights ?black_pawns
-    WHERE {
-      ?image chess:puzzle_id ?puzzle_id .
-      ?image chess:next_player ?next_player .
-      ?image chess:white_pieces ?white_pieces .
-      ?image chess:black_pieces ?black_pieces .
-
-      OPTIONAL { ?white_pieces chess:white_pieces_kings ?white_kings . }
-      OPTIONAL { ?white_pieces chess:white_pieces_queens ?white_queens . }
-      OPTIONAL { ?white_pieces chess:white_pieces_rooks ?white_rooks . }
-      OPTIONAL { ?white_pieces chess:white_pieces_bishops ?white_bishops . }
-      OPTIONAL { ?white_pieces chess:white_pieces_knights ?white_knights . }
-      OPTIONAL { ?white_pieces chess:white_pieces_pawns ?white_pawns . }
-
-      OPTIONAL { ?black_pieces chess:black_pieces_kings ?black_kings . }
-      OPTIONAL { ?black_pieces chess:black_pieces_queens ?black_queens . }
-      OPTIONAL { ?black_pieces chess:black_pieces_rooks ?black_rooks . }
-      OPTIONAL { ?black_pieces chess:black_pieces_bishops ?black_bishops . }
-      OPTIONAL { ?black_pieces chess:black_pieces_knights ?black_knights . }
-      OPTIONAL { ?black_pieces chess:black_pieces_pawns ?black_pawns . }
-    """
-
-    # Limit puzzle_ids
-    puzzle_id_list = ", ".join(map(str, puzzle_ids))
-    sparql_query += f"\nFILTER (?puzzle_id IN ({puzzle_id_list})) "
-
-    # Build piece conditions
-    piece_conditions = []
-    # We "pop" the game_state from 'filters' so it doesn't break piece logic:
-    piece_filters = dict(filters)  # shallow copy
-    piece_filters.pop("game_state", None)  # remove game_state if present
-
-    for piece, values in piece_filters.items():
-        if values:
-            subconds = []
-            for v in values:
-                if v == "3+":
-                    subconds.append(
-                        f"((?next_player = \"white\" && ?white_{piece} >= 3) "
-                        f"|| (?next_player = \"black\" && ?black_{piece} >= 3))"
-                    )
-                elif v == "2+":
-                    subconds.append(
-                        f"((?next_player = \"white\" && ?white_{piece} >= 2) "
-                        f"|| (?next_player = \"black\" && ?black_{piece} >= 2))"
-                    )
-                elif v == "9+":
-                    subconds.append(
-                        f"((?next_player = \"white\" && ?white_{piece} >= 9) "
-                        f"|| (?next_player = \"black\" && ?black_{piece} >= 9))"
-                    )
-                else:
-                    # numeric
-                    subconds.append(
-                        f"((?next_player = \"white\" && ?white_{piece} = {v}) "
-                        f"|| (?next_player = \"black\" && ?black_{piece} = {v}))"
-                    )
-            piece_conditions.append(f"FILTER ({' || '.join(subconds)})")
-
-    if piece_conditions:
-        sparql_query += "\n" + "\n".join(piece_conditions)
-
-    sparql_query += "\n} ORDER BY ASC(xsd:integer(?puzzle_id))"
-
-    # Run the piece-based filter
     try:
-        piece_results = query_graphdb(sparql_query)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        after, limit = parse_page(data.get("after"), data.get("limit"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    # Parse those results
-    piece_filtered_puzzles = []
-    for index, binding in enumerate(piece_results["results"]["bindings"]):
-        piece_filtered_puzzles.append({
-            "index": index + 1,
-            "filename": extract_filename(binding["image"]["value"]),
-            "puzzle_id": binding.get("puzzle_id", {}).get("value", "N/A"),
-            "next_player": binding.get("next_player", {}).get("value", ""),
-            "white_pieces": {
-                "kings": binding.get("white_kings", {}).get("value", "0"),
-                "queens": binding.get("white_queens", {}).get("value", "0"),
-                "rooks": binding.get("white_rooks", {}).get("value", "0"),
-                "bishops": binding.get("white_bishops", {}).get("value", "0"),
-                "knights": binding.get("white_knights", {}).get("value", "0"),
-                "pawns": binding.get("white_pawns", {}).get("value", "0"),
-            },
-            "black_pieces": {
-                "kings": binding.get("black_kings", {}).get("value", "0"),
-                "queens": binding.get("black_queens", {}).get("value", "0"),
-                "rooks": binding.get("black_rooks", {}).get("value", "0"),
-                "bishops": binding.get("black_bishops", {}).get("value", "0"),
-                "knights": binding.get("black_knights", {}).get("value", "0"),
-                "pawns": binding.get("black_pawns", {}).get("value", "0"),
-            },
-            "metadata": {  # RDF-Compatible metadata
-                "@context": "http://schema.org/",
-                "@type": "ImageObject",
-                "identifier": binding.get("puzzle_id", {}).get("value", "N/A"),
-                "name": f"Chess Puzzle {binding.get("puzzle_id", {}).get("value", "N/A")}",
-                "contentUrl": f"{BASE_URL}/images/{extract_filename(binding["image"]["value"])}",
-                "encodingFormat": "image/png",
-            }
-        })
+    game_states = filters.get("game_state")
+    classifier = game_state_classifier(game_state_filter_endpoint) if game_states else None
+    # Predictions are made on the query results, so the page is cut after them
+    query_limit = None if classifier == "ml" else limit
 
-    # If the user did NOT request game_state filtering, just return these
-    if not game_state_filters:
-        return jsonify(piece_filtered_puzzles)
-
-    # --------------- 2) If user wants game_state, call /filter/game-state-rdf ---------------
-    # Gather puzzle_ids from the piece filter
-    puzzle_ids_second = [p["puzzle_id"] for p in piece_filtered_puzzles if p["puzzle_id"] != "N/A"]
-    # If no puzzles remain, we can return empty
-    if not puzzle_ids_second:
-        return jsonify([])
+    headers = {}
+    index = get_puzzle_index()
+    try:
+        projection = parse_projection(data.get("fields"), data.get("format"),
+                                      PIECE_FILTER_FIELDS if classifier is None else GAME_STATE_FIELDS)
+        if classifier == "ml":
+            check_values(game_states, GAME_STATES)
+        if index is not None:
+            # Answered from the in-memory puzzle index, no SPARQL involved
+            bits = index.filter_pieces_bits(filters, puzzle_ids)
+            if classifier == "rdf":
+                bits &= index.game_state_bits(game_states)
+            rows = index.rows(bits, with_game_state=classifier == "rdf", after=after, limit=query_limit,
+                              variables=projection.variables)
+            if classifier != "ml":
+                headers[TOTAL_COUNT_HEADER] = str(index.count(bits))
+        else:
+            sparql_queries = build_filter_queries(filters, puzzle_ids, game_states if classifier == "rdf" else None,
+                                                  after, query_limit, projection.variables)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    # We'll call our second endpoint using requests
-    second_payload = {
-        "puzzle_ids": puzzle_ids_second,
-        "game_state": game_state_filters
-    }
     try:
-        # Assume your Flask server is running locally; adjust host/port as needed
-        second_resp = requests.post(game_state_filter_endpoint, json=second_payload)
-        second_resp.raise_for_status()
-        final_data = second_resp.json()
-        return jsonify(final_data)
+        if index is None:
+            rows = query_graphdb_rows_chunks(sparql_queries)
+        if classifier == "ml":
+            rows = predicted_rows(rows, game_states)
+            if limit is not None:
+                rows = islice(rows, limit + 1)
+        rows, page_headers = page_rows(rows, limit)
+        format_row = format_piece_filter_row if classifier is None else format_game_state_row
+        return stream_results(format_rows(rows, format_row), {**headers, **page_headers}, projection)
     except Exception as e:
-        return jsonify({"error": f"Error calling /filter/game-state-rdf: {e}"}), 500
-    
\ No newline at end of file
+        return jsonify({"error": str(e)}), 500
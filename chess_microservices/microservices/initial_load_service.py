@@ -1,46 +1,53 @@
-from flask import jsonify, Blueprint
+from flask import request, jsonify, Blueprint
 from config import BASE_URL
-from utils.graphdb_utils import query_graphdb, extract_filename
+from utils.graphdb_utils import query_graphdb_rows, extract_filename
+from utils.response_utils import format_rows, stream_results, parse_page, page_rows
+from utils.sparql_templates import render, after_condition, limit_clause
 
 initial_load_blueprint = Blueprint("initial", __name__)
 
-@initial_load_blueprint.route("/initial", methods=["GET"])
-def get_initial_images():
+def build_initial_query(after=None, limit=None):
     """
-    Fetches the first 3 chess puzzles from the RDF dataset with puzzle ID.
+    Builds the SPARQL query listing every puzzle with its image, or the page of limit
+    puzzles following the puzzle_id after.
     """
-    sparql_query = """
-    PREFIX chess: <http://imaginealpacas.org/chess/>
-    PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
-    SELECT ?image ?puzzle_id
-    WHERE {
-        ?image chess:puzzle_id ?puzzle_id .
-    }
-    ORDER BY ASC(xsd:integer(?puzzle_id))
-    # LIMIT 6
+    return render("initial", after=after_condition(after), limit=limit_clause(limit))
+
+def format_initial_row(binding, index):
     """
+    Turns one SPARQL binding into the puzzle object returned by /initial.
+    """
+    return {
+        "index": index,
+        "filename": extract_filename(binding["image"]["value"]),
+        "puzzle_id": binding.get("puzzle_id", {}).get("value", "N/A"),
+        "metadata": {  # RDF-Compatible metadata
+            "@context": "http://schema.org/",
+            "@type": "ImageObject",
+            "identifier": binding.get("puzzle_id", {}).get("value", "N/A"),
+            "name": f"Initial Chess Puzzle {binding.get("puzzle_id", {}).get("value", "N/A")}",
+            "contentUrl": f"{BASE_URL}/images/{extract_filename(binding["image"]["value"])}",
+            "encodingFormat": "image/png"
+        }
+    }
 
-    try:
-        results = query_graphdb(sparql_query)
+def format_initial_results(results):
+    return [format_initial_row(binding, index) for index, binding in enumerate(results["results"]["bindings"], 1)]
 
-        chess_puzzles = []
-        for index, binding in enumerate(results["results"]["bindings"]):
-            chess_puzzles.append({
-                "index": index + 1,
-                "filename": extract_filename(binding["image"]["value"]),
-                "puzzle_id": binding.get("puzzle_id", {}).get("value", "N/A"),
-                "metadata": {  # RDF-Compatible metadata
-                    "@context": "http://schema.org/",
-                    "@type": "ImageObject",
-                    "identifier": binding.get("puzzle_id", {}).get("value", "N/A"),
-                    "name": f"Initial Chess Puzzle {binding.get("puzzle_id", {}).get("value", "N/A")}",
-                    "contentUrl": f"{BASE_URL}/images/{extract_filename(binding["image"]["value"])}",
-                    "encodingFormat": "image/png"
-                }
-            })
+@initial_load_blueprint.route("/initial", methods=["GET"])
+def get_initial_images():
+    """
+    Fetches the chess puzzles from the RDF dataset with puzzle ID: all of them, or one page
+    when after (cursor) or limit is given, the next cursor being sent in X-Next-Cursor.
+    """
+    try:
+        after, limit = parse_page(request.args.get("after"), request.args.get("limit"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-        return jsonify(chess_puzzles)
+    try:
+        rows, headers = page_rows(query_graphdb_rows(build_initial_query(after, limit)), limit)
+        return stream_results(format_rows(rows, format_initial_row), headers=headers)
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    
\ No newline at end of file
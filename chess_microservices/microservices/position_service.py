@@ -0,0 +1,56 @@
+from flask import Blueprint, request, jsonify
+from config import BASE_URL
+from utils.bitboards import get_bitboard_store
+from utils.fen import parse_fens
+
+position_blueprint = Blueprint("position", __name__)
+
+def parse_position_fen(fen):
+    """
+    Reads the board placement of a /position request: a FEN (only its first field is used,
+    ranks separated by '/') or an image filename (ranks separated by '-').
+    Returns a one-board FenBatch; raises ValueError for a malformed board.
+    """
+    if not isinstance(fen, str) or not fen.strip():
+        raise ValueError("A FEN board placement is required")
+    placement = fen.split()[0].replace("/", "-")
+    return parse_fens([placement])
+
+def lookup_position(boards):
+    """
+    Every ingested puzzle showing exactly the position of the one-board FenBatch, found
+    through the Zobrist hash index of the bitboards. duplicate_of is the puzzle_id of the
+    first image of the position for the duplicates setup_rdf.py linked, None otherwise.
+    """
+    store = get_bitboard_store()
+    rows = store.position_rows(boards)[0]
+    puzzles = []
+    for row in rows.tolist():
+        canonical = int(store.canonical[row])
+        filename = str(store.file_names[row])
+        puzzles.append({
+            "puzzle_id": int(store.puzzle_ids[row]),
+            "filename": filename,
+            "duplicate_of": int(store.puzzle_ids[canonical]) if canonical != row else None,
+            "contentUrl": f"{BASE_URL}/images/{filename}",
+        })
+    return {
+        "zobrist": f"{int(boards.zobrist_hashes()[0]):016x}",
+        "count": len(puzzles),
+        "puzzles": puzzles,
+    }
+
+@position_blueprint.route("/position", methods=["GET"])
+def get_position():
+    """
+    Exact-position lookup: the puzzles whose board is the one given by the fen parameter.
+    """
+    try:
+        boards = parse_position_fen(request.args.get("fen"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        return jsonify(lookup_position(boards))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
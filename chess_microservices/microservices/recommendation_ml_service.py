@@ -1,6 +1,7 @@
 from flask import Blueprint, request, jsonify
 from config import BASE_URL
-from utils.graphdb_utils import query_graphdb, extract_filename
+from utils.graphdb_utils import query_graphdb_chunks, extract_filename
+from utils.sparql_templates import render, values_block, chunk_puzzle_ids
 import os
 import cv2
 import joblib
@@ -23,6 +24,66 @@ def extract_features(image_path):
     hist = cv2.normalize(hist, hist).flatten()
     return hist
 
+def build_image_queries(puzzle_ids):
+    """
+    Builds the SPARQL queries fetching the image URIs (the subject in our RDF triples) of the given puzzle ids,
+    one per chunk of puzzle ids.
+    """
+    return [render("ml_images", puzzle_values=values_block("puzzle_id", chunk)) for chunk in chunk_puzzle_ids(puzzle_ids)]
+
+def recommend_from_results(results):
+    """
+    Averages the colour histograms of the displayed images and returns the nearest training image.
+    Returns a (payload, status) pair.
+    """
+    if "results" not in results or not results["results"]["bindings"]:
+        return {"error": "No image information found for provided puzzle IDs"}, 404
+
+    # Extract filenames from the returned image URIs
+    filenames = []
+    for binding in results["results"]["bindings"]:
+        image_uri = binding["image"]["value"]
+        filename = extract_filename(image_uri)
+        filenames.append(filename)
+
+    if not filenames:
+        return {"error": "No filenames extracted from RDF results"}, 404
+
+    # For each filename, build the full path and extract image features
+    feature_list = []
+    for fname in filenames:
+        image_path = os.path.join(TEST_DIR, fname)
+        if not os.path.exists(image_path):
+            # You might choose to log this instead of returning an error immediately
+            return {"error": f"Image file '{fname}' not found in '{TEST_DIR}'"}, 404
+        features = extract_features(image_path)
+        feature_list.append(features)
+
+    # Compute the average feature vector from all displayed puzzles
+    avg_features = np.mean(np.array(feature_list), axis=0).reshape(1, -1)
+
+    # Use the k-NN model to find the index of the most similar image in the training set
+    distances, indices = knn.kneighbors(avg_features)
+    recommended_img_path = train_image_paths[indices[0][0]]
+    recommended_filename = os.path.basename(recommended_img_path)
+
+    print(f"Recommended Image: {recommended_filename}")
+
+    # Return the recommended filename
+    response = {
+        "dominant_feature": "Unknown",
+        "metadata": {
+            "@context": "http://schema.org/",
+            "@type": "ImageObject",
+            "contentUrl": f"{BASE_URL}/images/{recommended_filename}",
+            "encodingFormat": "image/png",
+            "identifier": "Unknown",
+            "name": f"Chess Puzzle Unknown",
+            "recommendedFeature": "Unknown"
+        }
+    }
+    return [response], 200
+
 recommendation_ml_blueprint = Blueprint("recommendation-ml", __name__)
 
 @recommendation_ml_blueprint.route("/ml-recommendations", methods=["POST"])
@@ -36,72 +97,16 @@ def get_recommendations():
         return jsonify({"error": "'puzzle_ids' must be a non-empty list"}), 400
 
     try:
-        # Construct a comma-separated string of puzzle ids for the SPARQL query.
-        # (Assumes puzzle ids are numeric; if they are strings, add quotes accordingly.)
-        puzzle_id_conditions = ", ".join(str(pid) for pid in puzzle_ids)
-
-        # SPARQL query to fetch the image URIs (the subject in our RDF triples) for the given puzzle ids.
-        sparql_query = f"""
-        PREFIX chess: <http://imaginealpacas.org/chess/>
-        PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
-        SELECT ?image ?puzzle_id
-        WHERE {{
-            ?image chess:puzzle_id ?puzzle_id .
-            FILTER (?puzzle_id IN ({puzzle_id_conditions}))
-        }}
-        """
+        sparql_queries = build_image_queries(puzzle_ids)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
+    try:
         # Query the RDF store
-        results = query_graphdb(sparql_query)
-
-        if "results" not in results or not results["results"]["bindings"]:
-            return jsonify({"error": "No image information found for provided puzzle IDs"}), 404
-
-        # Extract filenames from the returned image URIs
-        filenames = []
-        for binding in results["results"]["bindings"]:
-            image_uri = binding["image"]["value"]
-            filename = extract_filename(image_uri)
-            filenames.append(filename)
-
-        if not filenames:
-            return jsonify({"error": "No filenames extracted from RDF results"}), 404
-
-        # For each filename, build the full path and extract image features
-        feature_list = []
-        for fname in filenames:
-            image_path = os.path.join(TEST_DIR, fname)
-            if not os.path.exists(image_path):
-                # You might choose to log this instead of returning an error immediately
-                return jsonify({"error": f"Image file '{fname}' not found in '{TEST_DIR}'"}), 404
-            features = extract_features(image_path)
-            feature_list.append(features)
-
-        # Compute the average feature vector from all displayed puzzles
-        avg_features = np.mean(np.array(feature_list), axis=0).reshape(1, -1)
-
-        # Use the k-NN model to find the index of the most similar image in the training set
-        distances, indices = knn.kneighbors(avg_features)
-        recommended_img_path = train_image_paths[indices[0][0]]
-        recommended_filename = os.path.basename(recommended_img_path)
-
-        print(f"Recommended Image: {recommended_filename}")
-
-        # Return the recommended filename
-        response = {
-            "dominant_feature": "Unknown",
-            "metadata": {
-                "@context": "http://schema.org/",
-                "@type": "ImageObject",
-                "contentUrl": f"{BASE_URL}/images/{recommended_filename}",
-                "encodingFormat": "image/png",
-                "identifier": "Unknown",
-                "name": f"Chess Puzzle Unknown",
-                "recommendedFeature": "Unknown"
-            }
-        }
-        
-        return jsonify([response]), 200
+        results = query_graphdb_chunks(sparql_queries)
+
+        payload, status = recommend_from_results(results)
+        return jsonify(payload), status
 
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
\ No newline at end of file
+        return jsonify({"error": str(e)}), 500
@@ -0,0 +1,70 @@
+from flask import Blueprint, request, jsonify
+import numpy as np
+from config import POSITION_SIMILARITY_METRIC, POSITION_RECOMMENDATION_MAX_COUNT
+from utils.bitboards import get_bitboard_store, SIMILARITY_METRICS
+from utils.fen import SIDES, PIECES
+from utils.setup_rdf import CHESS_NAMESPACE
+from utils.sparql_templates import puzzle_ids_to_ints, check_values
+from microservices.recommendation_service import RECOMMENDATION_COUNT, format_recommendations
+
+recommendation_position_blueprint = Blueprint("recommendation-position", __name__)
+
+def parse_position_request(data):
+    """
+    Reads (puzzle ids, metric, count) from a /position-recommendations payload.
+    Raises ValueError for malformed input.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Expected a JSON object with puzzle_ids")
+    puzzle_ids = data.get("puzzle_ids", [])
+    if not isinstance(puzzle_ids, list) or not puzzle_ids:
+        raise ValueError("Displayed puzzle IDs are required")
+    metric = data.get("metric", POSITION_SIMILARITY_METRIC)
+    check_values([metric], SIMILARITY_METRICS)
+    count = data.get("count", RECOMMENDATION_COUNT)
+    if isinstance(count, bool) or not isinstance(count, int) or not 1 <= count <= POSITION_RECOMMENDATION_MAX_COUNT:
+        raise ValueError(f"Invalid count {count!r}, expected 1 to {POSITION_RECOMMENDATION_MAX_COUNT}")
+    return puzzle_ids_to_ints(puzzle_ids), metric, count
+
+def recommend_positions(puzzle_ids, metric, count):
+    """
+    Ranks the whole dataset by the bitboard distance of its positions to the displayed ones
+    and returns the closest, formatted like the RDF recommendations plus their distance.
+    Nothing is read from the store or from the images.
+    """
+    store = get_bitboard_store()
+    rows, distances = store.nearest(puzzle_ids, count, metric)
+
+    # Bindings shaped like the SPARQL results, so format_recommendations can be reused
+    counts = np.bitwise_count(store.bitboards[rows]).tolist()
+    candidates = []
+    for row, piece_counts in zip(rows.tolist(), counts):
+        binding = {
+            "puzzle_id": {"value": str(store.puzzle_ids[row])},
+            "image": {"value": CHESS_NAMESPACE + str(store.file_names[row])},
+            "next_player": {"value": SIDES[store.sides[row]]},
+        }
+        for index, (side, piece) in enumerate((side, piece) for side in SIDES for piece in PIECES):
+            binding[f"{side}_{piece}"] = {"value": str(piece_counts[index])}
+        candidates.append(binding)
+
+    recommendations = format_recommendations({"results": {"bindings": candidates}}, f"{metric} position similarity")
+    for recommendation, distance in zip(recommendations, distances.tolist()):
+        recommendation["distance"] = distance
+    return recommendations
+
+@recommendation_position_blueprint.route("/position-recommendations", methods=["POST"])
+def get_recommendations():
+    """
+    Fetches the puzzles whose piece placement is closest to the displayed ones.
+    Expects puzzle_ids, plus an optional metric ("jaccard" or "hamming") and count.
+    """
+    try:
+        puzzle_ids, metric, count = parse_position_request(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        return jsonify(recommend_positions(puzzle_ids, metric, count))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
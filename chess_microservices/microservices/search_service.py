@@ -1,121 +1,100 @@
 from flask import Blueprint, request, jsonify
 from config import BASE_URL
-from utils.graphdb_utils import query_graphdb, extract_filename
+from utils.graphdb_utils import query_graphdb_rows_chunks, extract_filename
+from utils.response_utils import format_rows, stream_results, parse_page, page_rows, TOTAL_COUNT_HEADER
+from utils.puzzle_index import get_puzzle_index
+from utils.search_query import compile_search
+from utils.projection import parse_projection
 
 search_blueprint = Blueprint("search", __name__)
 
+# Fields of the puzzle objects returned by /search, see utils.projection
+SEARCH_FIELDS = (
+    "index", "filename", "puzzle_id", "next_player", "white_pieces", "black_pieces",
+    "castling", "en_passant", "metadata",
+)
+
+def build_search_queries(query, after=None, limit=None, variables=None):
+    """
+    Builds the SPARQL queries for a lower-cased search string such as
+    "2 rooks no queens white_knight:f3", optionally for the page of limit results
+    following the puzzle_id after and selecting only the given variables. The query
+    language is described in utils.search_query; each normalized query is compiled once.
+    """
+    return compile_search(query).sparql_queries(after, limit, variables)
+
+def format_search_row(binding, index):
+    """
+    Turns one SPARQL binding into the puzzle object returned by /search.
+    """
+    return {
+        "index": index,
+        "filename": extract_filename(binding["image"]["value"]),
+        "puzzle_id": binding.get("puzzle_id", {}).get("value", "N/A"),
+        "next_player": binding.get("next_player", {}).get("value", ""),
+        "white_pieces": {
+            "kings": binding.get("white_kings", {}).get("value", "0"),
+            "queens": binding.get("white_queens", {}).get("value", "0"),
+            "rooks": binding.get("white_rooks", {}).get("value", "0"),
+            "bishops": binding.get("white_bishops", {}).get("value", "0"),
+            "knights": binding.get("white_knights", {}).get("value", "0"),
+            "pawns": binding.get("white_pawns", {}).get("value", "0"),
+        },
+        "black_pieces": {
+            "kings": binding.get("black_kings", {}).get("value", "0"),
+            "queens": binding.get("black_queens", {}).get("value", "0"),
+            "rooks": binding.get("black_rooks", {}).get("value", "0"),
+            "bishops": binding.get("black_bishops", {}).get("value", "0"),
+            "knights": binding.get("black_knights", {}).get("value", "0"),
+            "pawns": binding.get("black_pawns", {}).get("value", "0"),
+        },
+        "castling": {
+            "white_kingside": binding.get("white_castling_kingside", {}).get("value", "false"),
+            "white_queenside": binding.get("white_castling_queenside", {}).get("value", "false"),
+            "black_kingside": binding.get("black_castling_kingside", {}).get("value", "false"),
+            "black_queenside": binding.get("black_castling_queenside", {}).get("value", "false"),
+        },
+        "en_passant": {
+            "white": binding.get("en_passant_white", {}).get("value", "false"),
+            "black": binding.get("en_passant_black", {}).get("value", "false"),
+        },
+        "metadata": {  # RDF-Compatible metadata
+            "@context": "http://schema.org/",
+            "@type": "ImageObject",
+            "identifier": binding.get("puzzle_id", {}).get("value", "N/A"),
+            "name": f"Chess Puzzle {binding.get("puzzle_id", {}).get("value", "N/A")}",
+            "contentUrl": f"{BASE_URL}/images/{extract_filename(binding["image"]["value"])}",
+            "encodingFormat": "image/png",
+            "gameFeature": f"{binding.get("next_player", {}).get("value", "")} to move"
+        }
+    }
+
+def format_search_results(results):
+    return [format_search_row(binding, index) for index, binding in enumerate(results["results"]["bindings"], 1)]
+
 @search_blueprint.route("/search", methods=["GET"])
 def search():
     query = request.args.get("query", "").strip().lower()
     if not query:
         return jsonify({"error": "Query parameter is required"}), 400
-
-    query_terms = query.split()  # Split the query into terms like ["rooks", "queen"]
-
-    # Prepare SPARQL conditions for each piece type
-    conditions = []
-    for term in query_terms:
-        is_plural = term.endswith("s")
-        if not is_plural:
-            term = term + "s"
-
-        conditions.append(f"""
-            FILTER (
-                (?next_player = "white" && bound(?white_{term}) && ?white_{term} {"=" if not is_plural else ">"} 1)
-                ||
-                (?next_player = "black" && bound(?black_{term}) && ?black_{term} {"=" if not is_plural else ">"} 1)
-            )
-        """)
-
-    sparql_query = f"""
-    PREFIX chess: <http://imaginealpacas.org/chess/>
-    PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
-    SELECT ?image ?puzzle_id ?next_player ?white_kings ?white_queens ?white_rooks ?white_bishops ?white_knights ?white_pawns
-           ?black_kings ?black_queens ?black_rooks ?black_bishops ?black_knights ?black_pawns
-           ?white_castling_kingside ?white_castling_queenside
-           ?black_castling_kingside ?black_castling_queenside
-           ?en_passant_white ?en_passant_black
-    WHERE {{
-        ?image chess:puzzle_id ?puzzle_id .
-        ?image chess:next_player ?next_player .
-        ?image chess:white_pieces ?white_pieces .
-        ?image chess:black_pieces ?black_pieces .
-
-        OPTIONAL {{ ?white_pieces chess:white_pieces_kings ?white_kings . }}
-        OPTIONAL {{ ?white_pieces chess:white_pieces_queens ?white_queens . }}
-        OPTIONAL {{ ?white_pieces chess:white_pieces_rooks ?white_rooks . }}
-        OPTIONAL {{ ?white_pieces chess:white_pieces_bishops ?white_bishops . }}
-        OPTIONAL {{ ?white_pieces chess:white_pieces_knights ?white_knights . }}
-        OPTIONAL {{ ?white_pieces chess:white_pieces_pawns ?white_pawns . }}
-
-        OPTIONAL {{ ?black_pieces chess:black_pieces_kings ?black_kings . }}
-        OPTIONAL {{ ?black_pieces chess:black_pieces_queens ?black_queens . }}
-        OPTIONAL {{ ?black_pieces chess:black_pieces_rooks ?black_rooks . }}
-        OPTIONAL {{ ?black_pieces chess:black_pieces_bishops ?black_bishops . }}
-        OPTIONAL {{ ?black_pieces chess:black_pieces_knights ?black_knights . }}
-        OPTIONAL {{ ?black_pieces chess:black_pieces_pawns ?black_pawns . }}
-
-        OPTIONAL {{ ?image chess:white_castling_kingside ?white_castling_kingside . }}
-        OPTIONAL {{ ?image chess:white_castling_queenside ?white_castling_queenside . }}
-        OPTIONAL {{ ?image chess:black_castling_kingside ?black_castling_kingside . }}
-        OPTIONAL {{ ?image chess:black_castling_queenside ?black_castling_queenside . }}
-
-        OPTIONAL {{ ?image chess:en_passant_white ?en_passant_white . }}
-        OPTIONAL {{ ?image chess:en_passant_black ?en_passant_black . }}
-
-        {" ".join(conditions)}
-    }}
-    ORDER BY ASC(xsd:integer(?puzzle_id))
-    """
-
     try:
-        results = query_graphdb(sparql_query)
+        after, limit = parse_page(request.args.get("after"), request.args.get("limit"))
+        projection = parse_projection(request.args.get("fields"), request.args.get("format"), SEARCH_FIELDS)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-        chess_boards = []
-        for index, binding in enumerate(results["results"]["bindings"]):
-            chess_boards.append({
-                "index": index + 1,
-                "filename": extract_filename(binding["image"]["value"]),
-                "puzzle_id": binding.get("puzzle_id", {}).get("value", "N/A"),
-                "next_player": binding.get("next_player", {}).get("value", ""),
-                "white_pieces": {
-                    "kings": binding.get("white_kings", {}).get("value", "0"),
-                    "queens": binding.get("white_queens", {}).get("value", "0"),
-                    "rooks": binding.get("white_rooks", {}).get("value", "0"),
-                    "bishops": binding.get("white_bishops", {}).get("value", "0"),
-                    "knights": binding.get("white_knights", {}).get("value", "0"),
-                    "pawns": binding.get("white_pawns", {}).get("value", "0"),
-                },
-                "black_pieces": {
-                    "kings": binding.get("black_kings", {}).get("value", "0"),
-                    "queens": binding.get("black_queens", {}).get("value", "0"),
-                    "rooks": binding.get("black_rooks", {}).get("value", "0"),
-                    "bishops": binding.get("black_bishops", {}).get("value", "0"),
-                    "knights": binding.get("black_knights", {}).get("value", "0"),
-                    "pawns": binding.get("black_pawns", {}).get("value", "0"),
-                },
-                "castling": {
-                    "white_kingside": binding.get("white_castling_kingside", {}).get("value", "false"),
-                    "white_queenside": binding.get("white_castling_queenside", {}).get("value", "false"),
-                    "black_kingside": binding.get("black_castling_kingside", {}).get("value", "false"),
-                    "black_queenside": binding.get("black_castling_queenside", {}).get("value", "false"),
-                },
-                "en_passant": {
-                    "white": binding.get("en_passant_white", {}).get("value", "false"),
-                    "black": binding.get("en_passant_black", {}).get("value", "false"),
-                },
-                "metadata": {  # RDF-Compatible metadata
-                    "@context": "http://schema.org/",
-                    "@type": "ImageObject",
-                    "identifier": binding.get("puzzle_id", {}).get("value", "N/A"),
-                    "name": f"Chess Puzzle {binding.get("puzzle_id", {}).get("value", "N/A")}",
-                    "contentUrl": f"{BASE_URL}/images/{extract_filename(binding["image"]["value"])}",
-                    "encodingFormat": "image/png",
-                    "gameFeature": f"{binding.get("next_player", {}).get("value", "")} to move"
-                }
-            })
-
-        return jsonify(chess_boards)
+    try:
+        headers = {}
+        index = get_puzzle_index()
+        if index is not None:
+            # Answered from the in-memory puzzle index, no SPARQL involved
+            bits = index.search_bits(query)
+            rows = index.rows(bits, after=after, limit=limit, variables=projection.variables)
+            headers[TOTAL_COUNT_HEADER] = str(index.count(bits))
+        else:
+            rows = query_graphdb_rows_chunks(build_search_queries(query, after, limit, projection.variables))
+        rows, page_headers = page_rows(rows, limit)
+        return stream_results(format_rows(rows, format_search_row), {**headers, **page_headers}, projection)
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
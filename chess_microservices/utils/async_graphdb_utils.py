@@ -0,0 +1,258 @@
+import asyncio
+import aiohttp
+from config import (
+    GRAPHDB_ENDPOINT,
+    GRAPHDB_CONNECT_TIMEOUT,
+    GRAPHDB_READ_TIMEOUT,
+    GRAPHDB_MAX_RETRIES,
+    GRAPHDB_RETRY_BACKOFF,
+    ASYNC_GRAPHDB_POOL_SIZE,
+    ASYNC_GRAPHDB_MAX_CONCURRENCY,
+    SPARQL_CACHE_MAX_ROWS,
+    SPARQL_BACKEND,
+)
+from utils.query_cache import get_query_cache
+from utils.local_store import get_local_store
+from utils.sparql_results import TSV_ACCEPT, parse_tsv_header, parse_tsv_row, concat_results
+
+
+class AsyncSparqlClient:
+    """
+    asyncio counterpart of graphdb_utils.SparqlClient built on one aiohttp.ClientSession.
+    The session must be opened inside the running event loop with start().
+    """
+
+    RETRY_STATUSES = (429, 502, 503, 504)
+
+    def __init__(
+        self,
+        endpoint,
+        connect_timeout=GRAPHDB_CONNECT_TIMEOUT,
+        read_timeout=GRAPHDB_READ_TIMEOUT,
+        pool_size=ASYNC_GRAPHDB_POOL_SIZE,
+        max_concurrency=ASYNC_GRAPHDB_MAX_CONCURRENCY,
+        max_retries=GRAPHDB_MAX_RETRIES,
+        retry_backoff=GRAPHDB_RETRY_BACKOFF,
+    ):
+        self.endpoint = endpoint
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.session = None
+        self._slots = asyncio.Semaphore(max_concurrency)
+
+    async def start(self):
+        connector = aiohttp.TCPConnector(limit=self.pool_size, ttl_dns_cache=300)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _send(self, sparql_query, accept, read):
+        """
+        Posts a query and returns (response, await read(response)), retrying connection
+        errors, timeouts and RETRY_STATUSES with exponential backoff. The caller releases
+        the response.
+        """
+        headers = {
+            "Content-Type": "application/sparql-query",
+            "Accept": accept,
+        }
+        data = sparql_query.encode("utf-8")
+
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            response = None
+            try:
+                response = await self.session.post(self.endpoint, data=data, headers=headers)
+                if response.status not in self.RETRY_STATUSES or last_attempt:
+                    response.raise_for_status()
+                    return response, await read(response)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if response is not None:
+                    response.release()
+                if last_attempt:
+                    raise
+            except BaseException:
+                if response is not None:
+                    response.release()
+                raise
+            else:
+                response.release()
+            await asyncio.sleep(self.retry_backoff * (2 ** attempt))
+
+    async def query(self, sparql_query):
+        """
+        Sends a SPARQL query and returns the decoded JSON result.
+        """
+        async with self._slots:
+            response, result = await self._send(sparql_query, "application/json",
+                                                lambda response: response.json(content_type=None))
+        response.release()
+        return result
+
+    async def query_rows(self, sparql_query):
+        """
+        Sends a SELECT query asking for TSV results and returns (variables, rows),
+        where rows is an async iterator yielding one binding per result line. Failures
+        up to the header line are retried as in query().
+        """
+        async with self._slots:
+            response, header = await self._send(sparql_query, TSV_ACCEPT,
+                                                lambda response: response.content.readline())
+        variables = parse_tsv_header(header.decode("utf-8"))
+        return variables, self._iter_rows(response, variables)
+
+    async def _iter_rows(self, response, variables):
+        try:
+            async for line in response.content:
+                line = line.decode("utf-8").rstrip("\r\n")
+                if line:
+                    yield parse_tsv_row(variables, line)
+        finally:
+            response.release()
+
+
+_client = None
+
+
+async def start_async_sparql_client():
+    global _client
+    if _client is None:
+        _client = AsyncSparqlClient(GRAPHDB_ENDPOINT)
+        await _client.start()
+    return _client
+
+
+async def stop_async_sparql_client():
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+
+def get_async_sparql_client():
+    if _client is None:
+        raise RuntimeError("The async SPARQL client is not started")
+    return _client
+
+
+class AsyncLocalStore:
+    """
+    Runs queries on the embedded store (utils/local_store.py) in a worker thread,
+    with the same query()/query_rows() coroutines as AsyncSparqlClient.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    async def query(self, sparql_query):
+        return await asyncio.get_running_loop().run_in_executor(self.store.executor, self.store.query, sparql_query)
+
+    async def query_rows(self, sparql_query):
+        result = await self.query(sparql_query)
+        return result["head"]["vars"], _iter_cached(result["results"]["bindings"])
+
+
+def get_async_backend():
+    """
+    Async counterpart of graphdb_utils.get_sparql_backend.
+    """
+    if SPARQL_BACKEND == "local":
+        return AsyncLocalStore(get_local_store())
+    if SPARQL_BACKEND != "http":
+        raise ValueError(f"Unknown SPARQL_BACKEND: {SPARQL_BACKEND}")
+    return get_async_sparql_client()
+
+
+async def query_graphdb_async(sparql_query):
+    """
+    Sends a SPARQL query to the GraphDB repository without blocking the event loop,
+    answering from the result cache when the same query was already run.
+    """
+    client = get_async_backend()
+    cache = get_query_cache()
+    if cache is None:
+        return await client.query(sparql_query)
+    return await cache.aget_or_query(sparql_query, client.query)
+
+
+async def query_graphdb_rows_async(sparql_query):
+    """
+    Async counterpart of graphdb_utils.query_graphdb_rows.
+    """
+    client = get_async_backend()
+    cache = get_query_cache()
+    if cache is None:
+        _, rows = await client.query_rows(sparql_query)
+        return rows
+
+    key, version, result = cache.lookup(sparql_query)
+    if result is not None:
+        return _iter_cached(result["results"]["bindings"])
+    variables, rows = await client.query_rows(sparql_query)
+    return _cache_rows(cache, key, version, variables, rows)
+
+
+async def _iter_cached(bindings):
+    for binding in bindings:
+        yield binding
+
+
+async def _cache_rows(cache, key, version, variables, rows):
+    kept = []
+    async for binding in rows:
+        if kept is not None:
+            kept.append(binding)
+            if len(kept) > SPARQL_CACHE_MAX_ROWS:
+                kept = None
+        yield binding
+    if kept is not None:
+        cache.store(key, {"head": {"vars": variables}, "results": {"bindings": kept}}, version)
+
+
+async def query_graphdb_chunks_async(sparql_queries, merge=concat_results):
+    """
+    Async counterpart of graphdb_utils.query_graphdb_chunks.
+    """
+    if len(sparql_queries) == 1:
+        return await query_graphdb_async(sparql_queries[0])
+    return merge(await asyncio.gather(*(query_graphdb_async(q) for q in sparql_queries)))
+
+
+async def query_graphdb_rows_chunks_async(sparql_queries):
+    """
+    Async counterpart of graphdb_utils.query_graphdb_rows_chunks.
+    """
+    if len(sparql_queries) == 1:
+        return await query_graphdb_rows_async(sparql_queries[0])
+    tasks = [asyncio.ensure_future(_fetch_rows(q)) for q in sparql_queries]
+    try:
+        first = await tasks[0]
+    except BaseException:
+        _cancel_all(tasks)
+        raise
+    return _chain_chunks(first, tasks[1:])
+
+
+async def _fetch_rows(sparql_query):
+    return [binding async for binding in await query_graphdb_rows_async(sparql_query)]
+
+
+async def _chain_chunks(first, tasks):
+    try:
+        for binding in first:
+            yield binding
+        for task in tasks:
+            for binding in await task:
+                yield binding
+    finally:
+        _cancel_all(tasks)
+
+
+def _cancel_all(tasks):
+    for task in tasks:
+        task.cancel()
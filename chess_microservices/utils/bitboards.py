@@ -0,0 +1,256 @@
+"""
+Bitboards of every ingested puzzle: twelve 64-bit masks per position, one per piece of
+utils.fen.PIECE_LETTERS (bit 0 is a1, bit 63 h8). setup_rdf.py builds them from the FEN
+filenames and saves them next to ontology.nt; the square terms of /search, which the RDF
+piece counts cannot answer, are evaluated on them with bitwise operations over the
+whole dataset at once, and so is the similarity between positions the position
+recommender ranks the dataset by. The Zobrist hash of every position indexes them for
+exact-position lookups and duplicate detection.
+"""
+import os
+import threading
+import numpy as np
+from config import BITBOARDS_FILE, POSITION_SIMILARITY_BATCH
+from utils.fen import SIDES, PIECES, PIECE_LETTERS, parse_fens
+from utils.query_cache import read_dataset_version
+
+FILES = "abcdefgh"
+RANKS = "12345678"
+FILE_A = 0x0101010101010101
+RANK_1 = 0xFF
+
+# "hamming": squares whose piece differs, "jaccard": 1 - shared / all occupied (square, piece) pairs
+SIMILARITY_METRICS = ("jaccard", "hamming")
+
+
+def area_mask(area):
+    """
+    Squares of a square ("f3"), a file ("a") or a rank ("7") as a 64-bit mask; None if malformed.
+    """
+    if len(area) == 2 and area[0] in FILES and area[1] in RANKS:
+        return 1 << (RANKS.index(area[1]) * 8 + FILES.index(area[0]))
+    if len(area) == 1 and area in FILES:
+        return FILE_A << FILES.index(area)
+    if len(area) == 1 and area in RANKS:
+        return RANK_1 << (RANKS.index(area) * 8)
+    return None
+
+
+def square_terms(query):
+    """
+    Reads the square terms of a lower-cased search string: "[white_|black_]piece:areas",
+    e.g. "white_knight:f3", "black_king:g8", "pawns:7" or "rook:a,h" (comma-separated squares,
+    files or ranks, a piece of either colour when no side is given). Returns a
+    (bitboard columns, mask) pair per term, None for malformed ones.
+    """
+    terms = []
+    for term in query.split():
+        if ":" not in term:
+            continue
+        piece, _, areas = term.partition(":")
+        side, _, piece = piece.rpartition("_")
+        piece = piece if piece.endswith("s") else piece + "s"
+        masks = [area_mask(area) for area in areas.split(",")]
+        if (side and side not in SIDES) or piece not in PIECES or None in masks:
+            terms.append(None)
+            continue
+        sides = [SIDES.index(side)] if side else range(len(SIDES))
+        mask = 0
+        for area in masks:
+            mask |= area
+        terms.append(([index * len(PIECES) + PIECES.index(piece) for index in sides], mask))
+    return terms
+
+
+class BitboardStore:
+    """
+    (N, 12) uint64 bitboards with the puzzle_id, image file name, side to move (index
+    into SIDES) and Zobrist hash of each row, sorted by puzzle_id.
+
+    canonical is the row of the first (lowest puzzle_id) position identical to each row,
+    the row itself for a position seen for the first time.
+    """
+
+    def __init__(self, puzzle_ids, file_names, sides, hashes, bitboards):
+        order = np.argsort(np.asarray(puzzle_ids, dtype=np.int64), kind="stable")
+        self.puzzle_ids = np.asarray(puzzle_ids, dtype=np.int64)[order]
+        self.file_names = np.asarray(file_names, dtype=np.str_).reshape(-1)[order]
+        self.sides = np.asarray(sides, dtype=np.int8)[order]
+        self.hashes = np.asarray(hashes, dtype=np.uint64)[order]
+        self.bitboards = np.asarray(bitboards, dtype=np.uint64).reshape(-1, len(PIECE_LETTERS))[order]
+        # Column-major copy and piece totals for the similarity batches
+        self.columns = np.ascontiguousarray(self.bitboards.T)
+        self.sizes = np.bitwise_count(self.bitboards).sum(axis=1, dtype=np.uint8)
+        self.canonical = canonical_rows(self.hashes, self.bitboards)
+        self._hash_rows = None
+
+    def __len__(self):
+        return len(self.puzzle_ids)
+
+    @classmethod
+    def from_images(cls, images):
+        """
+        Builds the bitboards of (puzzle_id, file name) pairs from the FEN filenames.
+        """
+        file_names = [name for _, name in images]
+        boards = parse_fens(file_names)
+        return cls([puzzle_id for puzzle_id, _ in images], file_names, boards.sides,
+                   boards.zobrist_hashes(), boards.bitboards())
+
+    def updated(self, added, removed_ids):
+        """
+        A copy without the removed puzzle ids and with the added (puzzle_id, file name) images.
+        """
+        keep = ~np.isin(self.puzzle_ids, np.fromiter(removed_ids, dtype=np.int64))
+        added = BitboardStore.from_images(added)
+        return BitboardStore(*(
+            np.concatenate([getattr(self, column)[keep], getattr(added, column)])
+            for column in ("puzzle_ids", "file_names", "sides", "hashes", "bitboards")
+        ))
+
+    def save(self, path):
+        # Written next to the previous file and swapped in once complete
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, puzzle_ids=self.puzzle_ids, file_names=self.file_names, sides=self.sides,
+                     hashes=self.hashes, bitboards=self.bitboards)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["puzzle_ids"], data["file_names"], data["sides"], data["hashes"], data["bitboards"])
+
+    def matches(self, terms):
+        """
+        Boolean mask of the puzzles with, for every (columns, mask) term, a piece of one
+        of the columns on one of the squares of the mask.
+        """
+        matches = np.ones(len(self), dtype=bool)
+        for columns, mask in terms:
+            matches &= (self.bitboards[:, columns] & np.uint64(mask)).any(axis=1)
+        return matches
+
+    def matching_ids(self, terms):
+        return self.puzzle_ids[self.matches(terms)]
+
+    def duplicate_rows(self):
+        """
+        Rows whose position already appears under a lower puzzle_id.
+        """
+        return np.flatnonzero(self.canonical != np.arange(len(self)))
+
+    def position_rows(self, boards):
+        """
+        Rows holding exactly the position of each board of a FenBatch, found through the
+        Zobrist hash in O(1) and confirmed on the bitboards.
+        """
+        if self._hash_rows is None:
+            # Built on the first lookup: hash -> rows sharing it
+            order = np.argsort(self.hashes, kind="stable")
+            hashes, starts = np.unique(self.hashes[order], return_index=True)
+            self._hash_rows = dict(zip(hashes.tolist(), np.split(order, starts[1:])))
+        empty = np.zeros(0, dtype=np.int64)
+        matches = []
+        for hash_value, bitboards in zip(boards.zobrist_hashes().tolist(), boards.bitboards()):
+            rows = self._hash_rows.get(hash_value, empty)
+            matches.append(rows[(self.bitboards[rows] == bitboards).all(axis=1)])
+        return matches
+
+    def rows_of(self, puzzle_ids):
+        """
+        Row numbers of the given (validated) puzzle ids, the ones not in the store left out.
+        """
+        ids = np.asarray(puzzle_ids, dtype=np.int64)
+        if not len(self) or not len(ids):
+            return np.zeros(0, dtype=np.int64)
+        rows = np.searchsorted(self.puzzle_ids, ids).clip(max=len(self) - 1)
+        return np.unique(rows[self.puzzle_ids[rows] == ids])
+
+    def distances(self, rows, metric="jaccard"):
+        """
+        Mean distance of every position to the positions of the given rows. Computed in
+        blocks of candidates of about POSITION_SIMILARITY_BATCH (row, candidate) pairs, small
+        enough for the intermediate arrays to stay in cache.
+        """
+        if metric not in SIMILARITY_METRICS:
+            raise ValueError(f"Invalid metric {metric!r}, expected one of {', '.join(SIMILARITY_METRICS)}")
+        reference = self.bitboards[rows]
+        reference_sizes = self.sizes[rows].astype(np.float64)[:, None]
+        distances = np.empty(len(self), dtype=np.float64)
+        block = max(4096, POSITION_SIMILARITY_BATCH // max(len(rows), 1))
+        for start in range(0, len(self), block):
+            end = min(start + block, len(self))
+            # (square, piece) pairs both positions have; at most 32 pieces, so uint8 is enough
+            shared = np.zeros((len(rows), end - start), dtype=np.uint8)
+            for column in range(len(PIECE_LETTERS)):
+                shared += np.bitwise_count(reference[:, column, None] & self.columns[column, None, start:end])
+            shared = shared.astype(np.float64)
+            occupied = reference_sizes + self.sizes[start:end] - shared
+            if metric == "hamming":
+                pair_distances = occupied - shared
+            else:
+                pair_distances = 1 - shared / np.maximum(occupied, 1)
+            distances[start:end] = pair_distances.mean(axis=0)
+        return distances
+
+    def nearest(self, puzzle_ids, count, metric="jaccard"):
+        """
+        (rows, distances) of the count positions closest to the given puzzles, closest first
+        with ties broken by puzzle_id. The given positions themselves and duplicates
+        (see canonical) are left out, so no slot goes to a position twice.
+        """
+        rows = self.rows_of(puzzle_ids)
+        if not len(rows):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+        distances = self.distances(rows, metric)
+        distances[self.duplicate_rows()] = np.inf
+        distances[np.isin(self.canonical, self.canonical[rows])] = np.inf
+        count = min(count, int(np.count_nonzero(distances < np.inf)))
+        if count <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+
+        # Every position tied with the count-th closest, ordered by distance then row (puzzle_id)
+        threshold = np.partition(distances, count - 1)[count - 1]
+        candidates = np.flatnonzero(distances <= threshold)
+        nearest = candidates[np.lexsort((candidates, distances[candidates]))][:count]
+        return nearest, distances[nearest]
+
+
+def canonical_rows(hashes, bitboards):
+    """
+    For rows sorted by puzzle_id, the row of the first position identical to each row.
+    Rows are grouped by Zobrist hash; a position colliding with a different one under the
+    same hash is compared on its bitboards and keeps its own group.
+    """
+    rows = np.arange(len(hashes))
+    order = np.lexsort((rows, hashes))
+    sorted_hashes = hashes[order]
+    starts = np.ones(len(order), dtype=bool)
+    starts[1:] = sorted_hashes[1:] != sorted_hashes[:-1]
+    canonical = np.empty(len(order), dtype=np.int64)
+    canonical[order] = order[np.maximum.accumulate(np.where(starts, rows, 0))]
+
+    # Hash collisions between different positions, practically never taken
+    for row in np.flatnonzero((bitboards != bitboards[canonical]).any(axis=1)):
+        same_hash = np.flatnonzero(hashes == hashes[row])
+        canonical[row] = same_hash[(bitboards[same_hash] == bitboards[row]).all(axis=1)][0]
+    return canonical
+
+
+_store_lock = threading.Lock()
+_store_state = {"version": None, "store": None}
+
+
+def get_bitboard_store():
+    """
+    Returns the bitboards written by the last ingest, reloaded whenever the dataset version changes.
+    """
+    version = read_dataset_version()
+    if version != _store_state["version"]:
+        with _store_lock:
+            if version != _store_state["version"]:
+                if not os.path.exists(BITBOARDS_FILE):
+                    raise FileNotFoundError(f"{BITBOARDS_FILE} not found, run python -m utils.setup_rdf first")
+                _store_state["store"] = BitboardStore.load(BITBOARDS_FILE)
+                _store_state["version"] = version
+    return _store_state["store"]
@@ -0,0 +1,134 @@
+import numpy as np
+
+WORD_BITS = 64
+
+
+def empty_bits(size):
+    return np.zeros((size + WORD_BITS - 1) // WORD_BITS, dtype=np.uint64)
+
+
+def bits_from_mask(mask):
+    """
+    Packs a boolean mask into a bitset, bit i of the result being mask[i].
+    """
+    bits = empty_bits(len(mask))
+    packed = np.packbits(mask, bitorder="little")
+    bits.view(np.uint8)[:len(packed)] = packed
+    return bits
+
+
+def bits_to_positions(bits, size):
+    """
+    Positions of the set bits, in increasing order.
+    """
+    return np.flatnonzero(np.unpackbits(bits.view(np.uint8), count=size, bitorder="little"))
+
+
+def popcount(bits):
+    return int(np.bitwise_count(bits).sum())
+
+
+class BitmapIndex:
+    """
+    One bitset per (side to move, piece, count) over puzzle positions, plus one per
+    extra label (e.g. the game state). A filter becomes a few unions and intersections
+    of word-aligned uint64 arrays, and its result count is a popcount.
+    Bitsets grow with add(), so newly ingested puzzles are indexed incrementally, and
+    remove() clears the puzzles an ingest removed.
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.bitsets = {}
+
+    def _set_bits(self, key, positions):
+        bits = self.bitsets.get(key)
+        words = (self.size + WORD_BITS - 1) // WORD_BITS
+        if bits is None:
+            bits = np.zeros(words, dtype=np.uint64)
+        elif len(bits) < words:
+            bits = np.concatenate([bits, np.zeros(words - len(bits), dtype=np.uint64)])
+        np.bitwise_or.at(bits, positions // WORD_BITS, np.uint64(1) << (positions % WORD_BITS).astype(np.uint64))
+        self.bitsets[key] = bits
+
+    def add(self, sides, to_move_counts, labels=()):
+        """
+        Indexes new puzzles at positions size, size + 1, ...
+
+        sides: side to move of each puzzle (index into the sides, -1 if unknown).
+        to_move_counts: (puzzles, pieces) counts of the side to move, -1 when missing.
+        labels: optional (name, values) pairs, one value per puzzle, indexed as (name, value).
+        """
+        sides = np.asarray(sides)
+        to_move_counts = np.asarray(to_move_counts)
+        start = self.size
+        self.size += len(sides)
+        positions = np.arange(start, self.size, dtype=np.uint64)
+
+        for side in np.unique(sides[sides >= 0]):
+            of_side = sides == side
+            for piece in range(to_move_counts.shape[1]):
+                counts = to_move_counts[of_side, piece]
+                for count in np.unique(counts[counts >= 0]):
+                    self._set_bits((int(side), piece, int(count)), positions[of_side][counts == count])
+
+        for name, values in labels:
+            values = np.asarray(values)
+            for value in np.unique(values):
+                self._set_bits((name, value.item()), positions[values == value])
+
+    def remove(self, positions):
+        """
+        Clears the puzzles at the given positions from every bitset; their positions stay.
+        """
+        mask = np.zeros(self.size, dtype=bool)
+        mask[positions] = True
+        keep = ~bits_from_mask(mask)
+        for bits in self.bitsets.values():
+            bits &= keep[:len(bits)]
+
+    def copy(self):
+        """
+        Independent copy, to update while this one is still being read.
+        """
+        copy = BitmapIndex()
+        copy.size = self.size
+        copy.bitsets = {key: bits.copy() for key, bits in self.bitsets.items()}
+        return copy
+
+    def bits(self, key):
+        """
+        Bitset of a key padded to the current size; empty when no puzzle has it.
+        """
+        bits = self.bitsets.get(key)
+        full = empty_bits(self.size)
+        if bits is not None:
+            full[:len(bits)] = bits
+        return full
+
+    def count_bits(self, piece, operator, count):
+        """
+        Puzzles whose side to move has `operator count` pieces of the given kind,
+        as the union of the matching (side, piece, count) bitsets.
+        """
+        matches = {
+            "=": lambda indexed: indexed == count,
+            ">": lambda indexed: indexed > count,
+            ">=": lambda indexed: indexed >= count,
+            "!=": lambda indexed: indexed != count,
+            "<": lambda indexed: indexed < count,
+            "<=": lambda indexed: indexed <= count,
+        }[operator]
+        result = empty_bits(self.size)
+        for key, bits in self.bitsets.items():
+            if len(key) == 3 and key[1] == piece and matches(key[2]):
+                result[:len(bits)] |= bits
+        return result
+
+    def label_bits(self, name, values):
+        result = empty_bits(self.size)
+        for value in values:
+            bits = self.bitsets.get((name, value))
+            if bits is not None:
+                result[:len(bits)] |= bits
+        return result
@@ -0,0 +1,189 @@
+"""
+Pushes the output of utils/setup_rdf.py into the SPARQL store, in chunks of INSERT DATA /
+DELETE DATA updates sent concurrently. Every committed chunk is recorded in a checkpoint,
+so an interrupted load resumes where it stopped when run again.
+
+Run from chess_microservices/ after utils/setup_rdf.py:
+    python -m utils.bulk_load                    # adds ontology.nt to the repository
+    python -m utils.bulk_load --replace          # clears the repository first
+    python -m utils.bulk_load --delta            # applies ontology.removed.nt / ontology.added.nt (--incremental ingest)
+    python -m utils.bulk_load --store-dir DIR    # loads an on-disk Oxigraph store instead of GraphDB
+"""
+import argparse
+import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from pyoxigraph import Store
+from config import (
+    GRAPHDB_UPDATE_ENDPOINT,
+    LOCAL_STORE_SOURCE,
+    ROOT_DIR,
+    BULK_LOAD_CHUNK_SIZE,
+    BULK_LOAD_CONCURRENCY,
+    BULK_LOAD_CHECKPOINT_FILE,
+    INGEST_ADDED_FILE,
+    INGEST_REMOVED_FILE,
+)
+from utils.graphdb_utils import get_sparql_client
+from utils.query_cache import read_dataset_version
+from utils.setup_rdf import bump_dataset_version
+
+
+class SparqlUpdateTarget:
+    """
+    SPARQL Update endpoint of the repository; each update is committed as one transaction.
+    """
+
+    def __init__(self, endpoint=GRAPHDB_UPDATE_ENDPOINT):
+        self.endpoint = endpoint
+        self.client = get_sparql_client()
+
+    def update(self, sparql_update):
+        response = self.client.session.post(
+            self.endpoint,
+            data={"update": sparql_update},
+            timeout=self.client.timeout,
+        )
+        response.raise_for_status()
+
+
+class Checkpoint:
+    """
+    Number of leading chunks committed per load step, for one dataset version and chunk size.
+    Saved after every commit; a checkpoint of another dataset or chunk size is discarded.
+    """
+
+    def __init__(self, path, dataset_version, chunk_size):
+        self.path = path
+        self.key = {"dataset_version": dataset_version, "chunk_size": chunk_size}
+        self.steps = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                saved = json.load(f)
+            if {key: saved.get(key) for key in self.key} == self.key:
+                self.steps = saved["steps"]
+            else:
+                print("Ignoring the checkpoint of another dataset version or chunk size")
+
+    def committed(self, step):
+        return self.steps.get(step, 0)
+
+    def commit(self, step, chunks):
+        self.steps[step] = chunks
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({**self.key, "steps": self.steps}, f)
+        os.replace(self.path + ".tmp", self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def iter_line_chunks(path, chunk_size, skip=0):
+    """
+    Yields (chunk number, lines) for chunks of chunk_size N-Triples lines, the first skip chunks left out.
+    """
+    with open(path, encoding="utf-8") as f:
+        for _ in range(skip):
+            if sum(1 for _ in islice(f, chunk_size)) < chunk_size:
+                return
+        number = skip
+        while True:
+            lines = list(islice(f, chunk_size))
+            if not lines:
+                return
+            yield number, lines
+            number += 1
+
+
+def data_update(operation, lines):
+    """
+    INSERT DATA / DELETE DATA update for N-Triples lines, which are valid SPARQL triples as is.
+    """
+    return f"{operation} DATA {{\n{''.join(lines)}}}"
+
+
+def load_file(target, path, operation, checkpoint, chunk_size=BULK_LOAD_CHUNK_SIZE, concurrency=BULK_LOAD_CONCURRENCY):
+    """
+    Sends the triples of an N-Triples file as concurrent chunked updates, skipping the chunks
+    the checkpoint records as committed. Chunks are acknowledged in file order, so the
+    checkpoint only ever advances over a contiguous run of committed chunks; chunks past it
+    may be sent again on resume, which INSERT DATA / DELETE DATA tolerate.
+    """
+    step = f"{operation} {os.path.basename(path)}"
+    start = checkpoint.committed(step)
+    if start:
+        print(f"{step}: resuming after {start} committed chunks")
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="bulk-load") as executor:
+        pending = deque()
+        try:
+            for number, lines in iter_line_chunks(path, chunk_size, skip=start):
+                pending.append((number, len(lines), executor.submit(target.update, data_update(operation, lines))))
+                if len(pending) >= 2 * concurrency:
+                    acknowledge(pending, checkpoint, step)
+            while pending:
+                acknowledge(pending, checkpoint, step)
+        except BaseException:
+            for _, _, future in pending:
+                future.cancel()
+            print(f"{step}: stopped, run the loader again to resume")
+            raise
+
+
+def acknowledge(pending, checkpoint, step):
+    number, triples, future = pending.popleft()
+    future.result()
+    checkpoint.commit(step, number + 1)
+    print(f"{step}: chunk {number + 1} committed ({triples} triples)")
+
+
+def bulk_load(target, delta=False, replace=False, source=LOCAL_STORE_SOURCE,
+              chunk_size=BULK_LOAD_CHUNK_SIZE, concurrency=BULK_LOAD_CONCURRENCY,
+              checkpoint_path=BULK_LOAD_CHECKPOINT_FILE):
+    """
+    Loads the current ingest output into target (any object with an update(sparql_update) method).
+    """
+    checkpoint = Checkpoint(checkpoint_path, read_dataset_version(), chunk_size)
+
+    if delta:
+        if not os.path.exists(INGEST_ADDED_FILE) or not os.path.exists(INGEST_REMOVED_FILE):
+            raise FileNotFoundError("No delta to load, run python -m utils.setup_rdf --incremental first")
+        load_file(target, INGEST_REMOVED_FILE, "DELETE", checkpoint, chunk_size, concurrency)
+        load_file(target, INGEST_ADDED_FILE, "INSERT", checkpoint, chunk_size, concurrency)
+    else:
+        if replace and not checkpoint.committed("CLEAR"):
+            target.update("CLEAR DEFAULT")
+            checkpoint.commit("CLEAR", 1)
+        load_file(target, source, "INSERT", checkpoint, chunk_size, concurrency)
+
+    checkpoint.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--delta", action="store_true", help="apply the changes of the last incremental ingest")
+    parser.add_argument("--replace", action="store_true", help="clear the repository before a full load")
+    parser.add_argument("--endpoint", default=GRAPHDB_UPDATE_ENDPOINT, help="SPARQL Update endpoint of the repository")
+    parser.add_argument("--store-dir", help="load an on-disk Oxigraph store at this path instead")
+    parser.add_argument("--chunk-size", type=int, default=BULK_LOAD_CHUNK_SIZE, help="triples per update")
+    parser.add_argument("--concurrency", type=int, default=BULK_LOAD_CONCURRENCY, help="updates sent at the same time")
+    args = parser.parse_args()
+
+    if args.store_dir:
+        target = Store(args.store_dir)
+    else:
+        target = SparqlUpdateTarget(args.endpoint)
+
+    bulk_load(target, args.delta, args.replace, chunk_size=args.chunk_size, concurrency=args.concurrency)
+
+    # The repository now holds the new data: drop what was cached from the old one
+    if not args.store_dir:
+        bump_dataset_version(ROOT_DIR)
+    print("Bulk load complete")
+
+
+if __name__ == "__main__":
+    main()
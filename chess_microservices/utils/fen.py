@@ -0,0 +1,228 @@
+"""
+Batch parser for the FEN board placements the dataset images are named after
+(ranks separated by '-' instead of '/', e.g. 1B1B1Qr1-7p-...-4K2R.jpeg).
+
+The whole batch is decoded at once: every character is looked up in a square code
+table and a width table (a digit is that many empty squares, the rank separator none)
+and np.repeat expands them to 64 squares per board, then counts, side to move,
+castling and en passant rights are computed with array operations. Depends on NumPy
+only, so ingest, the puzzle index and the training scripts can all share it.
+"""
+import numpy as np
+
+SIDES = ("white", "black")
+PIECES = ("kings", "queens", "rooks", "bishops", "knights", "pawns")
+GAME_STATES = ("opening", "midgame", "endgame")
+
+# Square codes: 0 is empty, 1-6 the white pieces and 7-12 the black ones, in PIECES order
+PIECE_LETTERS = "KQRBNPkqrbnp"
+EMPTY = 0
+KING, ROOK, PAWN = 1, 3, 6
+BLACK = len(PIECES)  # offset of the black codes
+
+# Total pieces on the board from which a position counts as opening / midgame, below is endgame
+OPENING_MIN_PIECES = 24
+MIDGAME_MIN_PIECES = 14
+
+CASTLING_RIGHTS = (
+    "white_castling_kingside", "white_castling_queenside",
+    "black_castling_kingside", "black_castling_queenside",
+)
+
+# Square code and number of squares of every byte; a width of -1 marks an invalid character
+_CODES = np.zeros(256, dtype=np.uint8)
+_WIDTHS = np.full(256, -1, dtype=np.int64)
+for _code, _letter in enumerate(PIECE_LETTERS, start=1):
+    _CODES[ord(_letter)] = _code
+    _WIDTHS[ord(_letter)] = 1
+for _empty in range(1, 9):
+    _WIDTHS[ord(str(_empty))] = _empty
+_RANK_SEPARATOR = ord("-")
+_WIDTHS[_RANK_SEPARATOR] = 0
+
+
+def _splitmix64(values):
+    """
+    SplitMix64 finalizer: well-mixed 64-bit values from consecutive integers, identical on
+    every platform and NumPy version, unlike the streams of np.random.
+    """
+    z = values + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+# Zobrist keys: one random 64-bit key per (square code, square), zero for empty squares;
+# the hash of a board is the XOR of the keys of its pieces
+ZOBRIST_KEYS = np.zeros((len(PIECE_LETTERS) + 1, 64), dtype=np.uint64)
+ZOBRIST_KEYS[1:] = _splitmix64(np.arange(len(PIECE_LETTERS) * 64, dtype=np.uint64)).reshape(len(PIECE_LETTERS), 64)
+
+
+def fen_of_filename(filename):
+    """
+    Board placement of an image filename: the part before the extension.
+    """
+    return filename.split(".")[0]
+
+
+class FenBatch:
+    """
+    Parsed boards, one row per FEN of the batch:
+
+    boards: (N, 8, 8) square codes, row 0 being rank 8 as in the FEN.
+    counts: (N, 2, 6) pieces per side (SIDES) and kind (PIECES).
+    sides: (N,) side to move as an index into SIDES; the side whose pieces are on the
+        bottom half of the board, as the dataset images are drawn from its point of view.
+    castling: (N, 4) CASTLING_RIGHTS, king and rook still on their initial squares.
+    en_passant: (N, 2) a white / black pawn next to an enemy pawn, on row 4 when white
+        moves and on row 3 when black does.
+    """
+
+    def __init__(self, boards):
+        self.boards = boards
+        size = len(boards)
+
+        # One histogram of square codes per board
+        codes = len(PIECE_LETTERS) + 1
+        keys = np.arange(size)[:, None] * codes + boards.reshape(size, 64)
+        per_code = np.bincount(keys.ravel(), minlength=size * codes).reshape(size, codes)
+        self.counts = per_code[:, 1:].reshape(size, len(SIDES), len(PIECES))
+
+        bottom = boards[:, 4:]
+        white_bottom = ((bottom >= KING) & (bottom < KING + BLACK)).sum(axis=(1, 2))
+        black_bottom = (bottom >= KING + BLACK).sum(axis=(1, 2))
+        self.sides = np.where(white_bottom > black_bottom, 0, 1).astype(np.int8)
+
+        white_king = boards[:, 7, 4] == KING
+        black_king = boards[:, 0, 4] == KING + BLACK
+        self.castling = np.stack([
+            white_king & (boards[:, 7, 7] == ROOK),
+            white_king & (boards[:, 7, 0] == ROOK),
+            black_king & (boards[:, 0, 7] == ROOK + BLACK),
+            black_king & (boards[:, 0, 0] == ROOK + BLACK),
+        ], axis=1)
+
+        # Row 4 when white moves, row 3 when black does
+        rank = boards[np.arange(size), np.where(self.sides == 0, 4, 3)]
+        white_pawns = rank == PAWN
+        black_pawns = rank == PAWN + BLACK
+        self.en_passant = np.stack([
+            (white_pawns & _next_to(black_pawns)).any(axis=1),
+            (black_pawns & _next_to(white_pawns)).any(axis=1),
+        ], axis=1)
+
+    def __len__(self):
+        return len(self.boards)
+
+    @property
+    def total_pieces(self):
+        return self.counts.sum(axis=(1, 2))
+
+    def game_states(self):
+        """
+        Game state of every board as an index into GAME_STATES.
+        """
+        return game_state_codes(self.total_pieces)
+
+    def bitboards(self):
+        """
+        (N, 12) uint64 bitboards, one per square code of PIECE_LETTERS (column code - 1);
+        bit 0 is a1, bit 7 h1 and bit 63 h8.
+        """
+        # Rank 1 first, so the square index of a1 is 0
+        squares = self.boards[:, ::-1].reshape(len(self), 64)
+        bitboards = np.empty((len(self), len(PIECE_LETTERS)), dtype=np.uint64)
+        for column in range(len(PIECE_LETTERS)):
+            packed = np.packbits(squares == column + 1, axis=1, bitorder="little")
+            bitboards[:, column] = packed.view("<u8")[:, 0]
+        return bitboards
+
+    def zobrist_hashes(self):
+        """
+        (N,) uint64 Zobrist hash of every board's piece placement; equal boards hash equally.
+        """
+        keys = ZOBRIST_KEYS[self.boards.reshape(len(self), 64), np.arange(64)]
+        return np.bitwise_xor.reduce(keys, axis=1)
+
+    def properties(self, position):
+        """
+        Properties of one board, in the dict shape setup_rdf.derive_properties takes.
+        """
+        counts = self.counts[position].tolist()
+        return {
+            "next_player": SIDES[self.sides[position]],
+            "white_pieces": dict(zip(PIECES, counts[0])),
+            "black_pieces": dict(zip(PIECES, counts[1])),
+            "castling": dict(zip(CASTLING_RIGHTS, self.castling[position].tolist())),
+            "en_passant_white": bool(self.en_passant[position, 0]),
+            "en_passant_black": bool(self.en_passant[position, 1]),
+        }
+
+
+def _next_to(mask):
+    """
+    Squares with a marked square immediately left or right of them on the same rank.
+    """
+    neighbours = np.zeros_like(mask)
+    neighbours[:, 1:] |= mask[:, :-1]
+    neighbours[:, :-1] |= mask[:, 1:]
+    return neighbours
+
+
+def parse_valid_fens(fens):
+    """
+    Parses FEN board placements or image filenames without raising: returns (FenBatch of
+    the valid entries, boolean mask of the valid entries). A valid entry is 8 ranks of 8
+    squares separated by '-', made of piece letters and digits 1-8 only.
+    """
+    fens = list(fens)
+    placements = [fen_of_filename(fen) for fen in fens]
+    lengths = np.array([len(placement) for placement in placements], dtype=np.int64)
+    starts = np.cumsum(lengths) - lengths
+
+    # Non-ASCII characters become '?', which is invalid too
+    raw = np.frombuffer("".join(placements).encode("ascii", errors="replace"), dtype=np.uint8)
+    widths = _WIDTHS[raw]
+    board_of_char = np.repeat(np.arange(len(fens)), lengths)
+    valid = np.ones(len(fens), dtype=bool)
+    valid[board_of_char[widths < 0]] = False
+
+    # Squares before each character of its board; the k-th separator must follow 8 * k of
+    # them and the board end 64, so that a rank too long next to one too short is caught
+    squares = np.cumsum(widths)
+    before_board = np.concatenate([[0], squares])[starts]
+    separators = np.flatnonzero(raw == _RANK_SEPARATOR)
+    board_of_separator = board_of_char[separators]
+    per_board = np.bincount(board_of_separator, minlength=len(fens))
+    ordinal = np.arange(len(separators)) - np.repeat(np.cumsum(per_board) - per_board, per_board)
+    misplaced = squares[separators] - before_board[board_of_separator] != 8 * (ordinal + 1)
+    valid[board_of_separator[misplaced]] = False
+    valid &= per_board == 7
+    valid &= np.concatenate([[0], squares])[starts + lengths] - before_board == 64
+
+    if not valid.all():
+        keep = np.repeat(valid, lengths)
+        raw, widths = raw[keep], widths[keep]
+    return FenBatch(np.repeat(_CODES[raw], widths).reshape(-1, 8, 8)), valid
+
+
+def parse_fens(fens):
+    """
+    Parses FEN board placements or image filenames into a FenBatch.
+    Raises ValueError naming the first entry that is not a valid 8x8 board.
+    """
+    fens = list(fens)
+    boards, valid = parse_valid_fens(fens)
+    if not valid.all():
+        raise ValueError(f"Invalid FEN board: {fens[int(np.argmin(valid))]!r}")
+    return boards
+
+
+def game_state_codes(total_pieces):
+    """
+    GAME_STATES index for each total piece count.
+    """
+    total_pieces = np.asarray(total_pieces)
+    return np.select(
+        [total_pieces >= OPENING_MIN_PIECES, total_pieces >= MIDGAME_MIN_PIECES], [0, 1], 2
+    ).astype(np.int8)
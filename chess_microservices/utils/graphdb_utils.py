@@ -1,19 +1,245 @@
 import requests
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
-from config import GRAPHDB_ENDPOINT
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from config import (
+    GRAPHDB_ENDPOINT,
+    GRAPHDB_CONNECT_TIMEOUT,
+    GRAPHDB_READ_TIMEOUT,
+    GRAPHDB_POOL_SIZE,
+    GRAPHDB_MAX_CONCURRENCY,
+    GRAPHDB_MAX_RETRIES,
+    GRAPHDB_RETRY_BACKOFF,
+    SPARQL_CACHE_MAX_ROWS,
+    SPARQL_BACKEND,
+)
+from utils.query_cache import get_query_cache
+from utils.local_store import get_local_store
+from utils.sparql_results import TSV_ACCEPT, parse_tsv_header, parse_tsv_row, concat_results
+
+
+class SparqlClient:
+    """
+    Keep-alive SPARQL client backed by a pooled requests.Session.
+    Bounds the number of queries in flight and retries transient failures.
+    """
+
+    RETRY_STATUSES = (429, 502, 503, 504)
+
+    def __init__(
+        self,
+        endpoint,
+        connect_timeout=GRAPHDB_CONNECT_TIMEOUT,
+        read_timeout=GRAPHDB_READ_TIMEOUT,
+        pool_size=GRAPHDB_POOL_SIZE,
+        max_concurrency=GRAPHDB_MAX_CONCURRENCY,
+        max_retries=GRAPHDB_MAX_RETRIES,
+        retry_backoff=GRAPHDB_RETRY_BACKOFF,
+    ):
+        self.endpoint = endpoint
+        self.timeout = (connect_timeout, read_timeout)
+
+        # SPARQL queries are read-only, so retrying POST is safe here
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=retry_backoff,
+            status_forcelist=self.RETRY_STATUSES,
+            allowed_methods=frozenset({"GET", "POST"}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry, pool_block=True)
+
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        # Runs the queries of a chunked puzzle id set side by side
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="sparql")
+
+    def query(self, sparql_query):
+        """
+        Sends a SPARQL query and returns the decoded JSON result.
+        """
+        headers = {
+            "Content-Type": "application/sparql-query",
+            "Accept": "application/json",
+        }
+        with self._slots:
+            response = self.session.post(
+                self.endpoint,
+                data=sparql_query.encode("utf-8"),
+                headers=headers,
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+            return response.json()
+
+    def query_rows(self, sparql_query):
+        """
+        Sends a SELECT query asking for TSV results and returns (variables, rows),
+        where rows lazily yields one SPARQL JSON-style binding per result line
+        as it arrives, so the full result is never held in memory.
+        """
+        headers = {
+            "Content-Type": "application/sparql-query",
+            "Accept": TSV_ACCEPT,
+        }
+        # The slot bounds queries waiting on the store; reading the body
+        # afterwards is bounded by the connection pool instead.
+        with self._slots:
+            response = self.session.post(
+                self.endpoint,
+                data=sparql_query.encode("utf-8"),
+                headers=headers,
+                timeout=self.timeout,
+                stream=True,
+            )
+            try:
+                response.raise_for_status()
+                lines = response.iter_lines(delimiter=b"\n")
+                header = next(lines, b"")
+            except BaseException:
+                # A streamed response holds its pooled connection until closed
+                response.close()
+                raise
+        variables = parse_tsv_header(header.decode("utf-8"))
+        return variables, self._iter_rows(response, lines, variables)
+
+    def _iter_rows(self, response, lines, variables):
+        try:
+            for line in lines:
+                if line:
+                    yield parse_tsv_row(variables, line.decode("utf-8"))
+        finally:
+            response.close()
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_sparql_client():
+    """
+    Returns the SPARQL client shared by every blueprint of this worker.
+    A new client is created after a fork so workers never share sockets.
+    """
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = SparqlClient(GRAPHDB_ENDPOINT)
+                _client_pid = pid
+    return _client
+
+
+def get_sparql_backend():
+    """
+    Returns what answers the service queries: the pooled GraphDB client, or the
+    embedded store when SPARQL_BACKEND is "local". Both expose query(),
+    query_rows() and an executor for chunked queries.
+    """
+    if SPARQL_BACKEND == "local":
+        return get_local_store()
+    if SPARQL_BACKEND != "http":
+        raise ValueError(f"Unknown SPARQL_BACKEND: {SPARQL_BACKEND}")
+    return get_sparql_client()
+
 
 def query_graphdb(sparql_query):
     """
-    Sends a SPARQL query to the GraphDB repository.
+    Sends a SPARQL query to the GraphDB repository (or the local store),
+    answering from the result cache when the same query was already run.
+    """
+    client = get_sparql_backend()
+    cache = get_query_cache()
+    if cache is None:
+        return client.query(sparql_query)
+    return cache.get_or_query(sparql_query, client.query)
+
+def query_graphdb_rows(sparql_query):
+    """
+    Runs a SELECT query and returns an iterator over its bindings, streamed
+    from the store as TSV. The query is sent before this function returns,
+    so connection and HTTP errors surface here rather than mid-iteration.
+    """
+    client = get_sparql_backend()
+    cache = get_query_cache()
+    if cache is None:
+        _, rows = client.query_rows(sparql_query)
+        return rows
+
+    key, version, result = cache.lookup(sparql_query)
+    if result is not None:
+        return iter(result["results"]["bindings"])
+    variables, rows = client.query_rows(sparql_query)
+    return cache_rows(cache, key, version, variables, rows)
+
+def cache_rows(cache, key, version, variables, rows):
+    """
+    Passes rows through, storing the complete result in the cache once the
+    stream is exhausted unless it grew beyond SPARQL_CACHE_MAX_ROWS.
     """
-    headers = {
-        "Content-Type": "application/sparql-query",
-        "Accept": "application/json",
-    }
-    response = requests.post(GRAPHDB_ENDPOINT, data=sparql_query, headers=headers)
-    response.raise_for_status()
-    return response.json()
+    kept = []
+    for binding in rows:
+        if kept is not None:
+            kept.append(binding)
+            if len(kept) > SPARQL_CACHE_MAX_ROWS:
+                kept = None
+        yield binding
+    if kept is not None:
+        cache.store(key, {"head": {"vars": variables}, "results": {"bindings": kept}}, version)
+
+def query_graphdb_chunks(sparql_queries, merge=concat_results):
+    """
+    Runs the queries built for each puzzle_id chunk concurrently over the
+    connection pool and combines their results with merge(results).
+    """
+    if len(sparql_queries) == 1:
+        return query_graphdb(sparql_queries[0])
+    executor = get_sparql_backend().executor
+    return merge(list(executor.map(query_graphdb, sparql_queries)))
+
+def query_graphdb_rows_chunks(sparql_queries):
+    """
+    Row-streaming counterpart of query_graphdb_chunks. Every chunk is fetched
+    concurrently and rows are yielded chunk by chunk, in puzzle_id order.
+    The first chunk is awaited before returning so its errors surface here.
+    """
+    if len(sparql_queries) == 1:
+        return query_graphdb_rows(sparql_queries[0])
+    executor = get_sparql_backend().executor
+    futures = [executor.submit(fetch_rows, sparql_query) for sparql_query in sparql_queries]
+    try:
+        first = futures[0].result()
+    except BaseException:
+        cancel_all(futures)
+        raise
+    return chain_chunks(first, futures[1:])
+
+def fetch_rows(sparql_query):
+    # Drained in the worker thread so the connection goes back to the pool at once
+    return list(query_graphdb_rows(sparql_query))
+
+def chain_chunks(first, futures):
+    try:
+        yield from first
+        for future in futures:
+            yield from future.result()
+    finally:
+        cancel_all(futures)
+
+def cancel_all(futures):
+    for future in futures:
+        future.cancel()
 
 def extract_filename(uri):
     return os.path.basename(urlparse(uri).path)
@@ -0,0 +1,217 @@
+"""
+HTTP validators and compression shared by gateway.py and async_gateway.py.
+
+The read endpoints only change when the dataset does, so their ETag is derived from the
+dataset version and the request instead of from the body: a matching If-None-Match is
+answered with 304 before any query runs. JSON bodies are compressed with brotli or gzip
+as negotiated through Accept-Encoding, streamed bodies chunk by chunk, and the compressed
+bodies of the GET endpoints are kept in an LRU cache keyed by ETag and encoding.
+"""
+import hashlib
+import zlib
+from urllib.parse import parse_qsl
+import brotli
+from config import (
+    BASE_URL,
+    COLLAPSE_DUPLICATES,
+    RESPONSE_COMPRESSION,
+    GZIP_LEVEL,
+    BROTLI_QUALITY,
+    COMPRESSED_CACHE_SIZE,
+    COMPRESSED_CACHE_MAX_BYTES,
+    SPARQL_CACHE_TTL,
+)
+from utils.query_cache import LRUCache, read_dataset_version, read_rdf_schema
+
+# GET endpoints whose body is a function of the URL and the dataset alone
+CONDITIONAL_PATHS = ("/initial", "/search", "/position")
+
+# Preferred first when the client accepts several
+ENCODINGS = ("br", "gzip")
+
+JSON_MIMETYPE = "application/json"
+# One puzzle per line, for clients that process results as they arrive
+NDJSON_MIMETYPE = "application/x-ndjson"
+COMPRESSIBLE_MIMETYPES = (JSON_MIMETYPE, NDJSON_MIMETYPE)
+
+# Responses differ by format and encoding
+VARY = "Accept, Accept-Encoding"
+
+CACHE_CONTROL = "no-cache"  # clients may keep the body but revalidate it on every use
+
+# Streamed bodies arrive in tiny pieces (one puzzle, one comma); they are compressed in
+# blocks of this many bytes, the per-call overhead otherwise doubling the cost. The first
+# piece is flushed at once so the first result is not held back.
+COMPRESSION_BLOCK = 16 * 1024
+
+
+def response_etag(path, query_string, mimetype=JSON_MIMETYPE):
+    """
+    ETag of a GET response: the dataset version and a digest of the request, of the
+    response format and of the settings shaping the body. Parameters are sorted, so their
+    order does not matter.
+    """
+    if isinstance(query_string, bytes):
+        query_string = query_string.decode("utf-8", "replace")
+    query = sorted(parse_qsl(query_string, keep_blank_values=True))
+    text = f"{path}\n{query}\n{mimetype}\n{read_rdf_schema()}\n{COLLAPSE_DUPLICATES}\n{BASE_URL}"
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()[:20]
+    return f'"{read_dataset_version()}-{digest}"'
+
+
+def encoded_etag(etag, encoding):
+    """
+    ETag of the encoded representation, e.g. "3-ab12-br" for "3-ab12"; each encoding is
+    a different body so it gets its own strong validator.
+    """
+    return etag if encoding is None else f'{etag[:-1]}-{encoding}"'
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Whether an If-None-Match header holds etag, weakly compared as RFC 9110 asks, in
+    any of its encoded variants.
+    """
+    if not if_none_match:
+        return False
+    variants = {etag} | {encoded_etag(etag, encoding) for encoding in ENCODINGS}
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") in variants:
+            return True
+    return False
+
+
+def accepted_values(header):
+    """
+    {value: quality} of an Accept or Accept-Encoding header.
+    """
+    accepted = {}
+    for item in (header or "").split(","):
+        value, _, params = item.strip().partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, number = param.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(number)
+                except ValueError:
+                    quality = 0.0
+        if value.strip():
+            accepted[value.strip().lower()] = quality
+    return accepted
+
+
+def negotiate_format(accept):
+    """
+    Response format for an Accept header: NDJSON only when the client asks for it by
+    name, the JSON array otherwise (also for */*).
+    """
+    return NDJSON_MIMETYPE if accepted_values(accept).get(NDJSON_MIMETYPE, 0.0) > 0 else JSON_MIMETYPE
+
+
+def negotiate_encoding(accept_encoding):
+    """
+    Content coding for an Accept-Encoding header: "br", "gzip" or None for the identity.
+    """
+    if not RESPONSE_COMPRESSION or not accept_encoding:
+        return None
+    accepted = accepted_values(accept_encoding)
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+class Compressor:
+    """
+    Incremental compressor of one response body.
+    """
+
+    def __init__(self, encoding):
+        if encoding == "br":
+            compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=BROTLI_QUALITY)
+            self._compress, self._flush, self._finish = compressor.process, compressor.flush, compressor.finish
+        elif encoding == "gzip":
+            # wbits 16 + 15: a zlib stream with a gzip header and trailer
+            compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self._compress, self._finish = compressor.compress, compressor.flush
+            self._flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+        else:
+            raise ValueError(f"Unsupported content coding {encoding!r}")
+
+    def compress(self, data):
+        return self._compress(data.encode("utf-8") if isinstance(data, str) else data)
+
+    def flush(self):
+        """
+        Everything compressed so far, decodable by the client before the body ends.
+        """
+        return self._flush()
+
+    def finish(self):
+        return self._finish()
+
+
+_compressed_cache = LRUCache(max_entries=COMPRESSED_CACHE_SIZE, ttl=SPARQL_CACHE_TTL)
+
+
+def cached_response(etag, encoding):
+    """
+    (compressed body, headers) kept for an ETag and encoding, or None.
+    """
+    return _compressed_cache.get((etag, encoding))
+
+
+class CompressedStream:
+    """
+    Compresses a body as it is written and, when given an ETag, keeps the result in the
+    precompressed cache once complete unless it outgrows COMPRESSED_CACHE_MAX_BYTES.
+    """
+
+    def __init__(self, encoding, etag=None, headers=None):
+        self.encoding = encoding
+        self._compressor = Compressor(encoding)
+        self._etag = etag
+        self._headers = headers
+        self._kept = [] if etag is not None else None
+        self._size = 0
+        self._pending = []
+        self._pending_size = 0
+        self._started = False
+
+    def _keep(self, data):
+        if self._kept is not None and data:
+            self._size += len(data)
+            if self._size > COMPRESSED_CACHE_MAX_BYTES:
+                self._kept = None
+            else:
+                self._kept.append(data)
+        return data
+
+    def write(self, data):
+        """
+        Compressed bytes to send for data, possibly none until a block is complete.
+        """
+        data = data.encode("utf-8") if isinstance(data, str) else data
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if not self._started:
+            self._started = True
+            return self._keep(self._compress_pending() + self._compressor.flush())
+        if self._pending_size < COMPRESSION_BLOCK:
+            return b""
+        return self._keep(self._compress_pending())
+
+    def _compress_pending(self):
+        data = self._compressor.compress(b"".join(self._pending))
+        self._pending = []
+        self._pending_size = 0
+        return data
+
+    def finish(self):
+        data = self._keep(self._compress_pending() + self._compressor.finish())
+        if self._kept is not None:
+            _compressed_cache.set((self._etag, self.encoding), (b"".join(self._kept), self._headers))
+        return data
+
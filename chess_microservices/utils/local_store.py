@@ -0,0 +1,128 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pyoxigraph import Store, RdfFormat, NamedNode, BlankNode, QuerySolutions
+from config import LOCAL_STORE_SOURCE, GRAPHDB_MAX_CONCURRENCY
+from utils.query_cache import read_dataset_version
+
+XSD_STRING = "http://www.w3.org/2001/XMLSchema#string"
+
+
+def term_to_binding(term):
+    """
+    Converts an Oxigraph term into the {"type": ..., "value": ...} shape of SPARQL JSON bindings.
+    """
+    if isinstance(term, NamedNode):
+        return {"type": "uri", "value": term.value}
+    if isinstance(term, BlankNode):
+        return {"type": "bnode", "value": term.value}
+    binding = {"type": "literal", "value": term.value}
+    if term.language:
+        binding["xml:lang"] = term.language
+    elif term.datatype.value != XSD_STRING:
+        binding["datatype"] = term.datatype.value
+    return binding
+
+
+def source_format(path):
+    """
+    RDF format of a serialized dataset from its extension (.nt, .ttl, .rdf, ...).
+    """
+    rdf_format = RdfFormat.from_extension(os.path.splitext(path)[1].lstrip("."))
+    if rdf_format is None:
+        raise ValueError(f"Unknown RDF format: {path}")
+    return rdf_format
+
+
+class LocalSparqlStore:
+    """
+    Embedded Oxigraph store answering the same queries as the GraphDB repository, in process.
+    Triples are indexed by subject, predicate and object (SPO, POS, OSP), so every
+    pattern of the service queries is an index lookup, with no network hop involved.
+    The ontology is reloaded when setup_rdf.py bumps the dataset version.
+    """
+
+    def __init__(self, source=LOCAL_STORE_SOURCE, max_concurrency=GRAPHDB_MAX_CONCURRENCY):
+        self.source = source
+        self.store = None
+        self.version = None
+        self._lock = threading.Lock()
+        # Same role as SparqlClient.executor: runs the queries of a chunked puzzle id set
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="sparql-local")
+
+    def _current_store(self):
+        version = read_dataset_version()
+        if version != self.version:
+            with self._lock:
+                if version != self.version:
+                    self.store = self.load()
+                    self.version = version
+        return self.store
+
+    def warm_up(self):
+        """
+        Loads the ontology now rather than on the first query.
+        """
+        self._current_store()
+
+    def load(self):
+        """
+        Builds a fresh store from the serialized ontology; queries keep using
+        the previous one until it is swapped in.
+        """
+        if not os.path.exists(self.source):
+            raise FileNotFoundError(f"{self.source} not found, run python -m utils.setup_rdf first")
+        store = Store()
+        store.bulk_load(path=self.source, format=source_format(self.source))
+        return store
+
+    def _solutions(self, sparql_query):
+        solutions = self._current_store().query(sparql_query)
+        if not isinstance(solutions, QuerySolutions):
+            raise ValueError("Only SELECT queries are supported by the local store")
+        return [variable.value for variable in solutions.variables], solutions
+
+    def query(self, sparql_query):
+        """
+        Runs a SELECT query and returns the result in the SPARQL JSON shape of the HTTP backend.
+        """
+        variables, rows = self.query_rows(sparql_query)
+        return {"head": {"vars": variables}, "results": {"bindings": list(rows)}}
+
+    def query_rows(self, sparql_query):
+        """
+        Same contract as SparqlClient.query_rows: (variables, lazily evaluated bindings).
+        """
+        variables, solutions = self._solutions(sparql_query)
+        return variables, self._iter_rows(variables, solutions)
+
+    def _iter_rows(self, variables, solutions):
+        for solution in solutions:
+            binding = {}
+            for name, term in zip(variables, solution):
+                if term is not None:
+                    binding[name] = term_to_binding(term)
+            yield binding
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.store = None
+
+
+_store = None
+_store_pid = None
+_store_lock = threading.Lock()
+
+
+def get_local_store():
+    """
+    Returns the embedded store of this worker, created on first use and after a fork.
+    """
+    global _store, _store_pid
+    pid = os.getpid()
+    if _store is None or _store_pid != pid:
+        with _store_lock:
+            if _store is None or _store_pid != pid:
+                _store = LocalSparqlStore()
+                _store_pid = pid
+    return _store
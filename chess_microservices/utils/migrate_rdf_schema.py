@@ -0,0 +1,118 @@
+"""
+Migrates an existing dataset between the nested and the flat RDF schema (see setup_rdf.RDF_SCHEMAS)
+with a single SPARQL Update, then records the new schema and bumps the dataset version so the
+query builders switch over and the caches are dropped.
+
+Run from chess_microservices/:
+    python -m utils.migrate_rdf_schema --to flat                  # GraphDB repository and ontology.nt
+    python -m utils.migrate_rdf_schema --to flat --target file    # ontology.nt only
+    python -m utils.migrate_rdf_schema --to nested                # back to the nested schema
+"""
+import argparse
+from pyoxigraph import Store, DefaultGraph
+from rdflib.plugins.sparql.parser import parseUpdate
+from config import GRAPHDB_UPDATE_ENDPOINT, LOCAL_STORE_SOURCE, ROOT_DIR
+from utils.graphdb_utils import get_sparql_client
+from utils.local_store import source_format
+from utils.query_cache import read_rdf_schema
+from utils.setup_rdf import RDF_SCHEMAS, bump_dataset_version, record_rdf_schema
+from utils.sparql_templates import PIECES
+
+SIDES = {"white": "_WhitePieces", "black": "_BlackPieces"}
+
+# (link to the pieces resource, nested count property, flat count property, resource suffix)
+PROPERTY_ROWS = "\n".join(
+    f'            (chess:{side}_pieces chess:{side}_pieces_{piece} chess:{side}_{piece} "{suffix}")'
+    for side, suffix in SIDES.items() for piece in PIECES
+)
+
+TO_FLAT = """
+    PREFIX chess: <http://imaginealpacas.org/chess/>
+    DELETE {
+        ?image ?link ?pieces .
+        ?pieces a chess:ChessPieceCollection .
+        ?pieces ?nested ?count .
+    }
+    INSERT { ?image ?flat ?count . }
+    WHERE {
+        VALUES (?link ?nested ?flat ?suffix) {
+""" + PROPERTY_ROWS + """
+        }
+        ?image ?link ?pieces .
+        ?pieces ?nested ?count .
+    }
+"""
+
+TO_NESTED = """
+    PREFIX chess: <http://imaginealpacas.org/chess/>
+    DELETE { ?image ?flat ?count . }
+    INSERT {
+        ?image ?link ?pieces .
+        ?pieces a chess:ChessPieceCollection .
+        ?pieces ?nested ?count .
+    }
+    WHERE {
+        VALUES (?link ?nested ?flat ?suffix) {
+""" + PROPERTY_ROWS + """
+        }
+        ?image ?flat ?count .
+        BIND(IRI(CONCAT(STR(?image), ?suffix)) AS ?pieces)
+    }
+"""
+
+MIGRATIONS = {"flat": TO_FLAT, "nested": TO_NESTED}
+
+for update in MIGRATIONS.values():
+    parseUpdate(update)
+
+
+def migrate_graphdb(update, endpoint=GRAPHDB_UPDATE_ENDPOINT):
+    """
+    Runs the update against the SPARQL Update endpoint of the GraphDB repository.
+    """
+    response = get_sparql_client().session.post(
+        endpoint,
+        data={"update": update},
+        timeout=None,  # the whole repository is rewritten in one transaction
+    )
+    response.raise_for_status()
+
+
+def migrate_file(update, path=LOCAL_STORE_SOURCE):
+    """
+    Rewrites the serialized dataset loaded by the "local" backend.
+    """
+    rdf_format = source_format(path)
+    store = Store()
+    store.bulk_load(path=path, format=rdf_format)
+    store.update(update)
+    store.dump(path, format=rdf_format, from_graph=DefaultGraph())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--to", choices=RDF_SCHEMAS, required=True, help="schema to migrate to")
+    parser.add_argument("--target", choices=("all", "graphdb", "file"), default="all",
+                        help="migrate the GraphDB repository, the local dataset file or both")
+    parser.add_argument("--endpoint", default=GRAPHDB_UPDATE_ENDPOINT, help="SPARQL Update endpoint of the repository")
+    args = parser.parse_args()
+
+    current = read_rdf_schema()
+    if current == args.to:
+        print(f"The dataset already uses the {args.to} schema")
+        return
+
+    update = MIGRATIONS[args.to]
+    if args.target in ("all", "graphdb"):
+        migrate_graphdb(update, args.endpoint)
+        print(f"Migrated {args.endpoint} from the {current} to the {args.to} schema")
+    if args.target in ("all", "file"):
+        migrate_file(update)
+        print(f"Migrated {LOCAL_STORE_SOURCE} from the {current} to the {args.to} schema")
+
+    record_rdf_schema(ROOT_DIR, args.to)
+    bump_dataset_version(ROOT_DIR)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Field projection and the compact columnar format of the puzzle listings (/search,
+/filter, /filter/game-state-rdf and /rdf-recommendations).
+
+fields names the top-level fields of the puzzle objects to return, e.g.
+"puzzle_id,filename,white_pieces". The SPARQL queries then select only the variables
+those fields read, and the piece and flag patterns binding nothing else are left out.
+
+format "compact" sends one object of columns instead of an array of objects: an array
+per field and an object of arrays for the nested ones, with ids and counts as integers
+and the castling and en passant flags as booleans:
+
+    {"count": 2, "columns": {"puzzle_id": [4, 9], "white_pieces": {"rooks": [2, 1], ...}}}
+"""
+from utils.fen import SIDES, PIECES, CASTLING_RIGHTS
+from utils.sparql_templates import KEY_VARIABLES
+
+FORMATS = ("objects", "compact")
+
+# SPARQL variables each field of a puzzle object is formatted from
+FIELD_VARIABLES = {
+    "index": (),
+    "filename": ("image",),
+    "puzzle_id": ("puzzle_id",),
+    "next_player": ("next_player",),
+    "white_pieces": tuple(f"white_{piece}" for piece in PIECES),
+    "black_pieces": tuple(f"black_{piece}" for piece in PIECES),
+    "castling": CASTLING_RIGHTS,
+    "en_passant": tuple(f"en_passant_{side}" for side in SIDES),
+    "game_state": ("computed_state",),
+    "metadata": ("image", "puzzle_id", "next_player"),
+    "has_castling": (),
+    "has_en_passant": (),
+    "dominant_feature": (),
+}
+
+# Keys of the nested fields, which become objects of columns in the compact format
+NESTED_FIELDS = {
+    "white_pieces": PIECES,
+    "black_pieces": PIECES,
+    "castling": ("white_kingside", "white_queenside", "black_kingside", "black_queenside"),
+    "en_passant": SIDES,
+}
+
+# Types of the compact columns; the other fields keep their values
+FIELD_TYPES = {
+    "index": int,
+    "puzzle_id": int,
+    "white_pieces": int,
+    "black_pieces": int,
+    "castling": bool,
+    "en_passant": bool,
+    "has_castling": bool,
+    "has_en_passant": bool,
+}
+
+
+def parse_fields(fields, allowed):
+    """
+    Reads a fields parameter, a comma-separated string or a list of names, as the
+    requested fields in the order of allowed; None when absent (every field).
+    Raises ValueError for unknown or missing names.
+    """
+    if fields is None:
+        return None
+    names = fields.split(",") if isinstance(fields, str) else fields
+    if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+        raise ValueError(f"Invalid fields: {fields!r}")
+    names = {name.strip() for name in names if name.strip()}
+    if not names:
+        raise ValueError("fields must name at least one field")
+    for name in sorted(names):
+        if name not in allowed:
+            raise ValueError(f"Invalid field {name!r}, expected one of {', '.join(allowed)}")
+    return tuple(field for field in allowed if field in names)
+
+
+def typed(value, kind):
+    """
+    A formatted (string) value as the type of its compact column; None when unreadable.
+    """
+    if kind is int:
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+    if kind is bool:
+        return value in (True, 1, "true", "1")
+    return value
+
+
+class Projection:
+    """
+    The fields and format a listing request asks for, out of the fields its service returns.
+    """
+
+    def __init__(self, fields, compact, allowed):
+        self.fields = tuple(allowed) if fields is None else fields
+        self.projected = fields is not None
+        self.compact = compact
+        self.variables = set(KEY_VARIABLES).union(*(FIELD_VARIABLES[field] for field in self.fields))
+
+    def project(self, item):
+        return {field: item[field] for field in self.fields} if self.projected else item
+
+    def columns(self, items):
+        """
+        The compact body of an iterable of puzzle objects.
+        """
+        columns = {
+            field: {key: [] for key in NESTED_FIELDS[field]} if field in NESTED_FIELDS else []
+            for field in self.fields
+        }
+        count = 0
+        for item in items:
+            count += 1
+            for field in self.fields:
+                kind = FIELD_TYPES.get(field)
+                if field in NESTED_FIELDS:
+                    for key, column in columns[field].items():
+                        column.append(typed(item[field].get(key), kind))
+                else:
+                    columns[field].append(typed(item[field], kind))
+        return {"count": count, "columns": columns}
+
+    def payload(self, items):
+        """
+        JSON body of a non-streamed listing: the compact columns or the list of objects.
+        """
+        return self.columns(items) if self.compact else [self.project(item) for item in items]
+
+
+def parse_projection(fields, response_format, allowed):
+    """
+    Projection of a request's fields and format parameters; raises ValueError for
+    malformed values.
+    """
+    response_format = response_format or "objects"
+    if response_format not in FORMATS:
+        raise ValueError(f"Invalid format {response_format!r}, expected one of {', '.join(FORMATS)}")
+    return Projection(parse_fields(fields, allowed), response_format == "compact", allowed)
@@ -0,0 +1,489 @@
+import copy
+import os
+import threading
+import time
+import numpy as np
+from config import (
+    PUZZLE_INDEX,
+    PUZZLE_INDEX_DATASET_DIR,
+    PUZZLE_INDEX_RETRY_INTERVAL,
+    INGEST_MANIFEST_FILE,
+    INGEST_ADDED_FILE,
+    COLLAPSE_DUPLICATES,
+)
+from utils.bitboards import canonical_rows, get_bitboard_store
+from utils.bitmap_index import BitmapIndex, empty_bits, bits_from_mask, bits_to_positions, popcount
+from utils.graphdb_utils import get_sparql_backend
+from utils.query_cache import read_dataset_version, read_rdf_schema
+from utils.search_query import compile_search
+from utils.fen import SIDES, PIECES, GAME_STATES, CASTLING_RIGHTS, parse_fens, game_state_codes
+from utils.setup_rdf import dataset_images
+from utils.sparql_templates import (
+    render,
+    values_block,
+    chunk_puzzle_ids,
+    piece_filter_terms,
+    puzzle_ids_to_ints,
+    check_values,
+)
+
+FLAGS = CASTLING_RIGHTS + ("en_passant_white", "en_passant_black")
+CHESS = "http://imaginealpacas.org/chess/"
+XSD_INTEGER = "http://www.w3.org/2001/XMLSchema#integer"
+XSD_BOOLEAN = "http://www.w3.org/2001/XMLSchema#boolean"
+COMPARISONS = {
+    "=": np.equal,
+    "!=": np.not_equal,
+    ">": np.greater,
+    ">=": np.greater_equal,
+    "<": np.less,
+    "<=": np.less_equal,
+}
+
+
+def puzzle_id_array(puzzle_ids):
+    """
+    Same validation as sparql_templates.puzzle_ids_to_ints, without the sort, and
+    faster for the usual lists of ints or numeric strings sent by the frontend.
+    """
+    # bool is excluded here since type(True) is not int
+    if set(map(type, puzzle_ids)) <= {int, str}:
+        try:
+            return np.fromiter(map(int, puzzle_ids), dtype=np.int64, count=len(puzzle_ids))
+        except (ValueError, OverflowError):
+            pass
+    # The slow path reports the offending id
+    return np.asarray(puzzle_ids_to_ints(puzzle_ids), dtype=np.int64)
+
+
+class PuzzleIndex:
+    """
+    Columnar copy of the per-puzzle data /search and /filter look at, one NumPy
+    array per column sorted by puzzle_id, plus a BitmapIndex over the piece counts
+    of the side to move and the game state. Filters are evaluated as bitset unions
+    and intersections with the same semantics as the SPARQL queries; the store stays
+    the source of truth. Missing values (unbound in the store) are kept as -1 and
+    get no bitset, so they never satisfy a comparison. Puzzles removed by an ingest
+    keep their position but are no longer present: they match nothing.
+    """
+
+    def __init__(self, puzzle_ids, images, sides, counts, flags):
+        self.puzzle_ids = np.zeros(0, dtype=np.int64)
+        self.images = np.zeros(0, dtype=object)
+        self.sides = np.zeros(0, dtype=np.int8)  # index into SIDES, -1 if unknown
+        self.counts = np.zeros((0, len(SIDES), len(PIECES)), dtype=np.int16)
+        self.flags = np.zeros((0, len(FLAGS)), dtype=np.int8)
+        self.total_pieces = np.zeros(0, dtype=np.int64)
+        self.game_states = np.zeros(0, dtype=np.int8)  # index into GAME_STATES
+        self.present = np.zeros(0, dtype=bool)  # False once removed
+        self.bitmaps = BitmapIndex()
+        self.add_puzzles(puzzle_ids, images, sides, counts, flags)
+
+    def add_puzzles(self, puzzle_ids, images, sides, counts, flags):
+        """
+        Appends newly ingested puzzles, indexing only them. Their ids must all be
+        greater than the indexed ones, otherwise the index has to be rebuilt.
+        """
+        order = np.argsort(np.asarray(puzzle_ids, dtype=np.int64), kind="stable")
+        puzzle_ids = np.asarray(puzzle_ids, dtype=np.int64)[order]
+        if len(puzzle_ids) and len(self) and puzzle_ids[0] <= self.puzzle_ids[-1]:
+            raise ValueError("New puzzle ids must follow the indexed ones, rebuild the index instead")
+        sides = np.asarray(sides, dtype=np.int8)[order]
+        counts = np.asarray(counts, dtype=np.int16).reshape(-1, len(SIDES), len(PIECES))[order]
+
+        # Pieces of the side to move, the only ones the filters compare
+        side_counts = counts[np.arange(len(puzzle_ids)), np.maximum(sides, 0)]
+        to_move = np.where(sides[:, None] >= 0, side_counts, -1)
+
+        # Same classification as setup_rdf.game_state_for, missing counts add 0
+        total_pieces = np.maximum(counts, 0).sum(axis=(1, 2))
+        game_states = game_state_codes(total_pieces)
+
+        # Columns first: readers only see positions once the bitmaps are extended
+        self.puzzle_ids = np.concatenate([self.puzzle_ids, puzzle_ids])
+        self.images = np.concatenate([self.images, np.asarray(images, dtype=object)[order]])
+        self.sides = np.concatenate([self.sides, sides])
+        self.counts = np.concatenate([self.counts, counts])
+        self.flags = np.concatenate([self.flags, np.asarray(flags, dtype=np.int8).reshape(-1, len(FLAGS))[order]])
+        self.total_pieces = np.concatenate([self.total_pieces, total_pieces])
+        self.game_states = np.concatenate([self.game_states, game_states])
+        self.present = np.concatenate([self.present, np.ones(len(puzzle_ids), dtype=bool)])
+        self.bitmaps.add(sides, to_move, labels=[("game_state", game_states)])
+
+    def remove_puzzles(self, puzzle_ids):
+        """
+        Drops puzzles an ingest removed: they keep their position, cleared from every
+        bitset.
+        """
+        size = len(self)
+        ids = np.asarray(puzzle_ids, dtype=np.int64)
+        if not size or not len(ids):
+            return
+        positions = np.searchsorted(self.puzzle_ids[:size], ids).clip(max=size - 1)
+        positions = positions[self.puzzle_ids[positions] == ids]
+        self.present[positions] = False
+        self.bitmaps.remove(positions)
+
+    def copy(self):
+        """
+        Copy to update while this index keeps serving requests. add_puzzles replaces
+        the columns instead of writing to them, so only present and the bitmaps, which
+        remove_puzzles clears in place, are duplicated.
+        """
+        updated = copy.copy(self)
+        updated.present = self.present.copy()
+        updated.bitmaps = self.bitmaps.copy()
+        return updated
+
+    def __len__(self):
+        return self.bitmaps.size
+
+    def indexed_ids(self):
+        """
+        Ids of the puzzles present in the index, sorted.
+        """
+        return self.puzzle_ids[:len(self)][self.present[:len(self)]]
+
+    @classmethod
+    def from_bindings(cls, bindings):
+        """
+        Builds the index from the rows of the "search" template run without conditions.
+        """
+        return cls(*columns_from_bindings(bindings))
+
+    @classmethod
+    def from_fen_filenames(cls, dataset_dir, manifest_path=INGEST_MANIFEST_FILE):
+        """
+        Builds the index straight from the FEN image filenames, with the puzzle ids
+        setup_rdf.prepare_rdf_dataset gave them. Duplicate positions are left out when
+        COLLAPSE_DUPLICATES is set, as the "store" source does.
+        """
+        ingested = dataset_images(dataset_dir, manifest_path)
+        puzzle_ids = np.array([puzzle_id for puzzle_id, _ in ingested], dtype=np.int64)
+        file_names = [file_name for _, file_name in ingested]
+        boards = parse_fens(file_names)
+        keep = np.ones(len(ingested), dtype=bool)
+        if COLLAPSE_DUPLICATES:
+            keep = canonical_rows(boards.zobrist_hashes(), boards.bitboards()) == np.arange(len(ingested))
+        return cls(*(column[keep] for column in columns_from_boards(puzzle_ids, file_names, boards)))
+
+    # ---------- Bitsets ----------
+
+    def all_bits(self):
+        return bits_from_mask(self.present[:len(self)])
+
+    def _mask_bits(self, mask):
+        # Masks computed on the columns still cover the removed puzzles
+        return bits_from_mask(mask & self.present[:len(self)])
+
+    def search_bits(self, query):
+        """
+        Puzzles matching a /search string, see utils.search_query.
+        """
+        return compile_search(query).index_bits(self)
+
+    def count_bits(self, side, piece, operator, count):
+        """
+        Puzzles with `operator count` pieces of a kind for one side, or for the side
+        to move when side is None. Missing counts never match.
+        """
+        if side is None:
+            return self.bitmaps.count_bits(PIECES.index(piece), operator, count)
+        column = self.counts[:len(self), SIDES.index(side), PIECES.index(piece)]
+        return self._mask_bits((column >= 0) & COMPARISONS[operator](column, count))
+
+    def right_bits(self, side, right, value):
+        """
+        Puzzles where one side, or the side to move when side is None, has (value True)
+        or lacks a castling or en passant right. "castling" is either castling right;
+        lacking it means lacking both. Missing flags never match.
+        """
+        if side is not None:
+            return self._mask_bits(self._right_mask(side, right, value))
+        sides = self.sides[:len(self)]
+        mask = np.zeros(len(self), dtype=bool)
+        for side_index, side in enumerate(SIDES):
+            mask |= (sides == side_index) & self._right_mask(side, right, value)
+        return self._mask_bits(mask)
+
+    def _right_mask(self, side, right, value):
+        flags = self.flags[:len(self)]
+        if right == "en_passant":
+            return flags[:, FLAGS.index(f"en_passant_{side}")] == value
+        if right == "castling":
+            kingside = flags[:, FLAGS.index(f"{side}_castling_kingside")]
+            queenside = flags[:, FLAGS.index(f"{side}_castling_queenside")]
+            if value:
+                return (kingside == 1) | (queenside == 1)
+            return (kingside == 0) & (queenside == 0)
+        return flags[:, FLAGS.index(f"{side}_castling_{right}")] == value
+
+    def side_bits(self, side, negated=False):
+        """
+        Puzzles with (or, negated, without) the given side to move; an unknown side to
+        move matches neither.
+        """
+        sides = self.sides[:len(self)]
+        matches = sides != SIDES.index(side) if negated else sides == SIDES.index(side)
+        return self._mask_bits((sides >= 0) & matches)
+
+    def piece_filter_bits(self, filters):
+        """
+        Puzzles matching the FilterPanel piece filters, see build_piece_filter_queries.
+        """
+        bits = self.all_bits()
+        for piece, counts in piece_filter_terms(filters):
+            if piece is None:
+                return empty_bits(len(self))
+            matches = empty_bits(len(self))
+            for operator, count in counts:
+                matches |= self.bitmaps.count_bits(PIECES.index(piece), operator, count)
+            bits &= matches
+        return bits
+
+    def game_state_bits(self, game_states):
+        check_values(game_states, GAME_STATES)
+        if not game_states:
+            return self.all_bits()
+        return self.bitmaps.label_bits("game_state", [GAME_STATES.index(state) for state in game_states])
+
+    def id_bits(self, puzzle_ids):
+        """
+        The given puzzle ids, the counterpart of a VALUES block.
+        """
+        return self.array_id_bits(puzzle_id_array(puzzle_ids))
+
+    def array_id_bits(self, ids):
+        """
+        id_bits for an int64 array of already validated ids.
+        """
+        size = len(self)
+        indexed = self.puzzle_ids[:size]
+        mask = np.zeros(size, dtype=bool)
+        if size and len(ids):
+            positions = np.searchsorted(indexed, ids).clip(max=size - 1)
+            mask[positions[indexed[positions] == ids]] = True
+        return self._mask_bits(mask)
+
+    # ---------- Queries ----------
+
+    def filter_pieces_bits(self, filters, puzzle_ids):
+        """
+        Puzzles of /filter without game states; raises ValueError for malformed input.
+        """
+        return self.id_bits(puzzle_ids) & self.piece_filter_bits(filters)
+
+    def filter_game_state_bits(self, puzzle_ids, game_states):
+        """
+        Puzzles of /filter/game-state-rdf; raises ValueError for malformed input.
+        """
+        return self.id_bits(puzzle_ids) & self.game_state_bits(game_states)
+
+    def count(self, bits):
+        return popcount(bits)
+
+    def rows(self, bits, with_game_state=False, after=None, limit=None, variables=None):
+        """
+        Bindings of the selected puzzles in puzzle_id order, shaped like the SPARQL
+        results so the existing row formatters can be reused. after and limit select
+        a page as the paginated templates do (puzzle_id > after, limit + 1 rows), and
+        variables the piece counts and flags to bind (all of them when None).
+        """
+        positions = bits_to_positions(bits, len(self))
+        if after is not None:
+            # Positions follow puzzle_id order, so the cursor is a binary search away
+            start = np.searchsorted(self.puzzle_ids, after, side="right")
+            positions = positions[np.searchsorted(positions, start):]
+        if limit is not None:
+            positions = positions[:limit + 1]
+        return self._iter_rows(positions, with_game_state, variables)
+
+    def _iter_rows(self, positions, with_game_state, variables):
+        # Columns are converted to Python lists once instead of boxing every NumPy scalar
+        columns = zip(
+            self.puzzle_ids[positions].tolist(),
+            self.images[positions].tolist(),
+            self.sides[positions].tolist(),
+            self.counts[positions].reshape(-1, len(SIDES) * len(PIECES)).tolist(),
+            self.flags[positions].tolist(),
+            self.total_pieces[positions].tolist(),
+            self.game_states[positions].tolist(),
+        )
+        names = [f"{side}_{piece}" for side in SIDES for piece in PIECES]
+        # Columns left out of the projection stay unbound, as in the projected SPARQL results
+        names = [name if variables is None or name in variables else None for name in names]
+        flag_names = [name if variables is None or name in variables else None for name in FLAGS]
+        for puzzle_id, image, side, counts, flags, total_pieces, game_state in columns:
+            binding = {
+                "image": {"type": "uri", "value": image},
+                "puzzle_id": {"type": "literal", "value": str(puzzle_id), "datatype": XSD_INTEGER},
+            }
+            if side >= 0:
+                binding["next_player"] = {"type": "literal", "value": SIDES[side]}
+            for name, count in zip(names, counts):
+                if name is not None and count >= 0:
+                    binding[name] = {"type": "literal", "value": str(count), "datatype": XSD_INTEGER}
+            for name, flag in zip(flag_names, flags):
+                if name is not None and flag >= 0:
+                    binding[name] = {"type": "literal", "value": "true" if flag else "false", "datatype": XSD_BOOLEAN}
+            if with_game_state:
+                binding["total_pieces"] = {"type": "literal", "value": str(total_pieces), "datatype": XSD_INTEGER}
+                binding["computed_state"] = {"type": "literal", "value": GAME_STATES[game_state]}
+            yield binding
+
+
+def columns_from_bindings(bindings):
+    """
+    PuzzleIndex columns (puzzle ids, images, sides, counts, flags) of rows of the "search"
+    template.
+    """
+    puzzle_ids, images, sides, counts, flags = [], [], [], [], []
+    for binding in bindings:
+        puzzle_ids.append(int(binding["puzzle_id"]["value"]))
+        images.append(binding["image"]["value"])
+        next_player = binding.get("next_player", {}).get("value")
+        sides.append(SIDES.index(next_player) if next_player in SIDES else -1)
+        counts.append([
+            int(binding[f"{side}_{piece}"]["value"]) if f"{side}_{piece}" in binding else -1
+            for side in SIDES for piece in PIECES
+        ])
+        flags.append([
+            int(binding[flag]["value"] in ("true", "1")) if flag in binding else -1
+            for flag in FLAGS
+        ])
+    return (
+        np.array(puzzle_ids, dtype=np.int64),
+        np.array(images, dtype=object),
+        np.array(sides, dtype=np.int8),
+        np.array(counts, dtype=np.int16).reshape(-1, len(SIDES), len(PIECES)),
+        np.array(flags, dtype=np.int8).reshape(-1, len(FLAGS)),
+    )
+
+
+def columns_from_boards(puzzle_ids, file_names, boards):
+    """
+    PuzzleIndex columns of parsed FEN image filenames.
+    """
+    images = np.array([CHESS + file_name for file_name in file_names], dtype=object)
+    flags = np.hstack([boards.castling, boards.en_passant])
+    return np.asarray(puzzle_ids, dtype=np.int64), images, boards.sides, boards.counts, flags
+
+
+def load_puzzle_index(source):
+    if source == "store":
+        _, rows = get_sparql_backend().query_rows(render("search", puzzle_values="", conditions=""))
+        return PuzzleIndex.from_bindings(rows)
+    if source == "fen":
+        return PuzzleIndex.from_fen_filenames(PUZZLE_INDEX_DATASET_DIR)
+    raise ValueError(f"Unknown PUZZLE_INDEX: {source}")
+
+
+def ingested_puzzle_ids():
+    """
+    Ids of the puzzles the index holds after the last ingest, from its bitboards: the
+    images that passed validation, without the duplicate positions when
+    COLLAPSE_DUPLICATES is set.
+    """
+    store = get_bitboard_store()
+    if COLLAPSE_DUPLICATES:
+        return store.puzzle_ids[store.canonical == np.arange(len(store))]
+    return store.puzzle_ids
+
+
+def load_new_puzzles(source, puzzle_ids):
+    """
+    Columns of newly ingested puzzles, as add_puzzles takes them.
+    """
+    if source == "store":
+        bindings = []
+        for chunk in chunk_puzzle_ids(puzzle_ids.tolist()):
+            _, rows = get_sparql_backend().query_rows(
+                render("search", puzzle_values=values_block("puzzle_id", chunk), conditions="")
+            )
+            bindings.extend(rows)
+        return columns_from_bindings(bindings)
+    if source == "fen":
+        store = get_bitboard_store()
+        file_names = store.file_names[np.searchsorted(store.puzzle_ids, puzzle_ids)].tolist()
+        return columns_from_boards(puzzle_ids, file_names, parse_fens(file_names))
+    raise ValueError(f"Unknown PUZZLE_INDEX: {source}")
+
+
+def update_puzzle_index(index, source):
+    """
+    The index brought to the last ingest: a copy of it without the puzzles the store
+    no longer has and with only the new ones indexed, so requests keep reading the
+    current index until the update is complete. Comparing ids rather than reading the
+    delta files also catches up on several ingests at once. Returns None when a new
+    id does not follow the indexed ones (a duplicate whose original was removed),
+    which takes a rebuild.
+    """
+    current = ingested_puzzle_ids()
+    indexed = index.indexed_ids()
+    added = np.setdiff1d(current, indexed)
+    if len(added) and len(index) and added[0] <= index.puzzle_ids[len(index) - 1]:
+        return None
+    removed = np.setdiff1d(indexed, current)
+    new_puzzles = load_new_puzzles(source, added)
+    updated = index.copy()
+    updated.remove_puzzles(removed)
+    updated.add_puzzles(*new_puzzles)
+    print(f"Puzzle index updated: {len(added)} puzzles added, {len(removed)} removed")
+    return updated
+
+
+def refresh_puzzle_index(index, schema):
+    """
+    The index of the current dataset: index updated after an incremental ingest on
+    the schema it was built from; a full rebuild after a full ingest or a schema
+    change. index itself is never modified.
+    """
+    incremental = os.path.exists(INGEST_ADDED_FILE)
+    if index is not None and incremental and schema == _index_state["schema"]:
+        updated = update_puzzle_index(index, PUZZLE_INDEX)
+        if updated is not None:
+            return updated
+    return load_puzzle_index(PUZZLE_INDEX)
+
+
+_index_lock = threading.Lock()
+_index_state = {"version": None, "index": None, "schema": None, "failed_at": None}
+
+
+def _backing_off():
+    failed_at = _index_state["failed_at"]
+    return failed_at is not None and time.monotonic() - failed_at < PUZZLE_INDEX_RETRY_INTERVAL
+
+
+def get_puzzle_index():
+    """
+    Returns the puzzle index, updated or rebuilt whenever the dataset version changes.
+    Returns None when PUZZLE_INDEX is disabled or the index cannot be built,
+    in which case the services fall back to SPARQL. A failed build is retried
+    at most every PUZZLE_INDEX_RETRY_INTERVAL seconds, so requests do not queue
+    behind a rebuild while the store is down.
+    """
+    if PUZZLE_INDEX is None:
+        return None
+    version = read_dataset_version()
+    if version != _index_state["version"]:
+        if _backing_off():
+            return None
+        with _index_lock:
+            if version != _index_state["version"]:
+                # Requests that waited for the lock must not retry a build that just failed
+                if _backing_off():
+                    return None
+                try:
+                    schema = read_rdf_schema()
+                    _index_state["index"] = refresh_puzzle_index(_index_state["index"], schema)
+                except Exception as e:
+                    _index_state["failed_at"] = time.monotonic()
+                    print(f"Error building the puzzle index, retried in {PUZZLE_INDEX_RETRY_INTERVAL}s: {e}")
+                    return None
+                _index_state["version"] = version
+                _index_state["schema"] = schema
+                _index_state["failed_at"] = None
+                index = _index_state["index"]
+                print(f"Puzzle index ready: {index.count(index.all_bits())} puzzles")
+    return _index_state["index"]
@@ -0,0 +1,267 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from config import (
+    DATASET_VERSION_FILE,
+    RDF_SCHEMA_FILE,
+    SPARQL_CACHE_BACKEND,
+    SPARQL_CACHE_SIZE,
+    SPARQL_CACHE_TTL,
+    SPARQL_CACHE_PATH,
+)
+
+
+def normalize_query(sparql_query):
+    """
+    Collapses whitespace so formatting differences map to the same cache key.
+    """
+    return " ".join(sparql_query.split())
+
+
+_marker_lock = threading.Lock()
+_marker_state = {}
+
+
+def read_marker_file(path, default):
+    """
+    Returns the stripped content of a small dataset marker file, or default when it is missing or empty.
+    The file is only re-read when its modification time changes.
+    """
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return default
+
+    with _marker_lock:
+        cached = _marker_state.get(path)
+        if cached is None or cached[0] != mtime:
+            with open(path, encoding="utf-8") as f:
+                cached = (mtime, f.read().strip() or default)
+            _marker_state[path] = cached
+        return cached[1]
+
+
+def read_dataset_version():
+    """
+    Returns the dataset version written by setup_rdf.prepare_rdf_dataset.
+    """
+    return read_marker_file(DATASET_VERSION_FILE, "0")
+
+
+def read_rdf_schema():
+    """
+    Returns the RDF schema of the loaded dataset; datasets written before the flat schema existed are nested.
+    """
+    return read_marker_file(RDF_SCHEMA_FILE, "nested")
+
+
+class LRUCache:
+    """
+    In-process LRU cache with a per-entry time to live.
+    """
+
+    def __init__(self, max_entries=SPARQL_CACHE_SIZE, ttl=SPARQL_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, version=None):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self, version=None):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SqliteCache:
+    """
+    On-disk cache shared by every worker on the host.
+    Entries are tagged with the dataset version so stale ones can be purged.
+    """
+
+    def __init__(self, path=SPARQL_CACHE_PATH, max_entries=SPARQL_CACHE_SIZE, ttl=SPARQL_CACHE_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sparql_cache ("
+                " key TEXT PRIMARY KEY, version TEXT, expires_at REAL, used_at REAL, value TEXT)"
+            )
+
+    def _connection(self):
+        # sqlite3 connections cannot be shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        now = time.time()
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT value FROM sparql_cache WHERE key = ? AND expires_at >= ?", (key, now)
+        ).fetchone()
+        if row is None:
+            return None
+        with conn:
+            conn.execute("UPDATE sparql_cache SET used_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key, value, version=None):
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sparql_cache VALUES (?, ?, ?, ?, ?)",
+                (key, version, now + self.ttl, now, json.dumps(value)),
+            )
+            conn.execute(
+                "DELETE FROM sparql_cache WHERE key IN ("
+                " SELECT key FROM sparql_cache ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def clear(self, version=None):
+        with self._connection() as conn:
+            if version is None:
+                conn.execute("DELETE FROM sparql_cache")
+            else:
+                conn.execute("DELETE FROM sparql_cache WHERE version != ?", (version,))
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM sparql_cache").fetchone()[0]
+
+
+class QueryCache:
+    """
+    Caches SPARQL results keyed on the normalized query text and the dataset version.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _check_version(self):
+        version = read_dataset_version()
+        if version != self._version:
+            with self._lock:
+                if version != self._version:
+                    self.backend.clear(version)
+                    self._version = version
+        return version
+
+    def key_for(self, sparql_query, version):
+        text = f"{version}\n{normalize_query(sparql_query)}"
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def lookup(self, sparql_query):
+        """
+        Returns (key, version, result); result is None on a miss.
+        """
+        version = self._check_version()
+        key = self.key_for(sparql_query, version)
+
+        result = self.backend.get(key)
+        with self._lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return key, version, result
+
+    def get_or_query(self, sparql_query, fetch):
+        """
+        Returns the cached result for the query, calling fetch(sparql_query) on a miss.
+        """
+        key, version, result = self.lookup(sparql_query)
+        if result is None:
+            result = fetch(sparql_query)
+            self.store(key, result, version)
+        return result
+
+    def store(self, key, result, version):
+        self.backend.set(key, result, version)
+
+    async def aget_or_query(self, sparql_query, fetch):
+        """
+        Same as get_or_query for a coroutine fetch(sparql_query).
+        """
+        key, version, result = self.lookup(sparql_query)
+        if result is None:
+            result = await fetch(sparql_query)
+            self.store(key, result, version)
+        return result
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            "backend": type(self.backend).__name__,
+            "dataset_version": self._version,
+            "entries": len(self.backend),
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": round(hits / total, 4) if total else 0.0,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_query_cache():
+    """
+    Returns the configured cache, or None when SPARQL_CACHE_BACKEND disables it.
+    """
+    global _cache
+    if SPARQL_CACHE_BACKEND is None:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                if SPARQL_CACHE_BACKEND == "disk":
+                    backend = SqliteCache()
+                elif SPARQL_CACHE_BACKEND == "memory":
+                    backend = LRUCache()
+                else:
+                    raise ValueError(f"Unknown SPARQL_CACHE_BACKEND: {SPARQL_CACHE_BACKEND}")
+                _cache = QueryCache(backend)
+    return _cache
+
+
+def cache_stats():
+    cache = get_query_cache()
+    if cache is None:
+        return {"backend": None}
+    return cache.stats()
@@ -0,0 +1,205 @@
+from itertools import islice
+from flask import Response, current_app, g, jsonify, request, stream_with_context
+from config import PAGE_DEFAULT_LIMIT, PAGE_MAX_LIMIT, COMPRESSION_MIN_SIZE
+from utils.http_cache import (
+    CONDITIONAL_PATHS,
+    CACHE_CONTROL,
+    COMPRESSIBLE_MIMETYPES,
+    JSON_MIMETYPE,
+    NDJSON_MIMETYPE,
+    VARY,
+    CompressedStream,
+    cached_response,
+    encoded_etag,
+    etag_matches,
+    negotiate_encoding,
+    negotiate_format,
+    response_etag,
+)
+
+_END = object()
+
+# Number of results, sent when it is known before streaming (answers from the puzzle index)
+TOTAL_COUNT_HEADER = "X-Total-Count"
+
+# puzzle_id to pass as "after" for the next page, absent on the last one
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+# Headers replayed with a body served from the precompressed cache
+CACHED_HEADERS = ("Content-Type", TOTAL_COUNT_HEADER, NEXT_CURSOR_HEADER)
+
+
+def parse_page(after, limit):
+    """
+    Reads the keyset pagination parameters of a request as (after, limit): both None when
+    neither is given (the whole result), otherwise limit defaults to PAGE_DEFAULT_LIMIT.
+    Raises ValueError for malformed values.
+    """
+    if after is None and limit is None:
+        return None, None
+    after = None if after is None else page_int("after", after)
+    limit = PAGE_DEFAULT_LIMIT if limit is None else page_int("limit", limit)
+    if not 1 <= limit <= PAGE_MAX_LIMIT:
+        raise ValueError(f"Invalid limit {limit}, expected 1 to {PAGE_MAX_LIMIT}")
+    return after, limit
+
+
+def page_int(name, value):
+    # Query string values arrive as strings, JSON body values as numbers
+    if isinstance(value, bool):
+        raise ValueError(f"Invalid {name}: {value!r}")
+    try:
+        return int(str(value).strip())
+    except ValueError:
+        raise ValueError(f"Invalid {name}: {value!r}") from None
+
+
+def page_rows(rows, limit):
+    """
+    Cuts the rows of a paginated query (fetched with one extra row, see limit_clause) to the
+    page and returns (rows, headers) with the next cursor. Rows pass through when limit is None.
+    """
+    if limit is None:
+        return rows, {}
+    page = list(islice(rows, limit + 1))
+    if len(page) > limit and hasattr(rows, "close"):
+        # Reaching the end of a single LIMITed query lets the query cache keep it;
+        # the chunks not needed for this page are then stopped
+        next(rows, None)
+        rows.close()
+    if len(page) <= limit:
+        return page, {}
+    return page[:limit], {NEXT_CURSOR_HEADER: page[limit - 1]["puzzle_id"]["value"]}
+
+
+def format_rows(rows, format_row):
+    """
+    Lazily applies a service's format_*_row(binding, index) to streamed bindings.
+    """
+    return (format_row(binding, index) for index, binding in enumerate(rows, 1))
+
+
+def stream_json_array(items, headers=None):
+    """
+    Writes an iterable of puzzle objects as a JSON array, one item at a time,
+    so memory stays flat no matter how many rows the query returns.
+    The first item is pulled before the response starts, so a failing
+    query still ends up in the caller's error handling.
+    """
+    items = iter(items)
+    first = next(items, _END)
+    dumps = current_app.json.dumps
+
+    def generate():
+        if first is _END:
+            yield "[]\n"
+            return
+        # The first item goes out with the bracket, in the first (flushed) compressed block
+        yield "[" + dumps(first)
+        for item in items:
+            yield ","
+            yield dumps(item)
+        yield "]\n"
+
+    return Response(stream_with_context(generate()), mimetype=JSON_MIMETYPE, headers=headers)
+
+
+def stream_ndjson(items, headers=None):
+    """
+    Writes an iterable of puzzle objects as newline-delimited JSON, one puzzle per line,
+    each line going out as soon as its row comes from the SPARQL client. As for
+    stream_json_array, the first item is pulled before the response starts.
+    """
+    items = iter(items)
+    first = next(items, _END)
+    dumps = current_app.json.dumps
+
+    def generate():
+        if first is _END:
+            return
+        yield dumps(first) + "\n"
+        for item in items:
+            yield dumps(item) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE, headers=headers)
+
+
+def stream_results(items, headers=None, projection=None):
+    """
+    Streams the puzzles as NDJSON when the request asks for application/x-ndjson in
+    Accept, as a JSON array otherwise. With a projection (see utils.projection), only
+    the requested fields are sent, or the compact columns, which are not streamed.
+    """
+    if projection is not None:
+        if projection.compact:
+            response = jsonify(projection.columns(items))
+            response.headers.update(headers or {})
+            return response
+        items = map(projection.project, items)
+    if negotiate_format(request.headers.get("Accept")) == NDJSON_MIMETYPE:
+        return stream_ndjson(items, headers)
+    return stream_json_array(items, headers)
+
+
+def conditional_request():
+    """
+    before_request hook of the GET read endpoints: answers 304 when If-None-Match holds
+    the ETag of the current dataset, or the precompressed body when one is cached,
+    before the endpoint runs any query.
+    """
+    if request.method != "GET" or request.path not in CONDITIONAL_PATHS:
+        return None
+    g.etag = response_etag(request.path, request.query_string, negotiate_format(request.headers.get("Accept")))
+    g.encoding = negotiate_encoding(request.headers.get("Accept-Encoding"))
+    headers = {"ETag": encoded_etag(g.etag, g.encoding), "Cache-Control": CACHE_CONTROL, "Vary": VARY}
+    if etag_matches(request.headers.get("If-None-Match"), g.etag):
+        return Response(status=304, headers=headers)
+    cached = cached_response(g.etag, g.encoding) if g.encoding else None
+    if cached is not None:
+        body, cached_headers = cached
+        return Response(body, headers={**cached_headers, **headers, "Content-Encoding": g.encoding})
+    return None
+
+
+def compress_response(response):
+    """
+    after_request hook: adds the ETag of the GET read endpoints and compresses JSON and
+    NDJSON bodies in the negotiated encoding, streamed ones chunk by chunk as they are written.
+    """
+    if (response.status_code != 200 or response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or "Content-Encoding" in response.headers):
+        return response
+    etag = g.get("etag")
+    encoding = g.encoding if etag else negotiate_encoding(request.headers.get("Accept-Encoding"))
+    response.vary.update(header.strip() for header in VARY.split(","))
+    if encoding is not None and not response.is_streamed and (response.content_length or 0) < COMPRESSION_MIN_SIZE:
+        encoding = None
+    if etag:
+        response.headers["ETag"] = encoded_etag(etag, encoding)
+        response.headers["Cache-Control"] = CACHE_CONTROL
+    if encoding is None:
+        return response
+
+    kept = {name: response.headers[name] for name in CACHED_HEADERS if name in response.headers}
+    stream = CompressedStream(encoding, etag, kept)
+    if response.is_streamed:
+        chunks, body = response.iter_encoded(), response.response
+
+        def generate():
+            try:
+                for chunk in chunks:
+                    data = stream.write(chunk)
+                    if data:
+                        yield data
+                yield stream.finish()
+            finally:
+                # Closing the response still stops the query behind the body
+                if hasattr(body, "close"):
+                    body.close()
+
+        response.response = generate()
+        response.headers.pop("Content-Length", None)
+    else:
+        response.set_data(stream.write(response.get_data()) + stream.finish())
+    response.headers["Content-Encoding"] = encoding
+    return response
@@ -0,0 +1,284 @@
+"""
+The /search query language. A query is a list of whitespace-separated terms, all of
+which must hold:
+
+    rooks, rook            more than one / exactly one rook for the side to move
+    2 rooks, 2+ rooks      exactly / at least two; also =2, !=2, >2, >=2, <2 and <=2
+    no queens              no queen for the side to move
+    white rooks            the pieces of one side instead of the side to move's
+    white, black           the side to move
+    opening, midgame, endgame    the game state (several are alternatives)
+    castling, kingside, queenside, en_passant
+                           rights of the side to move, or of one side ("black castling")
+    white_knight:f3        square terms, see utils.bitboards.square_terms
+
+"no" or "not" negates the term that follows. A side word only qualifies a piece or a
+right right after it: "white rooks" counts white's rooks, "rooks white" asks for white
+to move. A word outside the language matches nothing, so the result is empty.
+
+Queries are parsed into terms and normalized: terms are written in one canonical form,
+sorted and deduplicated. The SearchPlan compiled from a normalized query is kept in an
+LRU cache and runs either as SPARQL on the "search" template or on the PuzzleIndex.
+"""
+import re
+from collections import namedtuple
+from config import SEARCH_PLAN_CACHE_SIZE
+from utils.bitboards import square_terms, get_bitboard_store
+from utils.bitmap_index import empty_bits
+from utils.fen import SIDES, PIECES, GAME_STATES
+from utils.query_cache import LRUCache
+from utils.sparql_templates import (
+    render,
+    to_move_count,
+    values_block,
+    chunk_puzzle_ids,
+    after_condition,
+    limit_clause,
+    string_list,
+    NO_MATCH,
+)
+
+# side is None for the side to move
+Count = namedtuple("Count", "side piece operator count")
+Right = namedtuple("Right", "side right value")
+GameState = namedtuple("GameState", "state negated")
+SideToMove = namedtuple("SideToMove", "side negated")
+Square = namedtuple("Square", "term")
+Unknown = namedtuple("Unknown", "word")
+
+RIGHTS = ("castling", "kingside", "queenside", "en_passant")
+NEGATIONS = ("no", "not")
+NEGATED_OPERATORS = {"=": "!=", "!=": "=", ">": "<=", ">=": "<", "<": ">=", "<=": ">"}
+COUNT_PATTERN = re.compile(r"(<=|>=|!=|<|>|=)?(\d+)(\+?)")
+TRUE_VALUES = '("true", "1")'
+FALSE_VALUES = '("false", "0")'
+
+# Terms that qualify what follows come last in a normalized query, so a side to move
+# never reads as the side of the next term
+TERM_ORDER = (Count, Right, GameState, Square, Unknown, SideToMove)
+
+
+def piece_word(word):
+    """
+    The PIECES entry of a singular or plural piece word, or None.
+    """
+    piece = word if word.endswith("s") else word + "s"
+    return piece if piece in PIECES else None
+
+
+def parse_count(word):
+    """
+    (operator, count) of a count word such as "2", "2+" or ">=2", or None.
+    """
+    match = COUNT_PATTERN.fullmatch(word)
+    if match is None or (match[1] and match[3]):
+        return None
+    operator = ">=" if match[3] else match[1] or "="
+    return operator, int(match[2])
+
+
+def parse_search(query):
+    """
+    Terms of a lower-cased search string, see the module docstring.
+    """
+    words = query.split()
+    terms = []
+    position = 0
+
+    def peek(offset=0):
+        return words[position + offset] if position + offset < len(words) else None
+
+    while position < len(words):
+        start = position
+        negated = peek() in NEGATIONS
+        position += negated
+        count = parse_count(peek() or "")
+        position += count is not None
+        side = None
+        if peek() in SIDES and (piece_word(peek(1) or "") or peek(1) in RIGHTS):
+            side = peek()
+            position += 1
+        word = peek()
+        position += 1
+
+        if word is not None and piece_word(word):
+            piece = piece_word(word)
+            if count is not None:
+                operator, number = count
+            elif negated:
+                operator, number, negated = "=", 0, False
+            else:
+                # Bare words, as the search box always read them
+                operator, number = (">", 1) if word.endswith("s") else ("=", 1)
+            if negated:
+                operator = NEGATED_OPERATORS[operator]
+            terms.append(Count(side, piece, operator, number))
+        elif count is not None or word is None:
+            terms.append(Unknown(" ".join(words[start:position])))
+        elif word in RIGHTS:
+            terms.append(Right(side, word, not negated))
+        elif word in SIDES:
+            terms.append(SideToMove(word, negated))
+        elif word in GAME_STATES:
+            terms.append(GameState(word, negated))
+        elif ":" in word and not negated:
+            terms.append(Square(word))
+        else:
+            terms.append(Unknown(" ".join(words[start:position])))
+    return terms
+
+
+def term_text(term):
+    """
+    Canonical text of a term; parse_search reads it back as the same term, except for
+    the words outside the language.
+    """
+    if isinstance(term, Count):
+        return " ".join(filter(None, [f"{term.operator}{term.count}", term.side, term.piece]))
+    if isinstance(term, Right):
+        return " ".join(filter(None, ["" if term.value else "no", term.side, term.right]))
+    if isinstance(term, (GameState, SideToMove)):
+        return f"not {term[0]}" if term.negated else term[0]
+    if isinstance(term, Unknown):
+        # Marked, so leftover words never read as a valid term of the normalized query
+        return f"?{term.word}"
+    return term.term
+
+
+def normalize(terms):
+    """
+    Normalized query of the terms: canonical texts, deduplicated and sorted.
+    """
+    texts = {(TERM_ORDER.index(type(term)), term_text(term)) for term in terms}
+    return " ".join(text for _, text in sorted(texts))
+
+
+def flag_test(variable, value):
+    # Booleans read "true" / "false" on ingest, "1" / "0" in older datasets
+    return f"STR({variable}) IN {TRUE_VALUES if value else FALSE_VALUES}"
+
+
+def right_condition(side, right, value):
+    """
+    SPARQL test of a castling or en passant right of one side.
+    """
+    if right == "en_passant":
+        return flag_test(f"?en_passant_{side}", value)
+    if right == "castling":
+        kingside = flag_test(f"?{side}_castling_kingside", value)
+        queenside = flag_test(f"?{side}_castling_queenside", value)
+        # Either right, or for "no castling" neither
+        return f"({kingside} {'||' if value else '&&'} {queenside})"
+    return flag_test(f"?{side}_castling_{right}", value)
+
+
+def term_condition(term):
+    """
+    SPARQL conditions of one term on the "search" template, which binds ?next_player,
+    the piece counts and the castling and en passant rights.
+    """
+    if isinstance(term, Count):
+        if term.side is None:
+            pattern, to_move = to_move_count(term.piece)
+            return f"{pattern} FILTER ({to_move} {term.operator} {term.count})"
+        return f"FILTER (?{term.side}_{term.piece} {term.operator} {term.count})"
+    if isinstance(term, Right):
+        if term.side is not None:
+            return f"FILTER ({right_condition(term.side, term.right, term.value)})"
+        if term.right in ("castling", "en_passant"):
+            # Materialized for the side to move by setup_rdf.py
+            return (f"?image chess:to_move_{term.right} ?to_move_{term.right} . "
+                    f"FILTER ({flag_test(f'?to_move_{term.right}', term.value)})")
+        by_side = [f'(?next_player = "{side}" && {right_condition(side, term.right, term.value)})' for side in SIDES]
+        return f"FILTER ({' || '.join(by_side)})"
+    if isinstance(term, SideToMove):
+        return f'FILTER (?next_player {"!=" if term.negated else "="} "{term.side}")'
+    raise ValueError(f"No SPARQL condition for {term!r}")
+
+
+def game_state_conditions(states, excluded):
+    if not states and not excluded:
+        return []
+    conditions = ["?image chess:game_state ?game_state ."]
+    if states:
+        conditions.append(f"FILTER (?game_state IN ({string_list(sorted(states), GAME_STATES)}))")
+    if excluded:
+        conditions.append(f"FILTER (?game_state NOT IN ({string_list(sorted(excluded), GAME_STATES)}))")
+    return conditions
+
+
+class SearchPlan:
+    """
+    A normalized /search query compiled once: its SPARQL conditions and square masks,
+    and the terms the PuzzleIndex evaluates as bitsets.
+    """
+
+    def __init__(self, normalized, terms):
+        self.normalized = normalized
+        self.matches_nothing = any(isinstance(term, Unknown) for term in terms)
+        self.terms = [term for term in terms if isinstance(term, (Count, Right, SideToMove))]
+        self.game_states = {term.state for term in terms if isinstance(term, GameState) and not term.negated}
+        self.excluded_states = {term.state for term in terms if isinstance(term, GameState) and term.negated}
+        self.squares = square_terms(" ".join(term.term for term in terms if isinstance(term, Square)))
+        if None in self.squares:
+            self.matches_nothing = True
+
+        conditions = [term_condition(term) for term in self.terms]
+        conditions += game_state_conditions(self.game_states, self.excluded_states)
+        self.conditions = NO_MATCH if self.matches_nothing else " ".join(conditions)
+
+    def sparql_queries(self, after=None, limit=None, variables=None):
+        """
+        SPARQL queries of the plan, optionally for the page of limit results following
+        the puzzle_id after and selecting only the given variables. Square terms cannot
+        be expressed on the piece counts: they are evaluated on the bitboard store and
+        the matching puzzle ids are bound as VALUES blocks, one query per chunk.
+        """
+        page = {"after": after_condition(after), "limit": limit_clause(limit), "variables": variables}
+        if not self.squares or self.matches_nothing:
+            return [render("search", puzzle_values="", conditions=self.conditions, **page)]
+        chunks = chunk_puzzle_ids(get_bitboard_store().matching_ids(self.squares).tolist(), after)
+        if not chunks:
+            return [render("search", puzzle_values="", conditions=NO_MATCH)]
+        return [
+            render("search", puzzle_values=values_block("puzzle_id", chunk), conditions=self.conditions, **page)
+            for chunk in chunks
+        ]
+
+    def index_bits(self, index):
+        """
+        Bitset of the matching puzzles of a PuzzleIndex.
+        """
+        if self.matches_nothing:
+            return empty_bits(len(index))
+        bits = index.all_bits()
+        for term in self.terms:
+            if isinstance(term, Count):
+                bits &= index.count_bits(term.side, term.piece, term.operator, term.count)
+            elif isinstance(term, Right):
+                bits &= index.right_bits(term.side, term.right, term.value)
+            else:
+                bits &= index.side_bits(term.side, term.negated)
+        if self.game_states:
+            bits &= index.game_state_bits(sorted(self.game_states))
+        if self.excluded_states:
+            bits &= index.all_bits() & ~index.game_state_bits(sorted(self.excluded_states))
+        if self.squares:
+            bits &= index.array_id_bits(get_bitboard_store().matching_ids(self.squares))
+        return bits
+
+
+_plans = LRUCache(max_entries=SEARCH_PLAN_CACHE_SIZE, ttl=float("inf"))
+
+
+def compile_search(query):
+    """
+    SearchPlan of a lower-cased search string, compiled once per normalized query.
+    """
+    terms = parse_search(query)
+    normalized = normalize(terms)
+    plan = _plans.get(normalized)
+    if plan is None:
+        plan = SearchPlan(normalized, terms)
+        _plans.set(normalized, plan)
+    return plan
@@ -1,6 +1,32 @@
-from collections import Counter
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import argparse
 import os
+import time
+import uuid
+import numpy as np
 import rdflib
+from rdflib.namespace import XSD
+from utils.bitboards import BitboardStore
+from utils.fen import parse_valid_fens, OPENING_MIN_PIECES, MIDGAME_MIN_PIECES
+from utils.validation import compile_shapes, validate_counts, violation_messages
+
+# "nested" hangs the piece counts off {image}_WhitePieces / {image}_BlackPieces resources,
+# "flat" stores them directly on the image (chess:white_kings, ...), saving two joins per query
+RDF_SCHEMAS = ("nested", "flat")
+
+CHESS_NAMESPACE = "http://imaginealpacas.org/chess/"
+
+# Images parsed per task of the ingest process pool
+INGEST_CHUNK_SIZE = 2000
+
+# What the ingest does with images breaking chess-shapes.ttl: "quarantine" leaves them out
+# and lists them in ingest_quarantine.tsv, "reject" stops before anything is written
+VALIDATION_MODES = ("quarantine", "reject", "off")
+
+# Quarantine message of the images whose name is not a valid FEN board; with the shapes
+# off they are still quarantined, as they have no board to describe
+MALFORMED_FEN = "malformed FEN"
 
 # Define RDF Namespace and Properties
 def initialize_rdf():
@@ -8,7 +34,7 @@ def initialize_rdf():
     g = rdflib.Graph()
 
     # Define namespaces
-    CHESS = rdflib.Namespace("http://imaginealpacas.org/chess/")
+    CHESS = rdflib.Namespace(CHESS_NAMESPACE)
 
     # Bind namespace to prefixes
     g.bind("chess", CHESS)
@@ -16,147 +42,459 @@ def initialize_rdf():
     return g, CHESS
 
 
-def extract_properties_from_fen(fen):
-    properties = {}
-
-    rows = fen.split('-')
-    board = []
-    for row in rows:
-        expanded_row = ""
-        for char in row:
-            if char.isdigit():
-                expanded_row += '.' * int(char)  # Empty squares
-            else:
-                expanded_row += char
-        board.append(expanded_row)
-
-    # Determine which side is playing from the bottom
-    bottom_pieces = Counter("".join(board[4:8]))
-    bottom_white = sum(bottom_pieces[p] for p in "PNBRQK")
-    bottom_black = sum(bottom_pieces[p] for p in "pnbrqk")
-    if bottom_white > bottom_black:
-        properties["next_player"] = "white"
-    else:
-        properties["next_player"] = "black"
-
-    # Count individual pieces for each color
-    piece_counter = Counter("".join(board))
-    properties["white_pieces"] = {
-        'kings': piece_counter.get('K', 0),
-        'queens': piece_counter.get('Q', 0),
-        'rooks': piece_counter.get('R', 0),
-        'bishops': piece_counter.get('B', 0),
-        'knights': piece_counter.get('N', 0),
-        'pawns': piece_counter.get('P', 0),
-    }
-    properties["black_pieces"] = {
-        'kings': piece_counter.get('k', 0),
-        'queens': piece_counter.get('q', 0),
-        'rooks': piece_counter.get('r', 0),
-        'bishops': piece_counter.get('b', 0),
-        'knights': piece_counter.get('n', 0),
-        'pawns': piece_counter.get('p', 0),
-    }
-
-    # Determine castling rights
-    properties["castling"] = {
-        'white_castling_kingside': board[7][4] == 'K' and board[7][7] == 'R',  # e1 and h1
-        'white_castling_queenside': board[7][4] == 'K' and board[7][0] == 'R',   # e1 and a1
-        'black_castling_kingside': board[0][4] == 'k' and board[0][7] == 'r',  # e8 and h8
-        'black_castling_queenside': board[0][4] == 'k' and board[0][0] == 'r'   # e8 and a8
+def game_state_for(total_pieces):
+    if total_pieces >= OPENING_MIN_PIECES:
+        return "opening"
+    if total_pieces >= MIDGAME_MIN_PIECES:
+        return "midgame"
+    return "endgame"
+
+
+def derive_properties(properties):
+    """
+    Values the queries would otherwise recompute on every row: the board total,
+    its game state, and the pieces, castling and en passant rights of the side to move.
+    """
+    side = properties["next_player"]
+    total_pieces = sum(properties["white_pieces"].values()) + sum(properties["black_pieces"].values())
+    return {
+        "total_pieces": total_pieces,
+        "game_state": game_state_for(total_pieces),
+        "to_move_pieces": dict(properties[f"{side}_pieces"]),
+        "to_move_castling": (properties["castling"][f"{side}_castling_kingside"]
+                             or properties["castling"][f"{side}_castling_queenside"]),
+        "to_move_en_passant": properties[f"en_passant_{side}"],
     }
 
-    properties["en_passant_white"] = False
-    properties["en_passant_black"] = False
-    if properties["next_player"] == "white":
-        for j in range(8):  # Iterate over columns
-            # Check White pawns on rank 5
-            if board[4][j] == 'P':  # White pawn on rank 5
-                if (j > 0 and board[4][j - 1] == 'p') or (j < 7 and board[4][j + 1] == 'p'):
-                    properties["en_passant_white"] = True
-
-            # Check Black pawns on rank 5
-            if board[4][j] == 'p':  # Black pawn on rank 5
-                if (j > 0 and board[4][j - 1] == 'P') or (j < 7 and board[4][j + 1] == 'P'):
-                    properties["en_passant_black"] = True
-
-    elif properties["next_player"] == "black":
-        for j in range(8):  # Iterate over columns
-            # Check White pawns on rank 4
-            if board[3][j] == 'P':  # White pawn on rank 4
-                if (j > 0 and board[3][j - 1] == 'p') or (j < 7 and board[3][j + 1] == 'p'):
-                    properties["en_passant_white"] = True
-
-            # Check Black pawns on rank 4
-            if board[3][j] == 'p':  # Black pawn on rank 4
-                if (j > 0 and board[3][j - 1] == 'P') or (j < 7 and board[3][j + 1] == 'P'):
-                    properties["en_passant_black"] = True
 
-    return properties
-
-
-def add_image_metadata_to_rdf(graph, CHESS, image_name, properties):
+def image_triples(CHESS, image_name, properties, schema="nested"):
+    """
+    Yields the triples describing one puzzle image.
+    """
     image_uri = CHESS[image_name]
 
     # # Add a comment to indicate the start of a new chess board
-    # graph.add((image_uri, rdflib.RDFS.comment, rdflib.Literal(f"Chess board representation for {image_name}")))
+    # yield (image_uri, rdflib.RDFS.comment, rdflib.Literal(f"Chess board representation for {image_name}"))
 
-    # Store the puzzle index
-    graph.add((image_uri, CHESS["puzzle_id"], rdflib.Literal(properties["puzzle_id"])))
+    # Store the puzzle index, typed so it sorts numerically without a cast
+    yield (image_uri, CHESS["puzzle_id"], rdflib.Literal(int(properties["puzzle_id"]), datatype=XSD.integer))
 
     # Store the next player
-    graph.add((image_uri, CHESS["next_player"], rdflib.Literal(properties["next_player"])))
-
-    # Create a resource for white pieces
-    white_pieces_uri = CHESS[f"{image_name}_WhitePieces"]
-    graph.add((image_uri, CHESS["white_pieces"], white_pieces_uri))
-    graph.add((white_pieces_uri, rdflib.RDF.type, CHESS["ChessPieceCollection"]))
-
-    # Create a resource for black pieces
-    black_pieces_uri = CHESS[f"{image_name}_BlackPieces"]
-    graph.add((image_uri, CHESS["black_pieces"], black_pieces_uri))
-    graph.add((black_pieces_uri, rdflib.RDF.type, CHESS["ChessPieceCollection"]))
-
-    # Store piece counts inside white_pieces and black_pieces
-    for piece, count in properties["white_pieces"].items():
-        graph.add((white_pieces_uri, CHESS[f"white_pieces_{piece}"], rdflib.Literal(count)))
-
-    for piece, count in properties["black_pieces"].items():
-        graph.add((black_pieces_uri, CHESS[f"black_pieces_{piece}"], rdflib.Literal(count)))
+    yield (image_uri, CHESS["next_player"], rdflib.Literal(properties["next_player"]))
+
+    if schema == "flat":
+        # Store piece counts directly on the image
+        for side in ("white", "black"):
+            for piece, count in properties[f"{side}_pieces"].items():
+                yield (image_uri, CHESS[f"{side}_{piece}"], rdflib.Literal(count))
+    elif schema == "nested":
+        # Create a resource for white pieces
+        white_pieces_uri = CHESS[f"{image_name}_WhitePieces"]
+        yield (image_uri, CHESS["white_pieces"], white_pieces_uri)
+        yield (white_pieces_uri, rdflib.RDF.type, CHESS["ChessPieceCollection"])
+
+        # Create a resource for black pieces
+        black_pieces_uri = CHESS[f"{image_name}_BlackPieces"]
+        yield (image_uri, CHESS["black_pieces"], black_pieces_uri)
+        yield (black_pieces_uri, rdflib.RDF.type, CHESS["ChessPieceCollection"])
+
+        # Store piece counts inside white_pieces and black_pieces
+        for piece, count in properties["white_pieces"].items():
+            yield (white_pieces_uri, CHESS[f"white_pieces_{piece}"], rdflib.Literal(count))
+
+        for piece, count in properties["black_pieces"].items():
+            yield (black_pieces_uri, CHESS[f"black_pieces_{piece}"], rdflib.Literal(count))
+    else:
+        raise ValueError(f"Unknown RDF schema: {schema!r}")
 
     # Store castling rights
     for castling_right, status in properties["castling"].items():
-        graph.add((image_uri, CHESS[castling_right], rdflib.Literal(status)))
+        yield (image_uri, CHESS[castling_right], rdflib.Literal(status))
 
     # Store en passant possibilities
-    graph.add((image_uri, CHESS["en_passant_white"], rdflib.Literal(properties["en_passant_white"])))
-    graph.add((image_uri, CHESS["en_passant_black"], rdflib.Literal(properties["en_passant_black"])))
+    yield (image_uri, CHESS["en_passant_white"], rdflib.Literal(properties["en_passant_white"]))
+    yield (image_uri, CHESS["en_passant_black"], rdflib.Literal(properties["en_passant_black"]))
+
+    # Store the derived properties the services filter and rank on
+    derived = derive_properties(properties)
+    yield (image_uri, CHESS["total_pieces"], rdflib.Literal(derived["total_pieces"], datatype=XSD.integer))
+    yield (image_uri, CHESS["game_state"], rdflib.Literal(derived["game_state"]))
+    for piece, count in derived["to_move_pieces"].items():
+        yield (image_uri, CHESS[f"to_move_{piece}"], rdflib.Literal(count, datatype=XSD.integer))
+    yield (image_uri, CHESS["to_move_castling"], rdflib.Literal(derived["to_move_castling"]))
+    yield (image_uri, CHESS["to_move_en_passant"], rdflib.Literal(derived["to_move_en_passant"]))
+
+
+def add_image_metadata_to_rdf(graph, CHESS, image_name, properties, schema="nested"):
+    for triple in image_triples(CHESS, image_name, properties, schema):
+        graph.add(triple)
+
+
+def bump_dataset_version(root_dir):
+    """
+    Writes a fresh dataset version so caches built on the old data are invalidated.
+    """
+    version = f"{int(time.time())}-{uuid.uuid4().hex[:8]}"
+    with open(os.path.join(root_dir, 'dataset_version'), 'w', encoding='utf-8') as f:
+        f.write(version)
+    return version
+
+
+def record_rdf_schema(root_dir, schema):
+    """
+    Records the schema of the dataset so the query builders pick the matching patterns.
+    """
+    with open(os.path.join(root_dir, 'rdf_schema'), 'w', encoding='utf-8') as f:
+        f.write(schema)
+
+
+def iter_images(dataset_dir):
+    """
+    Yields the FEN image file names of a directory, scanned once, in directory order.
+    """
+    with os.scandir(dataset_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith(".jpeg"):
+                yield entry.name
+
+
+def read_manifest(path):
+    """
+    Returns ({file name: puzzle_id}, next free puzzle_id) from an ingest manifest, or None if there is none.
+    """
+    if not os.path.exists(path):
+        return None
+    puzzle_ids = {}
+    with open(path, encoding='utf-8') as f:
+        next_id = int(f.readline().split('\t')[1])
+        for line in f:
+            file_name, puzzle_id = line.rstrip('\n').split('\t')
+            puzzle_ids[file_name] = int(puzzle_id)
+    return puzzle_ids, next_id
+
+
+def write_manifest(path, puzzle_ids, next_id):
+    """
+    Writes the file name -> puzzle_id manifest, ordered by puzzle_id. next_id is kept
+    so the ids of removed images are never handed out again.
+    """
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(f"next_puzzle_id\t{next_id}\n")
+        for file_name, puzzle_id in sorted(puzzle_ids.items(), key=lambda item: item[1]):
+            f.write(f"{file_name}\t{puzzle_id}\n")
+    os.replace(path + '.tmp', path)
+
+
+def read_quarantine(path):
+    """
+    Returns {file name: (puzzle_id, messages)} of the images an ingest quarantined.
+    """
+    if not os.path.exists(path):
+        return {}
+    quarantined = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            file_name, puzzle_id, *messages = line.rstrip('\n').split('\t')
+            quarantined[file_name] = (int(puzzle_id), messages)
+    return quarantined
+
+
+def write_quarantine(path, quarantined):
+    """
+    Writes the quarantined images, one per line with their puzzle_id and the messages of
+    the shapes they break, ordered by puzzle_id.
+    """
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        for file_name, (puzzle_id, messages) in sorted(quarantined.items(), key=lambda item: item[1][0]):
+            f.write("\t".join([file_name, str(puzzle_id), *messages]) + "\n")
+    os.replace(path + '.tmp', path)
+
+
+def dataset_images(dataset_dir, manifest_path):
+    """
+    (puzzle_id, file name) of every ingested image: from the manifest when there is one,
+    leaving out the quarantined images, otherwise numbered 1, 2, ... in directory order
+    as the first ingest does.
+    """
+    manifest = read_manifest(manifest_path)
+    if manifest is None:
+        return list(enumerate(iter_images(dataset_dir), start=1))
+    quarantined = read_quarantine(os.path.join(os.path.dirname(manifest_path), 'ingest_quarantine.tsv'))
+    return sorted((puzzle_id, file_name) for file_name, puzzle_id in manifest[0].items() if file_name not in quarantined)
+
+
+def assign_puzzle_ids(dataset_dir, manifest):
+    """
+    Scans dataset_dir and gives every image a stable puzzle_id: images in the manifest keep
+    theirs, new ones get the next free ids in directory order.
+    Returns ({file name: puzzle_id}, next free puzzle_id, added images, removed file names).
+    """
+    known, next_id = manifest or ({}, 1)
+    puzzle_ids = {}
+    added = []
+    for file_name in iter_images(dataset_dir):
+        if file_name in known:
+            puzzle_ids[file_name] = known[file_name]
+        else:
+            puzzle_ids[file_name] = next_id
+            added.append((next_id, file_name))
+            next_id += 1
+    removed = known.keys() - puzzle_ids.keys()
+    return puzzle_ids, next_id, added, removed
+
+
+def iter_chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def validate_images(images, constraints):
+    """
+    Parses the FEN of each (puzzle_id, file name) and validates the boards against the
+    compiled shapes. Returns (FenBatch of the parsed boards, their positions in images,
+    {position: messages} of the invalid images in order, the unparseable ones included).
+    """
+    boards, parsed = parse_valid_fens([file_name for _, file_name in images])
+    positions = np.flatnonzero(parsed)
+    invalid = {position: [MALFORMED_FEN] for position in np.flatnonzero(~parsed).tolist()}
+    for row, messages in violation_messages(validate_counts(boards.counts, constraints), constraints).items():
+        invalid[int(positions[row])] = messages
+    return boards, positions, dict(sorted(invalid.items()))
+
+
+def ntriples_for_images(images, schema, constraints=()):
+    """
+    Parses the FEN of each (puzzle_id, file name), validates the boards against the compiled
+    shapes and returns (N-Triples document of the valid ones, [(puzzle_id, file name, messages)]
+    of the others). Runs in the ingest worker processes.
+    """
+    CHESS = rdflib.Namespace(CHESS_NAMESPACE)
+    boards, positions, invalid = validate_images(images, constraints)
+    lines = []
+    for row, position in enumerate(positions.tolist()):
+        if position in invalid:
+            continue
+        puzzle_id, file_name = images[position]
+        properties = boards.properties(row)
+        properties["puzzle_id"] = puzzle_id
+        for triple in image_triples(CHESS, file_name, properties, schema):
+            lines.append(f"{triple[0].n3()} {triple[1].n3()} {triple[2].n3()} .\n")
+    quarantined = [(*images[position], messages) for position, messages in invalid.items()]
+    return "".join(lines), quarantined
+
+
+def iter_ntriples(images, schema="nested", workers=None, chunk_size=INGEST_CHUNK_SIZE, constraints=()):
+    """
+    Yields (images, (N-Triples document, quarantined images)) per chunk of (puzzle_id, file name),
+    in order. Chunks are converted in a process pool with at most two per worker in flight,
+    so memory use does not grow with the size of the dataset.
+    """
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in iter_chunks(images, chunk_size):
+            pending.append((len(chunk), executor.submit(ntriples_for_images, chunk, schema, constraints)))
+            if len(pending) >= 2 * workers:
+                done, future = pending.popleft()
+                yield done, future.result()
+        while pending:
+            done, future = pending.popleft()
+            yield done, future.result()
+
+
+def image_of_subject(line):
+    """
+    File name of the image an N-Triples line of ontology.nt describes, or None for other subjects.
+    """
+    prefix = f"<{CHESS_NAMESPACE}"
+    if not line.startswith(prefix):
+        return None
+    name = line[len(prefix):line.index(">")]
+    for suffix in ("_WhitePieces", "_BlackPieces"):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def duplicate_links(bitboards):
+    """
+    N-Triples lines linking every image whose position was already ingested under a lower
+    puzzle_id to that first image (chess:duplicate_of), sorted.
+    """
+    return sorted(
+        f"<{CHESS_NAMESPACE}{bitboards.file_names[row]}> <{CHESS_NAMESPACE}duplicate_of> "
+        f"<{CHESS_NAMESPACE}{bitboards.file_names[bitboards.canonical[row]]}> .\n"
+        for row in bitboards.duplicate_rows().tolist()
+    )
+
+
+def is_duplicate_link(line):
+    return f" <{CHESS_NAMESPACE}duplicate_of> " in line
+
+
+def write_ntriples(output, images, schema, workers, chunk_size, copies=(), constraints=()):
+    """
+    Appends the triples of the images passing the constraints to the open file output (and to
+    every file of copies). Returns {file name: (puzzle_id, messages)} of the others.
+    """
+    done = 0
+    quarantined = {}
+    for count, (ntriples, invalid) in iter_ntriples(images, schema, workers, chunk_size, constraints):
+        output.write(ntriples)
+        for copy in copies:
+            copy.write(ntriples)
+        for puzzle_id, file_name, messages in invalid:
+            quarantined[file_name] = (puzzle_id, messages)
+        done += count
+        print(f"Preparing RDF dataset... {done} \\ {len(images)} images")
+    return quarantined
+
+
+def check_images(images, constraints):
+    """
+    Raises ValueError naming the images breaking the constraints, for the "reject" validation mode.
+    """
+    for chunk in iter_chunks(images, INGEST_CHUNK_SIZE):
+        _, _, invalid = validate_images(chunk, constraints)
+        malformed = [chunk[position][1] for position, messages in invalid.items() if messages == [MALFORMED_FEN]]
+        if malformed:
+            raise ValueError(f"Malformed FEN image names: {', '.join(malformed)}")
+        if invalid:
+            position, messages = next(iter(invalid.items()))
+            raise ValueError(f"{chunk[position][1]} breaks chess-shapes.ttl: {' '.join(messages)}")
 
 
 # Example Use Case
-def prepare_rdf_dataset(dataset_dir):
-    g, CHESS = initialize_rdf()
-
-    index = 1
-    for file_name in os.listdir(dataset_dir):
-        print(f"Preparing RDF dataset... {index} \ {len(os.listdir(dataset_dir))}")
-        if file_name.endswith(".jpeg"):
-            fen_representation = file_name.replace(".jpeg", "")
-            properties = extract_properties_from_fen(fen_representation)
-            properties["puzzle_id"] = index
-            add_image_metadata_to_rdf(g, CHESS, file_name, properties)
-            index += 1
-        # if index == 10:
-        #     break
-
-    # Serialize to file
+def prepare_rdf_dataset(dataset_dir, schema="nested", workers=None, chunk_size=INGEST_CHUNK_SIZE, incremental=False,
+                        validation="quarantine"):
+    """
+    Streams the triples of the images of dataset_dir to ontology.nt in the repository root,
+    saves their bitboards to bitboards.npz, then records the schema and bumps the dataset version.
+    Images showing a position already ingested under a lower puzzle_id are linked to that
+    image with chess:duplicate_of, found through the Zobrist hashes of the bitboards.
+
+    Every board is checked against chess-shapes.ttl, compiled to vectorized checks on the piece
+    counts (see VALIDATION_MODES); images whose name is not a valid FEN board are quarantined
+    (or rejected) as well. Quarantined images keep their puzzle_id in the manifest but get no
+    triples and no bitboards.
+
+    Puzzle ids are kept stable across runs in ingest_manifest.tsv. With incremental=True only
+    the images added or removed since the last run are processed: ontology.nt is updated in
+    place and the changes are also written to ontology.added.nt / ontology.removed.nt, so the
+    repository can be updated without a full reload.
+    """
+    if schema not in RDF_SCHEMAS:
+        raise ValueError(f"Unknown RDF schema: {schema!r}")
+    if validation not in VALIDATION_MODES:
+        raise ValueError(f"Unknown validation mode: {validation!r}")
+
     path = os.path.dirname(os.path.dirname(__file__))
     path = os.path.dirname(path)
-    g.serialize(os.path.join(path, 'ontology.rdf'), format="xml")
+    output = os.path.join(path, 'ontology.nt')
+    manifest_path = os.path.join(path, 'ingest_manifest.tsv')
+    added_path = os.path.join(path, 'ontology.added.nt')
+    removed_path = os.path.join(path, 'ontology.removed.nt')
+    bitboards_path = os.path.join(path, 'bitboards.npz')
+    quarantine_path = os.path.join(path, 'ingest_quarantine.tsv')
+    constraints = [] if validation == "off" else compile_shapes(os.path.join(path, 'chess-shapes.ttl'))
+
+    manifest = read_manifest(manifest_path)
+    puzzle_ids, next_id, added, removed = assign_puzzle_ids(dataset_dir, manifest)
+
+    if incremental:
+        schema_path = os.path.join(path, 'rdf_schema')
+        recorded_schema = None
+        if os.path.exists(schema_path):
+            with open(schema_path, encoding='utf-8') as f:
+                recorded_schema = f.read().strip() or "nested"
+        if manifest is None or not os.path.exists(output) or recorded_schema != schema:
+            print("No previous ingest with this schema, running a full ingest")
+            incremental = False
+
+    # Written next to the previous dataset and swapped in once complete
+    if incremental:
+        if not added and not removed:
+            if not os.path.exists(bitboards_path):
+                BitboardStore.from_images(dataset_images(dataset_dir, manifest_path)).save(bitboards_path)
+            print("Dataset unchanged")
+            return output
+        if validation == "reject":
+            check_images(added, constraints)
+        previous_quarantine = read_quarantine(quarantine_path)
+        previous_links = []
+        with open(output + '.tmp', 'w', encoding='utf-8') as f, \
+                open(added_path, 'w', encoding='utf-8') as added_file, \
+                open(removed_path, 'w', encoding='utf-8') as removed_file:
+            with open(output, encoding='utf-8') as previous:
+                for line in previous:
+                    # The links are rewritten as a whole, only their changes go to the delta files
+                    if is_duplicate_link(line):
+                        previous_links.append(line)
+                    elif removed and image_of_subject(line) in removed:
+                        removed_file.write(line)
+                    else:
+                        f.write(line)
+            quarantined = write_ntriples(f, added, schema, workers, chunk_size, copies=[added_file],
+                                         constraints=constraints)
+            quarantined.update((name, entry) for name, entry in previous_quarantine.items() if name not in removed)
+            valid = [(puzzle_id, name) for puzzle_id, name in added if name not in quarantined]
+            if os.path.exists(bitboards_path):
+                bitboards = BitboardStore.load(bitboards_path).updated(valid, [manifest[0][name] for name in removed])
+            else:
+                bitboards = BitboardStore.from_images(sorted(
+                    (puzzle_id, name) for name, puzzle_id in puzzle_ids.items() if name not in quarantined
+                ))
+            links = duplicate_links(bitboards)
+            f.writelines(links)
+            removed_file.writelines(sorted(set(previous_links) - set(links)))
+            added_file.writelines(sorted(set(links) - set(previous_links)))
+        print(f"Added {len(added)} images, removed {len(removed)}, {len(links)} duplicate positions")
+    else:
+        images = sorted((puzzle_id, file_name) for file_name, puzzle_id in puzzle_ids.items())
+        if validation == "reject":
+            check_images(images, constraints)
+        with open(output + '.tmp', 'w', encoding='utf-8') as f:
+            quarantined = write_ntriples(f, images, schema, workers, chunk_size, constraints=constraints)
+            bitboards = BitboardStore.from_images([image for image in images if image[1] not in quarantined])
+            links = duplicate_links(bitboards)
+            f.writelines(links)
+        print(f"{len(links)} duplicate positions")
+        # A full ingest has to be loaded as a whole
+        for stale in (added_path, removed_path):
+            if os.path.exists(stale):
+                os.remove(stale)
+    if quarantined:
+        print(f"{len(quarantined)} images quarantined as malformed or breaking chess-shapes.ttl, see {quarantine_path}")
+    os.replace(output + '.tmp', output)
+    bitboards.save(bitboards_path)
+
+    write_quarantine(quarantine_path, quarantined)
+    write_manifest(manifest_path, puzzle_ids, next_id)
+    record_rdf_schema(path, schema)
+    bump_dataset_version(path)
+    return output
 
 
 # Prepare RDF dataset
-path = os.path.dirname(os.path.dirname(__file__))
-path = os.path.dirname(path)
-prepare_rdf_dataset(os.path.join(path, 'dataset', 'test'))
-# prepare_rdf_dataset("./dataset/train")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds ontology.nt from the dataset images.")
+    parser.add_argument("--schema", choices=RDF_SCHEMAS, default="nested", help="layout of the piece counts")
+    parser.add_argument("--workers", type=int, default=None, help="ingest processes (default: one per CPU)")
+    parser.add_argument("--chunk-size", type=int, default=INGEST_CHUNK_SIZE, help="images per ingest task")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only process the images added or removed since the last ingest")
+    parser.add_argument("--validation", choices=VALIDATION_MODES, default="quarantine",
+                        help="what to do with images breaking chess-shapes.ttl")
+    args = parser.parse_args()
+
+    path = os.path.dirname(os.path.dirname(__file__))
+    path = os.path.dirname(path)
+    prepare_rdf_dataset(os.path.join(path, 'dataset', 'test'), args.schema, args.workers, args.chunk_size, args.incremental,
+                        args.validation)
+    # prepare_rdf_dataset("./dataset/train")
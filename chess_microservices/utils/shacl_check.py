@@ -0,0 +1,78 @@
+"""
+Cross-checks the compiled ingest validation (utils/validation.py) against a full SHACL
+run: a random sample of the dataset images is converted to triples, validated with
+pyshacl against chess-shapes.ttl, and the puzzles and messages both report are compared.
+
+Run from chess_microservices/:
+    python -m utils.shacl_check --sample 1000
+"""
+import argparse
+import os
+import random
+import sys
+import pyshacl
+import rdflib
+from rdflib.namespace import SH
+from utils.fen import parse_fens
+from utils.setup_rdf import CHESS_NAMESPACE, image_of_subject, image_triples, iter_images
+from utils.validation import compile_shapes, validate_counts, violation_messages
+
+
+def compiled_violations(file_names, shapes_path):
+    """
+    {file name: set of messages} from the compiled shapes.
+    """
+    constraints = compile_shapes(shapes_path)
+    boards = parse_fens(file_names)
+    messages = violation_messages(validate_counts(boards.counts, constraints), constraints)
+    return {file_names[row]: set(row_messages) for row, row_messages in messages.items()}
+
+
+def shacl_violations(file_names, shapes_path):
+    """
+    {file name: set of messages} from pyshacl, on the triples the ingest writes for the
+    images ("nested" schema, the one the shapes are written for).
+    """
+    CHESS = rdflib.Namespace(CHESS_NAMESPACE)
+    graph = rdflib.Graph()
+    boards = parse_fens(file_names)
+    for position, file_name in enumerate(file_names):
+        properties = boards.properties(position)
+        properties["puzzle_id"] = position + 1
+        for triple in image_triples(CHESS, file_name, properties, "nested"):
+            graph.add(triple)
+
+    _, report, _ = pyshacl.validate(graph, shacl_graph=rdflib.Graph().parse(shapes_path))
+    violations = {}
+    for result in report.subjects(rdflib.RDF.type, SH.ValidationResult):
+        focus = report.value(result, SH.focusNode)
+        file_name = image_of_subject(f"<{focus}>")
+        violations.setdefault(file_name, set()).add(str(report.value(result, SH.resultMessage)))
+    return violations
+
+
+def main():
+    path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sample", type=int, default=1000, help="images validated by both")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dataset-dir", default=os.path.join(path, "dataset", "test"))
+    parser.add_argument("--shapes", default=os.path.join(path, "chess-shapes.ttl"))
+    args = parser.parse_args()
+
+    images = list(iter_images(args.dataset_dir))
+    sample = random.Random(args.seed).sample(images, min(args.sample, len(images)))
+    compiled = compiled_violations(sample, args.shapes)
+    shacl = shacl_violations(sample, args.shapes)
+
+    print(f"{len(sample)} images: {len(compiled)} invalid by the compiled shapes, {len(shacl)} by SHACL")
+    mismatches = sorted(name for name in compiled.keys() | shacl.keys() if compiled.get(name) != shacl.get(name))
+    for name in mismatches:
+        print(f"{name}: compiled {sorted(compiled.get(name, ()))}, SHACL {sorted(shacl.get(name, ()))}")
+    if mismatches:
+        sys.exit(1)
+    print("Both agree")
+
+
+if __name__ == "__main__":
+    main()
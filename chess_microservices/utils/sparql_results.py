@@ -0,0 +1,90 @@
+import re
+
+# Accept header asking the store for SPARQL 1.1 TSV results, which are far
+# cheaper to produce and parse than application/sparql-results+json
+TSV_ACCEPT = "text/tab-separated-values"
+
+_ESCAPES = {"t": "\t", "n": "\n", "r": "\r", "b": "\b", "f": "\f", '"': '"', "'": "'", "\\": "\\"}
+_ESCAPE_RE = re.compile(r"\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)")
+
+
+def _unescape(text):
+    def replace(match):
+        code = match.group(1)
+        if code[0] in "uU" and len(code) > 1:
+            return chr(int(code[1:], 16))
+        return _ESCAPES.get(code, code)
+
+    return _ESCAPE_RE.sub(replace, text) if "\\" in text else text
+
+
+def parse_tsv_term(token):
+    """
+    Decodes one RDF term written in SPARQL TSV (Turtle) syntax into the
+    {"type": ..., "value": ...} shape used by SPARQL JSON bindings.
+    Returns None for unbound values.
+    """
+    if not token:
+        return None
+    if token[0] == "<" and token[-1] == ">":
+        return {"type": "uri", "value": token[1:-1]}
+    if token.startswith("_:"):
+        return {"type": "bnode", "value": token[2:]}
+    if token[0] == '"':
+        end = token.rindex('"')
+        term = {"type": "literal", "value": _unescape(token[1:end])}
+        suffix = token[end + 1:]
+        if suffix.startswith("@"):
+            term["xml:lang"] = suffix[1:]
+        elif suffix.startswith("^^<"):
+            term["datatype"] = suffix[3:-1]
+        return term
+    # Bare numbers and booleans (Turtle abbreviated literals)
+    return {"type": "literal", "value": token}
+
+
+def parse_tsv_header(line):
+    """
+    Returns the variable names of a TSV result header such as "?image\t?puzzle_id".
+    """
+    return [name.lstrip("?$") for name in line.rstrip("\r\n").split("\t")]
+
+
+def parse_tsv_row(variables, line):
+    """
+    Decodes one TSV result row into a binding dict, leaving out unbound variables.
+    """
+    binding = {}
+    for name, token in zip(variables, line.rstrip("\r\n").split("\t")):
+        term = parse_tsv_term(token)
+        if term is not None:
+            binding[name] = term
+    return binding
+
+
+def concat_results(results):
+    """
+    Merges the JSON results of queries run over consecutive puzzle_id chunks.
+    Chunks cover ascending id ranges, so results ordered by puzzle_id stay ordered.
+    """
+    bindings = []
+    for result in results:
+        bindings.extend(result["results"]["bindings"])
+    return {"head": results[0]["head"], "results": {"bindings": bindings}}
+
+
+def sum_results(results):
+    """
+    Reduces the single-row results of an ungrouped COUNT/SUM query run over
+    several chunks into one row. A variable left unbound in any chunk
+    (an aggregate error) stays unbound in the reduced row too.
+    """
+    variables = results[0]["head"]["vars"]
+    rows = [result["results"]["bindings"][0] if result["results"]["bindings"] else {} for result in results]
+
+    binding = {}
+    for name in variables:
+        terms = [row.get(name) for row in rows]
+        if all(terms):
+            binding[name] = dict(terms[0], value=str(sum(int(term["value"]) for term in terms)))
+    return {"head": results[0]["head"], "results": {"bindings": [binding]}}
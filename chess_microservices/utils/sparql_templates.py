@@ -0,0 +1,382 @@
+import re
+from bisect import bisect_right
+from string import Template
+from rdflib.plugins.sparql.parser import parseQuery
+from config import SPARQL_CHUNK_SIZE, COLLAPSE_DUPLICATES
+from utils.fen import SIDES, PIECES, CASTLING_RIGHTS
+from utils.query_cache import read_rdf_schema
+
+RECOMMENDATION_FEATURES = ("has_castling", "has_en_passant", "queens", "rooks", "bishops", "knights", "pawns")
+
+# Minimum counts behind the "N+" checkboxes of the FilterPanel
+AT_LEAST_VALUES = {"2+": 2, "3+": 3, "9+": 9}
+
+# Condition for terms that can never match (rdflib mis-evaluates a bare FILTER (false))
+NO_MATCH = "FILTER (1 = 0)"
+
+
+class SparqlTemplate(Template):
+    """
+    SPARQL query with %placeholders for fragments built by the helpers below.
+    '%' is used as delimiter because '$' and '?' are SPARQL variable sigils.
+    """
+
+    delimiter = "%"
+
+    def __init__(self, name, text, **sample):
+        super().__init__(text)
+        self.name = name
+        self.sample = sample
+
+    def render(self, **fragments):
+        return self.substitute(fragments)
+
+    def validate(self, **fragments):
+        """
+        Parses the template rendered with its sample fragments; raises on a syntax error.
+        """
+        parseQuery(self.render(**{**self.sample, **fragments}))
+
+
+# ---------- Safe fragment builders ----------
+
+def puzzle_ids_to_ints(puzzle_ids):
+    """
+    Validates client-supplied puzzle ids and returns them as sorted, unique ints.
+    """
+    ids = set()
+    for pid in puzzle_ids:
+        if isinstance(pid, bool):
+            raise ValueError(f"Invalid puzzle_id: {pid!r}")
+        try:
+            ids.add(int(str(pid).strip()))
+        except ValueError:
+            raise ValueError(f"Invalid puzzle_id: {pid!r}") from None
+    return sorted(ids)
+
+
+def chunk_puzzle_ids(puzzle_ids, after=None):
+    """
+    Validates puzzle ids and splits them into ascending runs of at most SPARQL_CHUNK_SIZE,
+    so each chunk covers a puzzle_id range that sorts after the previous one.
+    Ids up to the page cursor after are dropped, so earlier pages are never queried.
+    """
+    ids = puzzle_ids_to_ints(puzzle_ids)
+    if after is not None:
+        ids = ids[bisect_right(ids, after):]
+    return [ids[start:start + SPARQL_CHUNK_SIZE] for start in range(0, len(ids), SPARQL_CHUNK_SIZE)]
+
+
+def values_block(variable, puzzle_ids):
+    """
+    VALUES block binding ?variable to the given puzzle ids, e.g. VALUES ?puzzle_id { 1 2 3 }.
+    Placed first in a group, it lets the store drive the joins from the id set.
+    """
+    ids = puzzle_ids_to_ints(puzzle_ids)
+    return f"VALUES ?{variable} {{ {' '.join(map(str, ids))} }}"
+
+
+def after_condition(after):
+    """
+    Keyset condition of a page: the puzzles past the cursor, e.g. FILTER (?puzzle_id > 42).
+    Empty for the first page.
+    """
+    return "" if after is None else f"FILTER (?puzzle_id > {int(after)})"
+
+
+def limit_clause(limit):
+    """
+    LIMIT of a page: one row more than the page size, which tells whether a next page exists.
+    Empty when the whole result is requested.
+    """
+    return "" if limit is None else f"LIMIT {int(limit) + 1}"
+
+
+def to_move_count(piece):
+    """
+    Triple pattern binding the count of a piece for the side to move, as materialized
+    by setup_rdf.py, and the variable it binds; (None, None) for an unknown piece.
+    """
+    if piece not in PIECES:
+        return None, None
+    return f"?image chess:to_move_{piece} ?to_move_{piece} .", f"?to_move_{piece}"
+
+
+def count_condition(value):
+    """
+    Turns a FilterPanel value ("2+", "3+", "9+" or an exact number) into (operator, count).
+    """
+    value = str(value).strip()
+    if value in AT_LEAST_VALUES:
+        return ">=", AT_LEAST_VALUES[value]
+    if value.isdigit():
+        return "=", int(value)
+    raise ValueError(f"Invalid piece count filter: {value!r}")
+
+
+def piece_filter_terms(filters):
+    """
+    Reads the FilterPanel filters as (piece, [(operator, count), ...]) terms on the side to move;
+    'game_state' and empty entries are skipped, piece is None for unknown pieces.
+    Raises ValueError for malformed count values.
+    """
+    terms = []
+    for piece, values in filters.items():
+        if piece == "game_state" or not values:
+            continue
+        if piece not in PIECES:
+            terms.append((None, []))
+        else:
+            terms.append((piece, [count_condition(v) for v in values]))
+    return terms
+
+
+def check_values(values, allowed):
+    """
+    Raises ValueError unless every value belongs to the closed vocabulary allowed.
+    """
+    for value in values:
+        if value not in allowed:
+            raise ValueError(f"Invalid value {value!r}, expected one of {', '.join(allowed)}")
+
+
+def string_list(values, allowed):
+    """
+    Comma-separated SPARQL string literals restricted to a closed vocabulary.
+    """
+    check_values(values, allowed)
+    return ", ".join(f'"{value}"' for value in values)
+
+
+# ---------- Templates ----------
+
+PREFIXES = """
+    PREFIX chess: <http://imaginealpacas.org/chess/>
+    PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
+"""
+
+PIECE_VARIABLES = """
+           ?white_kings ?white_queens ?white_rooks ?white_bishops ?white_knights ?white_pawns
+           ?black_kings ?black_queens ?black_rooks ?black_bishops ?black_knights ?black_pawns"""
+
+COUNT_VARIABLES = tuple(f"{side}_{piece}" for side in SIDES for piece in PIECES)
+FLAG_VARIABLES = CASTLING_RIGHTS + ("en_passant_white", "en_passant_black")
+
+# Selected by every listing template whatever the projection: the image and the page cursor
+KEY_VARIABLES = ("image", "puzzle_id")
+
+
+def piece_patterns(schema, counts=COUNT_VARIABLES):
+    """
+    Patterns binding ?puzzle_id, ?next_player and the given piece count variables in an
+    RDF schema (see setup_rdf.RDF_SCHEMAS); templates reference them as %piece_patterns.
+    """
+    if schema == "flat":
+        # Every count is written at ingest, so the flat layout needs neither the hops nor OPTIONALs
+        triples = ["chess:puzzle_id ?puzzle_id", "chess:next_player ?next_player"]
+        triples += [f"chess:{count} ?{count}" for count in COUNT_VARIABLES if count in counts]
+        return "\n        ?image " + " ;\n               ".join(triples) + " .\n"
+    lines = [
+        "?image chess:puzzle_id ?puzzle_id .",
+        "?image chess:next_player ?next_player .",
+        "?image chess:white_pieces ?white_pieces .",
+        "?image chess:black_pieces ?black_pieces .",
+    ]
+    lines += [
+        f"OPTIONAL {{ ?{side}_pieces chess:{side}_pieces_{piece} ?{side}_{piece} . }}"
+        for side in SIDES for piece in PIECES if f"{side}_{piece}" in counts
+    ]
+    return "\n" + "".join(f"        {line}\n" for line in lines)
+
+
+def flag_patterns(flags=FLAG_VARIABLES):
+    """
+    OPTIONAL patterns binding the given castling and en passant variables, %flag_patterns.
+    """
+    return "\n" + "".join(f"        OPTIONAL {{ ?image chess:{flag} ?{flag} . }}\n" for flag in flags)
+
+
+PIECE_PATTERNS = {schema: piece_patterns(schema) for schema in ("nested", "flat")}
+
+# Leaves out the images setup_rdf.py linked to an earlier image of the same position;
+# templates reference it as %canonical_only
+CANONICAL_ONLY = "FILTER NOT EXISTS { ?image chess:duplicate_of ?canonical . }"
+
+SAMPLE_VALUES = "VALUES ?puzzle_id { 1 2 3 }"
+SAMPLE_AFTER = "FILTER (?puzzle_id > 3)"
+SAMPLE_LIMIT = "LIMIT 7"
+SAMPLE_FILTER = "?image chess:to_move_rooks ?to_move_rooks . FILTER (?to_move_rooks >= 2)"
+
+TEMPLATES = {}
+
+
+def register(name, text, variables=None, **sample):
+    """
+    Adds a template. Listing templates pass the variables they can select, in order, and
+    use %variables in their SELECT; see render.
+    """
+    TEMPLATES[name] = SparqlTemplate(name, text, **sample)
+    TEMPLATES[name].variables = variables
+
+
+register("initial", PREFIXES + """
+    SELECT ?image ?puzzle_id
+    WHERE {
+        ?image chess:puzzle_id ?puzzle_id .
+        %canonical_only
+        %after
+    }
+    ORDER BY ASC(?puzzle_id)
+    %limit
+""", after=SAMPLE_AFTER, limit=SAMPLE_LIMIT)
+
+register("search", PREFIXES + """
+    SELECT %variables
+    WHERE {
+        %puzzle_values
+        %piece_patterns
+        %flag_patterns
+        %canonical_only
+        %conditions
+        %after
+    }
+    ORDER BY ASC(?puzzle_id)
+    %limit
+""", variables=KEY_VARIABLES + ("next_player",) + COUNT_VARIABLES + FLAG_VARIABLES,
+    puzzle_values=SAMPLE_VALUES, conditions=SAMPLE_FILTER, after=SAMPLE_AFTER, limit=SAMPLE_LIMIT)
+
+register("filter_pieces", PREFIXES + """
+    SELECT %variables
+    WHERE {
+        %puzzle_values
+        %piece_patterns
+        %conditions
+        %after
+    }
+    ORDER BY ASC(?puzzle_id)
+    %limit
+""", variables=KEY_VARIABLES + ("next_player",) + COUNT_VARIABLES,
+    puzzle_values=SAMPLE_VALUES, conditions=SAMPLE_FILTER, after=SAMPLE_AFTER, limit=SAMPLE_LIMIT)
+
+register("game_state", PREFIXES + """
+    SELECT %variables
+    WHERE {
+        %puzzle_values
+        %piece_patterns
+        ?image chess:total_pieces ?total_pieces .
+        ?image chess:game_state ?computed_state .
+
+        %conditions
+        %after
+    }
+    ORDER BY ASC(?puzzle_id)
+    %limit
+""", variables=KEY_VARIABLES + ("next_player",) + COUNT_VARIABLES + ("total_pieces", "computed_state"),
+    puzzle_values=SAMPLE_VALUES, conditions='FILTER (?computed_state IN ("midgame"))',
+    after=SAMPLE_AFTER, limit=SAMPLE_LIMIT)
+
+register("ml_candidates", PREFIXES + """
+    SELECT ?image ?puzzle_id ?next_player""" + PIECE_VARIABLES + """
+    WHERE {
+        %puzzle_values
+        %piece_patterns
+    }
+""", puzzle_values=SAMPLE_VALUES)
+
+register("ml_images", PREFIXES + """
+    SELECT ?image ?puzzle_id
+    WHERE {
+        %puzzle_values
+        ?image chess:puzzle_id ?puzzle_id .
+    }
+""", puzzle_values=SAMPLE_VALUES)
+
+register("recommendation_displayed", PREFIXES + """
+    SELECT (COUNT(?puzzle) AS ?total_puzzles)
+           (SUM(IF(?to_move_castling, 1, 0)) AS ?has_castling)
+           (SUM(IF(?to_move_en_passant, 1, 0)) AS ?has_en_passant)
+           (SUM(?to_move_queens) AS ?queens)
+           (SUM(?to_move_rooks) AS ?rooks)
+           (SUM(?to_move_bishops) AS ?bishops)
+           (SUM(?to_move_knights) AS ?knights)
+           (SUM(?to_move_pawns) AS ?pawns)
+    WHERE {
+        %puzzle_values
+        ?puzzle chess:puzzle_id ?puzzle_id .
+
+        OPTIONAL { ?puzzle chess:to_move_castling ?to_move_castling . }
+        OPTIONAL { ?puzzle chess:to_move_en_passant ?to_move_en_passant . }
+
+        OPTIONAL { ?puzzle chess:to_move_queens ?to_move_queens . }
+        OPTIONAL { ?puzzle chess:to_move_rooks ?to_move_rooks . }
+        OPTIONAL { ?puzzle chess:to_move_bishops ?to_move_bishops . }
+        OPTIONAL { ?puzzle chess:to_move_knights ?to_move_knights . }
+        OPTIONAL { ?puzzle chess:to_move_pawns ?to_move_pawns . }
+    }
+""", puzzle_values=SAMPLE_VALUES)
+
+register("recommendation_candidates", PREFIXES + """
+    SELECT %variables
+    WHERE {
+        %piece_patterns
+        %feature_pattern
+        %canonical_only
+        %exclusion
+    }
+    %order_by
+    LIMIT %limit OFFSET %offset
+""", variables=KEY_VARIABLES + ("next_player",) + COUNT_VARIABLES,
+    feature_pattern="?image chess:to_move_rooks ?feature_value .",
+    exclusion="MINUS { " + SAMPLE_VALUES + " }",
+    order_by="ORDER BY DESC(?feature_value) ASC(?puzzle_id)",
+    limit=3, offset=0)
+
+
+def validate_templates():
+    """
+    Parses every template once so a broken query fails at startup, not on the first request.
+    """
+    for template in TEMPLATES.values():
+        for schema in PIECE_PATTERNS:
+            try:
+                template.validate(canonical_only=CANONICAL_ONLY,
+                                  **projection_fragments(template, schema, None, template.sample))
+            except Exception as e:
+                raise RuntimeError(f"Invalid SPARQL template '{template.name}' ({schema} schema): {e}") from e
+
+
+def projection_fragments(template, schema, variables, fragments):
+    """
+    %variables, %piece_patterns and %flag_patterns of a template. Listing templates select
+    the given variables (all of them when None) and the KEY_VARIABLES, and only bind the
+    piece counts and flags that are selected or that the other fragments reference.
+    """
+    if template.variables is None:
+        return {"piece_patterns": PIECE_PATTERNS[schema]}
+    selected = [
+        variable for variable in template.variables
+        if variables is None or variable in variables or variable in KEY_VARIABLES
+    ]
+    bound = set(selected) | set(re.findall(r"\?(\w+)", " ".join(map(str, fragments.values()))))
+    return {
+        "variables": " ".join(f"?{variable}" for variable in selected),
+        "piece_patterns": piece_patterns(schema, [count for count in COUNT_VARIABLES if count in bound]),
+        "flag_patterns": flag_patterns([flag for flag in FLAG_VARIABLES if flag in bound]),
+    }
+
+
+def render(name, variables=None, **fragments):
+    """
+    Renders a template for the RDF schema of the loaded dataset, without the duplicate
+    positions when COLLAPSE_DUPLICATES is set. Paginated templates return the whole
+    result unless after_condition / limit_clause fragments are given. variables narrows
+    the SELECT of the listing templates, see projection_fragments.
+    """
+    canonical_only = CANONICAL_ONLY if COLLAPSE_DUPLICATES else ""
+    fragments = {"after": "", "limit": "", **fragments}
+    template = TEMPLATES[name]
+    return template.render(canonical_only=canonical_only,
+                           **projection_fragments(template, read_rdf_schema(), variables, fragments), **fragments)
+
+
+validate_templates()
@@ -0,0 +1,148 @@
+"""
+Ingest-time validation against chess-shapes.ttl. The SHACL shapes are compiled once into
+vectorized checks over the (N, 2, 6) piece counts of utils.fen.FenBatch, so every chunk of
+the ingest is validated as it streams through instead of running a SHACL engine over the
+loaded graph. python -m utils.shacl_check cross-checks the compiled shapes against a real
+SHACL run on a sample of the dataset.
+"""
+import re
+import numpy as np
+import rdflib
+from rdflib.namespace import SH, XSD
+from utils.fen import SIDES, PIECES
+
+CHESS_NAMESPACE = "http://imaginealpacas.org/chess/"
+
+# "white_pieces_kings" (nested schema) or "white_kings" (flat schema)
+COUNT_PROPERTY = re.compile(rf"^({'|'.join(SIDES)})_(?:pieces_)?({'|'.join(PIECES)})$")
+
+# Pieces of SPARQL constraints of the form
+#   SELECT $this WHERE { $this chess:p ?a . ... BIND(?a + ?b ... AS ?total) FILTER(?total > N) }
+SPARQL_COUNT = re.compile(r"\$this\s+chess:(\w+)\s+\?(\w+)\s*\.")
+SPARQL_BIND = re.compile(r"BIND\s*\(\s*((?:\?\w+\s*\+\s*)*\?\w+)\s+AS\s+\?(\w+)\s*\)", re.IGNORECASE)
+SPARQL_FILTER = re.compile(r"FILTER\s*\(\s*\?(\w+)\s*(>=|<=|>|<)\s*(-?\d+)\s*\)", re.IGNORECASE)
+
+# Value types the counts are written with; a datatype constraint on them always holds
+COUNT_DATATYPES = (XSD.integer,)
+
+
+class Constraint:
+    """
+    A compiled shape constraint: the sum of the count columns (index side * 6 + piece)
+    must lie within [low, high], either bound being None when open.
+    """
+
+    def __init__(self, message, columns, low=None, high=None):
+        self.message = message
+        self.columns = list(columns)
+        self.low = low
+        self.high = high
+
+    def violations(self, counts):
+        """
+        (N,) bool, True for the boards of the (N, 2, 6) counts breaking the constraint.
+        """
+        totals = counts.reshape(len(counts), -1)[:, self.columns].sum(axis=1)
+        violated = np.zeros(len(counts), dtype=bool)
+        if self.low is not None:
+            violated |= totals < self.low
+        if self.high is not None:
+            violated |= totals > self.high
+        return violated
+
+
+def count_column(path):
+    """
+    Count column of a chess: property IRI; raises ValueError for any other path.
+    """
+    match = COUNT_PROPERTY.match(str(path)[len(CHESS_NAMESPACE):]) if str(path).startswith(CHESS_NAMESPACE) else None
+    if match is None:
+        raise ValueError(f"Cannot compile a constraint on {path}: not a piece count")
+    return SIDES.index(match.group(1)) * len(PIECES) + PIECES.index(match.group(2))
+
+
+def integer_value(shapes, node, predicate):
+    value = shapes.value(node, predicate)
+    return None if value is None else int(value.toPython())
+
+
+def compile_property(shapes, shape):
+    """
+    Constraints of a property shape: value ranges of one piece count. Datatype constraints
+    compile to nothing since the counts are always written as xsd:integer.
+    """
+    supported = {SH.path, SH.datatype, SH.message, SH.minInclusive, SH.maxInclusive,
+                 SH.minExclusive, SH.maxExclusive, SH.name, SH.description}
+    unsupported = set(shapes.predicates(shape)) - supported
+    if unsupported:
+        raise ValueError(f"Cannot compile property shape constraints: {', '.join(sorted(map(str, unsupported)))}")
+    column = count_column(shapes.value(shape, SH.path))
+    datatype = shapes.value(shape, SH.datatype)
+    if datatype is not None and datatype not in COUNT_DATATYPES:
+        raise ValueError(f"Piece counts are xsd:integer, a {datatype} constraint never holds")
+
+    # Counts are integers, so exclusive bounds are the next inclusive ones
+    lows = [integer_value(shapes, shape, SH.minInclusive), integer_value(shapes, shape, SH.minExclusive)]
+    highs = [integer_value(shapes, shape, SH.maxInclusive), integer_value(shapes, shape, SH.maxExclusive)]
+    lows = [bound for bound in (lows[0], None if lows[1] is None else lows[1] + 1) if bound is not None]
+    highs = [bound for bound in (highs[0], None if highs[1] is None else highs[1] - 1) if bound is not None]
+    low = max(lows) if lows else None
+    high = min(highs) if highs else None
+    if low is None and high is None:
+        return []
+    return [Constraint(str(shapes.value(shape, SH.message)), [column], low, high)]
+
+
+def compile_sparql(shapes, constraint):
+    """
+    A SPARQL constraint selecting the focus nodes whose sum of piece counts passes a
+    comparison, e.g. FILTER(?total > 16), as the allowed range of that sum.
+    """
+    query = str(shapes.value(constraint, SH.select))
+    variables = {variable: count_column(CHESS_NAMESPACE + name) for name, variable in SPARQL_COUNT.findall(query)}
+    sums = {total: re.findall(r"\?(\w+)", expression) for expression, total in SPARQL_BIND.findall(query)}
+    filters = SPARQL_FILTER.findall(query)
+    if len(filters) != 1 or filters[0][0] not in sums or not set(sums[filters[0][0]]) <= variables.keys():
+        raise ValueError(f"Cannot compile SPARQL constraint: {query.strip()}")
+    total, operator, bound = filters[0]
+    bound = int(bound)
+    # The query selects the violations, so the allowed range is the complement of the filter
+    low, high = {">": (None, bound), ">=": (None, bound - 1), "<": (bound, None), "<=": (bound + 1, None)}[operator]
+    return Constraint(str(shapes.value(constraint, SH.message)), [variables[v] for v in sums[total]], low, high)
+
+
+def compile_shapes(path):
+    """
+    Compiles the node shapes of a SHACL file into Constraints. Raises ValueError for a
+    constraint that cannot be checked on the piece counts, rather than skipping it.
+    """
+    shapes = rdflib.Graph().parse(path)
+    constraints = []
+    for shape in shapes.subjects(rdflib.RDF.type, SH.NodeShape):
+        for property_shape in shapes.objects(shape, SH.property):
+            constraints.extend(compile_property(shapes, property_shape))
+        for sparql in shapes.objects(shape, SH.sparql):
+            constraints.append(compile_sparql(shapes, sparql))
+    return constraints
+
+
+def validate_counts(counts, constraints):
+    """
+    (N, len(constraints)) bool matrix of the constraints each board of the counts breaks.
+    """
+    violations = np.zeros((len(counts), len(constraints)), dtype=bool)
+    for index, constraint in enumerate(constraints):
+        violations[:, index] = constraint.violations(counts)
+    return violations
+
+
+def violation_messages(violations, constraints):
+    """
+    {row: messages} of the rows of a validate_counts matrix breaking at least one constraint.
+    """
+    messages = {}
+    for row, index in zip(*np.nonzero(violations)):
+        row_messages = messages.setdefault(int(row), [])
+        if constraints[index].message not in row_messages:
+            row_messages.append(constraints[index].message)
+    return messages